@@ -48,6 +48,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'email_app.metrics.MetricsMiddleware',
 ]
 
 ROOT_URLCONF = 'azure_email_project.urls'
@@ -154,6 +155,115 @@ EMAIL_HOST_PASSWORD = 'your-azure-comm-password'
 EMAIL_USE_TLS = True
 EMAIL_DOMAIN = 'example.com'
 
+# DNS verification (email_app/dns_verification.py)
+DNS_VERIFICATION_CONCURRENCY = 50  # Lookups in flight at once
+DNS_VERIFICATION_TIMEOUT = 5  # Seconds per lookup
+DNS_MONITOR_MIN_INTERVAL = 60  # Never re-check a domain more often than this, whatever its TTL
+DNS_MONITOR_MAX_INTERVAL = 3600  # Re-check at least this often, even for long TTLs
+
+# SMTP connection pool used by AzureEmailService.send_email
+EMAIL_SMTP_POOL_SIZE = 4  # Authenticated sessions kept per SMTP account
+EMAIL_SMTP_POOL_IDLE_TIMEOUT = 60  # Seconds before an idle session is closed
+EMAIL_SMTP_POOL_MAX_MESSAGES = 100  # Messages sent before a session is recycled
+EMAIL_SMTP_POOL_HEALTHCHECK_INTERVAL = 5  # Idle seconds before a NOOP probe on reuse
+
+# Outbound queue drained by `manage.py send_queued_emails`
+EMAIL_QUEUE_BATCH_SIZE = 50  # Messages claimed per round trip
+EMAIL_QUEUE_CONCURRENCY = 8  # Messages sent in parallel per worker process
+EMAIL_QUEUE_LEASE_SECONDS = 300  # Claimed messages become reclaimable after this
+EMAIL_QUEUE_MAX_ATTEMPTS = 5  # Attempts before a message is marked FAILED
+EMAIL_QUEUE_RETRY_BACKOFF = 30  # Base retry delay in seconds, doubled per attempt
+EMAIL_QUEUE_RETRY_BACKOFF_MAX = 3600  # Upper bound for the retry delay
+
+# Direct API sends kept in flight by AzureEmailService.send_bulk
+EMAIL_BULK_CONCURRENCY = 32
+
+# Attachments (email_app/attachments.py)
+EMAIL_MAX_ATTACHMENTS_SIZE = 10 * 1024 * 1024  # Total per message; Azure's default limit, raise with your quota
+EMAIL_ATTACHMENT_SPOOL_SIZE = 1024 * 1024  # Streamed attachments over this size are spooled to disk
+
+# Compiled EmailTemplates kept per process (email_app/templating.py)
+EMAIL_TEMPLATE_CACHE_SIZE = 128
+
+# Provider throttling (email_app/throttling.py)
+EMAIL_RATE_LIMIT_PER_SECOND = None  # Sends per second across all workers, e.g. your ACS quota; None disables the bucket
+EMAIL_RATE_LIMIT_BURST = None  # Tokens that may be spent at once; defaults to one second's worth
+EMAIL_RATE_LIMIT_CACHE = 'default'  # Cache alias holding the bucket; use a shared cache (Redis) with several workers
+EMAIL_SEND_CONCURRENCY_INITIAL = 8  # In-flight sends per process before AIMD adjusts the limit
+EMAIL_SEND_CONCURRENCY_MIN = 1
+EMAIL_SEND_CONCURRENCY_MAX = 64
+EMAIL_SEND_RETRY_MAX_ATTEMPTS = 4  # Attempts per send for 429s, SMTP 4xx and transient errors
+EMAIL_SEND_RETRY_BUDGET_RATIO = 0.1  # Retries allowed as a share of recent sends
+EMAIL_SEND_RETRY_BACKOFF = 0.5  # Seconds; doubled per attempt with full jitter
+EMAIL_SEND_RETRY_BACKOFF_MAX = 30
+
+# Transport routing (email_app/transports.py). Empty: the outbox sends through
+# AzureEmailService, SMTP or direct API per message. Otherwise every entry is a
+# transport and sends are balanced and failed over between them. Transports
+# share the EMAIL_RATE_LIMIT_PER_SECOND bucket; give one its own 'rate' (and
+# 'burst') only when it sends against a separate quota, e.g.
+# EMAIL_TRANSPORTS = [
+#     {'type': 'smtp', 'name': 'relay-1', 'host': 'smtp.azurecomm.net', 'username': '...', 'password': '...'},
+#     {'type': 'api', 'name': 'acs-westeurope', 'connection_string': '...', 'weight': 2, 'rate': 50},
+# ]
+# A queued message is submitted at most EMAIL_QUEUE_MAX_ATTEMPTS x
+# len(EMAIL_TRANSPORTS) x EMAIL_TRANSPORT_MAX_ATTEMPTS times (5 x 2 x 2 = 20
+# with two transports); retries past the first submission also draw on the
+# EMAIL_SEND_RETRY_BUDGET_RATIO budget.
+EMAIL_TRANSPORTS = []
+EMAIL_TRANSPORT_MAX_ATTEMPTS = 2  # Attempts on one transport before failing over to the next
+EMAIL_TRANSPORT_BREAKER_WINDOW = 30  # Seconds of calls the circuit breaker looks at
+EMAIL_TRANSPORT_BREAKER_MIN_CALLS = 10  # Calls in the window before the breaker may open
+EMAIL_TRANSPORT_BREAKER_FAILURE_RATE = 0.5  # Share of failed calls that opens the breaker
+EMAIL_TRANSPORT_SLOW_CALL_SECONDS = 10  # Calls slower than this count as slow
+EMAIL_TRANSPORT_BREAKER_SLOW_RATE = 0.8  # Share of slow calls that opens the breaker
+EMAIL_TRANSPORT_BREAKER_OPEN_SECONDS = 30  # Seconds an open breaker waits before a probe call
+
+# Metrics and profiling (email_app/metrics.py), served at /metrics
+EMAIL_METRICS_DIR = None  # Shared directory for per-worker metric files under gunicorn; None keeps them in-process
+EMAIL_METRICS_FLUSH_INTERVAL = 5  # Seconds between writes of a worker's metrics file
+EMAIL_METRICS_TOKEN = None  # /metrics requires 'Authorization: Bearer <token>'; None serves staff users only
+EMAIL_PROFILER_ENABLED = False  # Lets staff add ?profile to a URL to get a sampled profile instead of the page
+EMAIL_PROFILER_INTERVAL = 0.005  # Seconds between stack samples
+
+# Asynchronous delivery tracking (email_app/reconciler.py)
+EMAIL_DIRECT_API_WAIT = False  # True polls each direct API send to completion instead of recording it as ACCEPTED
+EMAIL_DELIVERY_BATCH_SIZE = 200  # ACCEPTED messages polled per reconciler pass
+EMAIL_DELIVERY_CONCURRENCY = 16  # Send operations polled at once
+EMAIL_DELIVERY_POLL_INTERVAL = 5  # Seconds between polls of an unfinished send operation
+EMAIL_DELIVERY_MAX_AGE = 86400  # Sends still unfinished after this many seconds are marked FAILED
+EMAIL_WEBHOOK_SECRET = None  # Required ?token= on /webhooks/email-events/; the endpoint refuses everything while unset
+
+# Delivery and engagement event ingestion (email_app/events.py)
+EMAIL_EVENT_BUFFER_SIZE = 500  # Buffered events that trigger a write from the request; 1 writes every batch before responding
+EMAIL_EVENT_FLUSH_INTERVAL = 1.0  # Seconds between background writes of a partly filled buffer
+
+# Recipient validation (email_app/recipients.py)
+EMAIL_RECIPIENT_MX_CHECK = False  # Reject recipients at domains without mail service, one cached MX lookup per domain
+
+# Suppression list checked on every send (email_app/suppression.py)
+EMAIL_SUPPRESSION_ENABLED = True
+EMAIL_SUPPRESSION_REFRESH_INTERVAL = 5  # Seconds before newly suppressed addresses are picked up
+EMAIL_SUPPRESSION_REBUILD_INTERVAL = 3600  # Seconds between full reloads, which also drop removed addresses
+EMAIL_SUPPRESSION_ERROR_RATE = 0.001  # Bloom filter false positives, each confirmed with a database lookup
+
 # RoundCube settings (if using RoundCube integration)
 ROUNDCUBE_PATH = '/var/www/roundcube'  # Path to RoundCube installation
-ROUNDCUBE_URL = 'http://localhost/roundcube'  # URL to RoundCube installation
\ No newline at end of file
+ROUNDCUBE_URL = 'http://localhost/roundcube'  # URL to RoundCube installation
+ROUNDCUBE_DATABASE = 'roundcube'  # DATABASES alias of RoundCube's own database, used by the user sync (email_app/roundcube_sync.py)
+ROUNDCUBE_MAIL_HOST = 'localhost'  # users.mail_host of synced accounts: RoundCube's default_host
+ROUNDCUBE_SYNC_ENABLED = True  # Record user changes for the incremental sync
+ROUNDCUBE_SYNC_CHUNK_SIZE = 500  # Users read and written per batch
+ROUNDCUBE_SYNC_INTERVAL = 60  # Seconds between runs of the sync_roundcube_users command
+ROUNDCUBE_SSO_KEYS = {}  # {key id: secret}; the first signs SSO tokens, the rest still verify. Empty uses SECRET_KEY and SECRET_KEY_FALLBACKS
+ROUNDCUBE_SSO_TOKEN_TTL = 60  # Seconds an SSO link stays valid
+ROUNDCUBE_SSO_REPLAY_CACHE = None  # CACHES alias recording used tokens; None keeps them in process, fine for a single worker
+ROUNDCUBE_SSO_VALIDATION_SECRET = None  # Sent by RoundCube's SSO plugin as X-SSO-Secret; the validation endpoint refuses everything without it
+
+# Index page figures (email_app/dashboard.py)
+EMAIL_DASHBOARD_DAYS = 30  # Days covered by the totals, per-day volume and top domains
+EMAIL_DASHBOARD_CACHE = 'default'  # Cache alias for the figures; writes invalidate them by bumping a version
+EMAIL_DASHBOARD_CACHE_TIMEOUT = 300
+
+# Admin changelist for EmailMessage (email_app/search.py)
+EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD = 10000  # Above this many rows, page counts come from planner statistics instead of COUNT(*)
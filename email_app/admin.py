@@ -1,20 +1,147 @@
 # email_app/admin.py
+from datetime import datetime, timedelta
 from django.contrib import admin
-from .models import EmailMessage, DNSRecord
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Max, Min, QuerySet, Value
+from django.db.models.functions import Length, Replace, Substr
+from django.utils import timezone
+from .models import EmailMessage, EmailRecipient, EmailEvent, EmailTemplate, DNSRecord, SuppressedAddress, RoundCubeAccount
+from .recipients import MAX_ADDRESS_LENGTH, summarize_recipients
+from .search import EstimatedCountPaginator, full_text_filter
+
+# Enough of the recipients string for the two addresses the changelist shows
+RECIPIENTS_HEAD_LENGTH = 2 * (MAX_ADDRESS_LENGTH + 2)
+
+class EmailRecipientInline(admin.TabularInline):
+    model = EmailRecipient
+    fields = ('address', 'status', 'error_message')
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+    
+    def has_add_permission(self, request, obj=None):
+        return False
+
+def _period_start(value, kind):
+    return datetime(value.year, 1 if kind == 'year' else value.month, value.day if kind == 'day' else 1,
+                    tzinfo=value.tzinfo)
+
+def _next_period(start, kind):
+    if kind == 'year':
+        return start.replace(year=start.year + 1)
+    if kind == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return datetime.combine(start.date() + timedelta(days=1), start.time(), start.tzinfo)
+
+class SentAtProbeQuerySet(QuerySet):
+    """
+    QuerySet for the changelist whose ``datetimes`` finds the years, months
+    or days holding messages with one ranged EXISTS per period between the
+    first and last sent_at, each a seek on the (status, sent_at) index,
+    instead of a DISTINCT over every message's truncated date. It is what
+    date_hierarchy calls for its links.
+    """
+    
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None, **kwargs):
+        if kind not in ('year', 'month', 'day'):
+            return super().datetimes(field_name, kind, order, tzinfo, **kwargs)
+        bounds = self.aggregate(first=Min(field_name), last=Max(field_name))
+        if bounds['first'] is None:
+            return []
+        if timezone.is_aware(bounds['first']):
+            tzinfo = tzinfo or timezone.get_current_timezone()
+            bounds = {key: timezone.localtime(value, tzinfo) for key, value in bounds.items()}
+        # Every status, so each probe is a range seek on (status, sent_at)
+        statuses = [status for status, _ in EmailMessage.STATUS_CHOICES]
+        period = _period_start(bounds['first'], kind)
+        periods = []
+        while period <= bounds['last']:
+            following = _next_period(period, kind)
+            in_period = {f'{field_name}__gte': period, f'{field_name}__lt': following}
+            if self.filter(status__in=statuses, **in_period).exists():
+                periods.append(period)
+            period = following
+        return periods[::-1] if order == 'DESC' else periods
+
+class EmailMessageChangeList(ChangeList):
+    """
+    Changelist rows without the message bodies, and with the recipients cut
+    to their start plus an address count computed by the database, so a page
+    of mass mailings does not pull every address across to be summarised.
+    """
+    
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('body', 'html_body', 'recipients').annotate(
+            recipients_head=Substr('recipients', 1, RECIPIENTS_HEAD_LENGTH),
+            recipient_count=Length('recipients') - Length(Replace('recipients', Value(','), Value(''))) + 1,
+        )
 
 @admin.register(EmailMessage)
 class EmailMessageAdmin(admin.ModelAdmin):
     list_display = ('subject', 'sender', 'recipients_summary', 'sent_at', 'status', 'created_by')
+    list_select_related = ('created_by',)
+    # Its links come from SentAtProbeQuerySet: a MIN/MAX of sent_at plus an
+    # indexed EXISTS per period rather than a DISTINCT over every row
+    date_hierarchy = 'sent_at'
     list_filter = ('status', 'sent_at', 'created_by')
+    # LIKE fallback for databases without the full-text index
     search_fields = ('subject', 'sender', 'recipients', 'body')
-    readonly_fields = ('sent_at',)
-    date_hierarchy = 'sent_at'
+    readonly_fields = (
+        'sent_at', 'provider_message_id', 'transport', 'continuation_token',
+        'connect_ms', 'tls_ms', 'auth_ms', 'submit_ms', 'total_ms',
+    )
+    inlines = [EmailRecipientInline]
+    # Estimated above EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD rows, and no
+    # second COUNT(*) of the whole table for "N total"
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        return SentAtProbeQuerySet(self.model, query=queryset.query, using=queryset.db)
+    
+    def get_changelist(self, request, **kwargs):
+        return EmailMessageChangeList
+    
+    def get_search_results(self, request, queryset, search_term):
+        # The full-text index where migration 0013 built one, LIKE over search_fields otherwise
+        matched = full_text_filter(queryset, search_term)
+        if matched is None:
+            return super().get_search_results(request, queryset, search_term)
+        return matched, False
     
+    @admin.display(description='Recipients')
     def recipients_summary(self, obj):
-        recipients = obj.recipients.split(',')
-        if len(recipients) > 2:
-            return f"{recipients[0]}, {recipients[1]} (+{len(recipients)-2} more)"
-        return obj.recipients
+        if hasattr(obj, 'recipients_head'):
+            return summarize_recipients(obj.recipients_head, total=obj.recipient_count)
+        return summarize_recipients(obj.recipients)
+
+@admin.register(EmailEvent)
+class EmailEventAdmin(admin.ModelAdmin):
+    list_display = ('event_type', 'status', 'recipient', 'occurred_at', 'received_at')
+    list_filter = ('event_type', 'status')
+    search_fields = ('recipient', 'provider_message_id', 'event_id')
+    raw_id_fields = ('message',)
+    readonly_fields = ('received_at',)
+
+@admin.register(SuppressedAddress)
+class SuppressedAddressAdmin(admin.ModelAdmin):
+    list_display = ('address', 'reason', 'created_at')
+    list_filter = ('reason',)
+    search_fields = ('address',)
+    readonly_fields = ('created_at',)
+
+@admin.register(RoundCubeAccount)
+class RoundCubeAccountAdmin(admin.ModelAdmin):
+    list_display = ('user_id', 'username', 'rc_user_id', 'changed_at', 'synced_at')
+    search_fields = ('username',)
+    readonly_fields = ('user_id', 'rc_user_id', 'username', 'name', 'changed_at', 'synced_at')
+
+@admin.register(EmailTemplate)
+class EmailTemplateAdmin(admin.ModelAdmin):
+    list_display = ('name', 'subject', 'version', 'updated_at', 'created_by')
+    search_fields = ('name', 'subject')
+    readonly_fields = ('version', 'updated_at')
 
 @admin.register(DNSRecord)
 class DNSRecordAdmin(admin.ModelAdmin):
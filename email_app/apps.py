@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class EmailAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'email_app'
+
+    def ready(self):
+        # Connects the user signals that feed the incremental RoundCube sync
+        from . import roundcube_sync  # noqa: F401
+        # Register the system checks for the full-text search index and the rate limit cache
+        from . import search, throttling  # noqa: F401
@@ -0,0 +1,270 @@
+# email_app/async_services.py
+import asyncio
+import time
+import uuid
+import weakref
+
+import aiosmtplib
+from asgiref.sync import sync_to_async
+from azure.communication.email.aio import EmailClient as AsyncEmailClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.polling.async_base_polling import AsyncLROBasePolling
+from django.conf import settings
+
+from .metrics import record_send
+from .suppression import allowed_recipients
+from .results import OPERATION_STATUSES, SendResult, SendTimings
+from .services import build_api_message, build_mime_message
+from .throttling import get_throttle
+
+
+class AsyncStatusPolling(AsyncLROBasePolling):
+    """asyncio counterpart of ``services.StatusPolling``"""
+
+    def __init__(self, polls=1):
+        super().__init__(0, lro_options={'final-state-via': 'azure-async-operation'})
+        self.polls = polls
+
+    async def run(self):
+        for _ in range(self.polls):
+            if self.finished():
+                break
+            await self.update_status()
+
+
+class _AsyncPooledSMTPConnection:
+    def __init__(self, server):
+        self.server = server
+        self.last_used = time.monotonic()
+        self.messages_sent = 0
+
+    async def close(self):
+        try:
+            await self.server.quit()
+        except Exception:
+            self.server.close()
+
+
+class AsyncSMTPConnectionPool:
+    """
+    asyncio counterpart of ``smtp_pool.SMTPConnectionPool``.
+
+    A pool belongs to a single event loop; use ``get_async_smtp_pool`` to get
+    the one for the running loop.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True,
+                 size=4, idle_timeout=60, max_messages=100, healthcheck_interval=5,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.healthcheck_interval = healthcheck_interval
+        self.timeout = timeout
+
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+        self.connections_opened = 0
+
+    async def _connect(self):
+        server = aiosmtplib.SMTP(
+            hostname=self.host,
+            port=self.port,
+            start_tls=self.use_tls,
+            timeout=self.timeout
+        )
+        await server.connect()
+        try:
+            if self.username:
+                await server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        self.connections_opened += 1
+        return _AsyncPooledSMTPConnection(server)
+
+    async def _checkout(self):
+        while self._idle:
+            conn = self._idle.pop()
+            idle_for = time.monotonic() - conn.last_used
+            if idle_for > self.idle_timeout:
+                await conn.close()
+                continue
+            if idle_for > self.healthcheck_interval:
+                try:
+                    response = await conn.server.noop()
+                except (aiosmtplib.SMTPException, OSError):
+                    conn.server.close()
+                    continue
+                if response.code != 250:
+                    await conn.close()
+                    continue
+            return conn
+        return await self._connect()
+
+    async def _checkin(self, conn):
+        conn.last_used = time.monotonic()
+        if conn.messages_sent >= self.max_messages:
+            await conn.close()
+        else:
+            self._idle.append(conn)
+
+    async def send_message(self, message):
+        """Send a message, reconnecting once if the pooled session was dropped"""
+        async with self._slots:
+            for attempt in range(2):
+                conn = await self._checkout()
+                try:
+                    result = await conn.server.send_message(message)
+                except aiosmtplib.SMTPServerDisconnected:
+                    conn.server.close()
+                    if attempt:
+                        raise
+                    continue
+                except Exception:
+                    conn.server.close()
+                    raise
+                conn.messages_sent += 1
+                await self._checkin(conn)
+                return result
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await conn.close()
+
+
+# One Azure client and one SMTP pool per event loop; aiohttp sessions and
+# asyncio primitives must not be shared across loops.
+_loop_state = weakref.WeakKeyDictionary()
+
+
+def _state_for_running_loop():
+    loop = asyncio.get_running_loop()
+    state = _loop_state.get(loop)
+    if state is None:
+        state = _loop_state[loop] = {}
+    return state
+
+
+async def close_async_clients():
+    """Close the Azure client and SMTP pool belonging to the running loop"""
+    state = _loop_state.pop(asyncio.get_running_loop(), {})
+    if 'email_client' in state:
+        await state['email_client'].close()
+    if 'smtp_pool' in state:
+        await state['smtp_pool'].close()
+
+
+class AsyncAzureEmailService:
+    """
+    Non-blocking variant of ``AzureEmailService`` for ASGI views and asyncio
+    workers. Sends go through the same process-wide Throttle as the sync
+    service: one token bucket, concurrency limit and retry budget for both.
+    """
+
+    def __init__(self):
+        """Read Azure and SMTP settings; clients are created lazily per event loop"""
+        self.connection_string = settings.AZURE_COMMUNICATION_CONNECTION_STRING
+        self.api_key = getattr(settings, 'AZURE_COMMUNICATION_API_KEY', None)
+        self.endpoint = getattr(settings, 'AZURE_COMMUNICATION_ENDPOINT', None)
+
+        if not self.connection_string and not (self.api_key and self.endpoint):
+            raise ValueError("Azure Communication Service credentials not properly configured in settings")
+
+        # SMTP settings from Django settings
+        self.smtp_server = settings.EMAIL_HOST
+        self.smtp_port = settings.EMAIL_PORT
+        self.smtp_username = settings.EMAIL_HOST_USER
+        self.smtp_password = settings.EMAIL_HOST_PASSWORD
+        self.smtp_use_tls = getattr(settings, 'EMAIL_USE_TLS', True)
+        self.throttle = get_throttle()
+
+    def get_email_client(self):
+        """Return the async EmailClient shared by everything on the running loop"""
+        state = _state_for_running_loop()
+        client = state.get('email_client')
+        if client is None:
+            if self.connection_string:
+                client = AsyncEmailClient.from_connection_string(self.connection_string)
+            else:
+                client = AsyncEmailClient(self.endpoint, AzureKeyCredential(self.api_key))
+            state['email_client'] = client
+        return client
+
+    def get_smtp_pool(self):
+        """Return the async SMTP pool shared by everything on the running loop"""
+        state = _state_for_running_loop()
+        pool = state.get('smtp_pool')
+        if pool is None:
+            pool = state['smtp_pool'] = AsyncSMTPConnectionPool(
+                self.smtp_server,
+                self.smtp_port,
+                username=self.smtp_username,
+                password=self.smtp_password,
+                use_tls=self.smtp_use_tls,
+                size=getattr(settings, 'EMAIL_SMTP_POOL_SIZE', 4),
+                idle_timeout=getattr(settings, 'EMAIL_SMTP_POOL_IDLE_TIMEOUT', 60),
+                max_messages=getattr(settings, 'EMAIL_SMTP_POOL_MAX_MESSAGES', 100),
+                healthcheck_interval=getattr(settings, 'EMAIL_SMTP_POOL_HEALTHCHECK_INTERVAL', 5),
+                timeout=getattr(settings, 'EMAIL_TIMEOUT', None) or 30,
+            )
+        return pool
+
+    async def send_email(self, sender, recipients, subject, body, html_body=None):
+        """Send email using Azure Communication Services SMTP; returns a ``results.SendResult``"""
+        timings = SendTimings()
+        suppressed = []
+        started = time.perf_counter()
+        try:
+            recipients = await sync_to_async(allowed_recipients)(recipients, suppressed)
+            message = build_mime_message(sender, recipients, subject, body, html_body)
+            pool = self.get_smtp_pool()
+            await self.throttle.acall(lambda: pool.send_message(message))
+            timings.submit = time.perf_counter() - started
+            result = SendResult.sent("Email sent successfully", 'smtp', message['Message-ID'], timings)
+        except Exception as e:
+            result = SendResult.failed(e, f"Failed to send email: {str(e)}", transport='smtp', timings=timings)
+        result.suppressed = suppressed
+        timings.total = time.perf_counter() - started
+        record_send(result)
+        return result
+
+    async def send_email_direct_api(self, sender, recipients, subject, body, html_body=None):
+        """Send email using Azure Communication Services direct API; returns a ``results.SendResult``"""
+        timings = SendTimings()
+        suppressed = []
+        started = time.perf_counter()
+        try:
+            recipients = await sync_to_async(allowed_recipients)(recipients, suppressed)
+            message = build_api_message(sender, recipients, subject, body, html_body)
+            wait = getattr(settings, 'EMAIL_DIRECT_API_WAIT', False)
+            client = self.get_email_client()
+            # As in services.deliver_api: 429s reach the throttle, and the
+            # fixed operation id makes a retried submit idempotent
+            operation_id = str(uuid.uuid4())
+            poller = await self.throttle.acall(
+                lambda: client.begin_send(
+                    message, operation_id=operation_id, retry_total=0, polling=True if wait else AsyncStatusPolling(0)
+                )
+            )
+            timings.submit = time.perf_counter() - started
+            operation = await poller.result()
+            if wait:
+                timings.poll = time.perf_counter() - started - timings.submit
+            continuation_token = None
+            if OPERATION_STATUSES.get(operation.get('status'), 'ACCEPTED') == 'ACCEPTED':
+                continuation_token = poller.continuation_token()
+            result = SendResult.from_operation(operation, 'api', timings, continuation_token)
+        except Exception as e:
+            result = SendResult.failed(
+                e, f"Failed to send email via direct API: {str(e)}", transport='api', timings=timings
+            )
+        result.suppressed = suppressed
+        timings.total = time.perf_counter() - started
+        record_send(result)
+        return result
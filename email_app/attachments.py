@@ -0,0 +1,156 @@
+# email_app/attachments.py
+import base64
+import mimetypes
+import mmap
+import os
+import re
+import shutil
+import threading
+import uuid
+from email import policy
+from email.mime.base import MIMEBase
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+
+# Raw bytes per encoded block; a multiple of 57 so every block is whole
+# 76-character base64 lines and blocks can be concatenated as they are
+BLOCK_SIZE = 57 * 1024
+
+
+class AttachmentTooLarge(Exception):
+    """Raised before sending when the attachments exceed EMAIL_MAX_ATTACHMENTS_SIZE"""
+
+
+class Attachment:
+    """
+    A file attached to an outgoing email, read lazily from where it already is.
+
+    On-disk files are memory-mapped and encoded block by block, so attaching a
+    25 MB file costs a few encoded blocks of memory per SMTP send rather than
+    the whole message. The base64 text needed by the direct API is built once
+    and shared by every send that uses the same Attachment, e.g. all the
+    messages of a bulk send.
+    """
+
+    def __init__(self, name, content_type=None, path=None, fileobj=None, size=None):
+        if (path is None) == (fileobj is None):
+            raise ValueError("Attachment needs exactly one of path or fileobj")
+        self.name = name
+        self.content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        self.path = path
+        self.fileobj = fileobj
+        if size is None:
+            if path is not None:
+                size = os.path.getsize(path)
+            else:
+                fileobj.seek(0, os.SEEK_END)
+                size = fileobj.tell()
+        self.size = size
+        self._base64 = None
+        self._lock = threading.RLock()
+        # Stands in for the encoded body in the MIME skeleton, see iter_mime_message
+        self.placeholder = f'attachment-{uuid.uuid4().hex}'
+
+    @classmethod
+    def from_path(cls, path, name=None, content_type=None):
+        return cls(name or os.path.basename(path), content_type, path=path)
+
+    @classmethod
+    def from_upload(cls, upload):
+        """Wrap a Django UploadedFile; large uploads are already spooled to disk"""
+        if hasattr(upload, 'temporary_file_path'):
+            return cls(upload.name, upload.content_type, path=upload.temporary_file_path(), size=upload.size)
+        return cls(upload.name, upload.content_type, fileobj=upload.file, size=upload.size)
+
+    @classmethod
+    def from_stream(cls, stream, name, content_type=None):
+        """
+        Copy a one-shot stream (e.g. a download) into a SpooledTemporaryFile so
+        it can be re-read for every recipient and retry. Small files stay in
+        memory; anything over EMAIL_ATTACHMENT_SPOOL_SIZE goes to disk.
+        """
+        spool = SpooledTemporaryFile(max_size=getattr(settings, 'EMAIL_ATTACHMENT_SPOOL_SIZE', 1024 * 1024))
+        shutil.copyfileobj(stream, spool, BLOCK_SIZE)
+        return cls(name, content_type, fileobj=spool)
+
+    def blocks(self):
+        """Yield the raw content in BLOCK_SIZE pieces without reading it all at once"""
+        if self.path is not None:
+            if not self.size:
+                return
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                for offset in range(0, len(mapped), BLOCK_SIZE):
+                    yield mapped[offset:offset + BLOCK_SIZE]
+            return
+
+        # The file object may be shared by concurrent sends, so each read
+        # seeks to this reader's own position first
+        position = 0
+        while True:
+            with self._lock:
+                self.fileobj.seek(position)
+                block = self.fileobj.read(BLOCK_SIZE)
+            if not block:
+                return
+            position += len(block)
+            yield block
+
+    def mime_chunks(self):
+        """The content as CRLF-terminated 76-character base64 lines, one block at a time"""
+        for block in self.blocks():
+            yield base64.encodebytes(block).replace(b'\n', b'\r\n')
+
+    def base64(self):
+        """The content as one base64 string, encoded once and then reused"""
+        with self._lock:
+            if self._base64 is None:
+                self._base64 = ''.join(base64.b64encode(block).decode('ascii') for block in self.blocks())
+            return self._base64
+
+    def mime_part(self):
+        """A MIME part with this attachment's headers and a placeholder body"""
+        maintype, _, subtype = self.content_type.partition('/')
+        part = MIMEBase(maintype, subtype or 'octet-stream')
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', 'attachment', filename=self.name)
+        part.set_payload(self.placeholder)
+        return part
+
+    def api_payload(self):
+        return {
+            "name": self.name,
+            "contentType": self.content_type,
+            "contentInBase64": self.base64(),
+        }
+
+
+def check_attachments_size(attachments):
+    """Raise AttachmentTooLarge if the attachments are over the configured total"""
+    limit = getattr(settings, 'EMAIL_MAX_ATTACHMENTS_SIZE', 10 * 1024 * 1024)
+    total = sum(attachment.size for attachment in attachments or ())
+    if total > limit:
+        raise AttachmentTooLarge(f"Attachments total {total} bytes, over the {limit} byte limit")
+
+
+# Same rule smtplib applies to DATA: a line starting with '.' gets another one
+_LEADING_DOT_RE = re.compile(rb'(?m)^\.')
+
+
+def iter_mime_message(message, attachments):
+    """
+    Yield ``message`` as SMTP DATA bytes (CRLF line endings, dot-stuffed)
+    with each attachment's base64 streamed in place of its placeholder part,
+    so the encoded attachments are never held in memory at once.
+
+    ``message`` is built by ``build_mime_message`` with ``attachments``; every
+    header, boundary and filename is still produced by the email package.
+    """
+    skeleton = _LEADING_DOT_RE.sub(b'..', message.as_bytes(policy=policy.SMTP))
+    for attachment in attachments:
+        head, skeleton = skeleton.split(attachment.placeholder.encode('ascii') + b'\r\n', 1)
+        yield head
+        yield from attachment.mime_chunks()
+    if not skeleton.endswith(b'\r\n'):
+        skeleton += b'\r\n'
+    yield skeleton
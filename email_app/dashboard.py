@@ -0,0 +1,197 @@
+# email_app/dashboard.py
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Count, F, Sum, Value
+from django.db.models.functions import Lower, StrIndex, Substr, TruncDate
+from django.utils import timezone
+
+from .models import EmailDailyStat, EmailDomainDailyStat, EmailMessage, EmailRecipient
+
+# Statuses a send ends in; messages are counted once they reach one
+FINAL_STATUSES = ('SENT', 'DELIVERED', 'FAILED')
+
+TOP_DOMAINS = 5
+
+# Rollup rows written per bulk_create while rebuilding
+REBUILD_BATCH_SIZE = 1000
+
+_GLOBAL_VERSION_KEY = 'dashboard:version'
+
+
+def _cache():
+    return caches[getattr(settings, 'EMAIL_DASHBOARD_CACHE', 'default')]
+
+
+def _version_key(user_id):
+    return f'dashboard:version:{user_id}'
+
+
+def _bump_versions(user_ids=None):
+    """Invalidate the cached dashboards of ``user_ids``, or of everyone"""
+    cache = _cache()
+    for key in [_version_key(user_id) for user_id in user_ids] if user_ids is not None else [_GLOBAL_VERSION_KEY]:
+        try:
+            cache.incr(key)
+        except ValueError:
+            # A fresh version that cannot collide with one evicted from the cache
+            cache.set(key, time.time_ns(), None)
+
+
+def _add(counter, model, key_fields):
+    """Add ``counter`` ({key tuple: delta}) to the matching rollup rows"""
+    counter = {key: delta for key, delta in counter.items() if delta}
+    if not counter:
+        return
+    model.objects.bulk_create(
+        [model(**dict(zip(key_fields, key)), count=0) for key in counter],
+        ignore_conflicts=True
+    )
+    for key, delta in counter.items():
+        model.objects.filter(**dict(zip(key_fields, key))).update(count=F('count') + delta)
+
+
+def record_outcomes(changes):
+    """
+    Update the rollups for messages whose status changed.
+
+    ``changes`` holds ``(user_id, sent_at, addresses, old_status, new_status)``
+    per message, ``old_status`` None for a message that was just created. A
+    message is counted under its final status and moved when that changes
+    (SENT to DELIVERED or FAILED); its recipient domains are counted once,
+    when it first reaches a final status. Costs one UPDATE per distinct
+    (user, day, status) or (user, day, domain) in the batch, not one per
+    message, and invalidates the cached dashboards of the users involved
+    once the transaction commits.
+    """
+    statuses = Counter()
+    domains = Counter()
+    for user_id, sent_at, addresses, old_status, new_status in changes:
+        if old_status == new_status or new_status not in FINAL_STATUSES:
+            continue
+        day = timezone.localdate(sent_at)
+        statuses[(user_id, day, new_status)] += 1
+        if old_status in FINAL_STATUSES:
+            statuses[(user_id, day, old_status)] -= 1
+        else:
+            for address in addresses:
+                domains[(user_id, day, address.rpartition('@')[2].lower())] += 1
+    if not statuses:
+        return
+    with transaction.atomic():
+        _add(statuses, EmailDailyStat, ('user_id', 'day', 'status'))
+        _add(domains, EmailDomainDailyStat, ('user_id', 'day', 'domain'))
+    user_ids = {user_id for user_id, _, _ in statuses}
+    transaction.on_commit(lambda: _bump_versions(user_ids))
+
+
+def compute_dashboard(user_id, days):
+    """Read the dashboard figures for the last ``days`` days straight from the rollups"""
+    today = timezone.localdate()
+    since = today - timedelta(days=days - 1)
+    per_day = {since + timedelta(days=offset): {'sent': 0, 'delivered': 0, 'failed': 0} for offset in range(days)}
+    for day, status, count in EmailDailyStat.objects.filter(user_id=user_id, day__gte=since).values_list(
+            'day', 'status', 'count'):
+        if day in per_day:
+            figures = per_day[day]
+            if status == 'FAILED':
+                figures['failed'] += count
+            else:
+                # Delivered messages were sent too
+                figures['sent'] += count
+                if status == 'DELIVERED':
+                    figures['delivered'] += count
+    top_domains = list(
+        EmailDomainDailyStat.objects.filter(user_id=user_id, day__gte=since)
+        .values('domain').annotate(total=Sum('count')).order_by('-total', 'domain')
+        .values_list('domain', 'total')[:TOP_DOMAINS]
+    )
+    return {
+        'days': days,
+        'sent': sum(figures['sent'] for figures in per_day.values()),
+        'delivered': sum(figures['delivered'] for figures in per_day.values()),
+        'failed': sum(figures['failed'] for figures in per_day.values()),
+        'per_day': [dict(figures, day=day) for day, figures in sorted(per_day.items())],
+        'top_domains': top_domains,
+    }
+
+
+def dashboard_stats(user, days=None):
+    """
+    The index page figures for ``user``: sent, delivered and failed totals,
+    per-day volume and top recipient domains over the last ``days`` days.
+
+    Cache-aside: the key carries a per-user and a global version, bumped by
+    ``record_outcomes`` and ``rebuild_rollups``, so writes invalidate without
+    deleting anything, and the date, so the window moves at midnight. A miss
+    reads at most ``days`` x statuses rollup rows, however long the history.
+    """
+    days = days or getattr(settings, 'EMAIL_DASHBOARD_DAYS', 30)
+    cache = _cache()
+    user_key = _version_key(user.pk)
+    versions = cache.get_many([_GLOBAL_VERSION_KEY, user_key])
+    key = (f'dashboard:{versions.get(_GLOBAL_VERSION_KEY, 0)}:{versions.get(user_key, 0)}:'
+           f'{user.pk}:{days}:{timezone.localdate().isoformat()}')
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_dashboard(user.pk, days)
+        cache.set(key, stats, getattr(settings, 'EMAIL_DASHBOARD_CACHE_TIMEOUT', 300))
+    return stats
+
+
+def _domain():
+    return Lower(Substr('address', StrIndex('address', Value('@')) + 1))
+
+
+def rebuild_rollups(since=None):
+    """
+    Recompute the rollups from EmailMessage and EmailRecipient, for days
+    from ``since`` on or for all history. Returns the number of status and
+    domain rows written. Sends finishing while this runs may be counted
+    twice or not at all, so run it when the outbox is quiet.
+    """
+    messages = EmailMessage.objects.filter(status__in=FINAL_STATUSES)
+    recipients = EmailRecipient.objects.filter(message__status__in=FINAL_STATUSES)
+    stats = EmailDailyStat.objects.all()
+    domains = EmailDomainDailyStat.objects.all()
+    if since is not None:
+        messages = messages.filter(sent_at__date__gte=since)
+        recipients = recipients.filter(message__sent_at__date__gte=since)
+        stats = stats.filter(day__gte=since)
+        domains = domains.filter(day__gte=since)
+
+    written = 0
+    with transaction.atomic():
+        stats.delete()
+        domains.delete()
+        rows = (
+            messages.annotate(day=TruncDate('sent_at')).order_by()
+            .values_list('created_by_id', 'day', 'status').annotate(count=Count('pk'))
+        )
+        written += _bulk_insert(EmailDailyStat, ('user_id', 'day', 'status'), rows)
+        rows = (
+            recipients.annotate(day=TruncDate('message__sent_at'), domain=_domain()).order_by()
+            .values_list('message__created_by_id', 'day', 'domain').annotate(count=Count('pk'))
+        )
+        written += _bulk_insert(EmailDomainDailyStat, ('user_id', 'day', 'domain'), rows)
+    transaction.on_commit(_bump_versions)
+    return written
+
+
+def _bulk_insert(model, key_fields, rows):
+    written = 0
+    batch = []
+    for *key, count in rows.iterator(chunk_size=REBUILD_BATCH_SIZE):
+        batch.append(model(**dict(zip(key_fields, key)), count=count))
+        if len(batch) >= REBUILD_BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            written += len(batch)
+            batch = []
+    if batch:
+        model.objects.bulk_create(batch)
+        written += len(batch)
+    return written
@@ -0,0 +1,195 @@
+# email_app/dns_monitor.py
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import Signal
+from django.utils import timezone
+
+from .dns_verification import DNSCache, DNSVerificationEngine, dkim_selector, record_matches
+from .models import DNSAnswerHistory, DNSDomainState, DNSRecord
+
+logger = logging.getLogger(__name__)
+
+# Sent with ``domain`` and ``events`` (a list of drift dicts) whenever a
+# monitored record set changes in a way worth alerting on
+dns_drift_detected = Signal()
+
+
+def _first_with_prefix(answers, prefix):
+    return next((answer for answer in answers if answer.startswith(prefix)), None)
+
+
+def detect_drift(lookup, old, new):
+    """Describe how a lookup's answers changed, e.g. an SPF record removed or an MX priority changed"""
+    events = []
+    if lookup == 'MX':
+        old_mx = {server: pref for pref, server in old}
+        new_mx = {server: pref for pref, server in new}
+        for server in sorted(old_mx.keys() - new_mx.keys()):
+            events.append({'type': 'mx_removed', 'server': server, 'priority': old_mx[server]})
+        for server in sorted(new_mx.keys() - old_mx.keys()):
+            events.append({'type': 'mx_added', 'server': server, 'priority': new_mx[server]})
+        for server in sorted(old_mx.keys() & new_mx.keys()):
+            if old_mx[server] != new_mx[server]:
+                events.append({
+                    'type': 'mx_priority_changed',
+                    'server': server,
+                    'old': old_mx[server],
+                    'new': new_mx[server],
+                })
+        return events
+
+    if lookup == 'TXT':
+        kind, prefix = 'spf', 'v=spf1'
+    elif lookup == 'DMARC':
+        kind, prefix = 'dmarc', 'v=DMARC1'
+    elif lookup.startswith('DKIM:'):
+        kind, prefix = 'dkim', ''
+    else:
+        return events
+
+    before = _first_with_prefix(old, prefix)
+    after = _first_with_prefix(new, prefix)
+    if before and not after:
+        events.append({'type': f'{kind}_removed', 'old': before})
+    elif after and not before:
+        events.append({'type': f'{kind}_added', 'new': after})
+    elif before != after:
+        events.append({'type': f'{kind}_changed', 'old': before, 'new': after})
+    if kind == 'dkim' and events:
+        events[0]['selector'] = lookup.split(':', 1)[1]
+    return events
+
+
+def snapshot(report):
+    """JSON-friendly, order-independent answers for every lookup that succeeded"""
+    return {
+        key: sorted(list(answer) if isinstance(answer, tuple) else answer for answer in result.answers)
+        for key, result in report.lookups.items()
+        if result.ok
+    }
+
+
+class DNSMonitor:
+    """
+    Periodically re-verify every domain that has stored DNSRecords.
+
+    Each domain is re-checked after the shortest TTL among its answers
+    (clamped to ``min_interval``/``max_interval``) or as soon as the DNS view
+    requests it. The database is only written when an answer changes: the
+    new answers go to DNSDomainState, a DNSAnswerHistory row is added per
+    changed lookup, DNSRecord verification flags are refreshed and drift
+    events are logged and sent through ``dns_drift_detected``.
+    """
+
+    def __init__(self, engine=None, min_interval=None, max_interval=None):
+        # A private cache so entries expire exactly when the domain is due again
+        self.engine = engine or DNSVerificationEngine(cache=DNSCache())
+        self.min_interval = min_interval or getattr(settings, 'DNS_MONITOR_MIN_INTERVAL', 60)
+        self.max_interval = max_interval or getattr(settings, 'DNS_MONITOR_MAX_INTERVAL', 3600)
+        self._next_check = {}
+
+    def tracked_domains(self):
+        """Domain -> DKIM selectors for every domain with stored DNSRecords"""
+        domains = {domain: set() for domain in DNSRecord.objects.values_list('domain', flat=True).distinct()}
+        for record in DNSRecord.objects.filter(record_type='DKIM').only('domain', 'record_type', 'value'):
+            selector = dkim_selector(record)
+            if selector:
+                domains.setdefault(record.domain, set()).add(selector)
+        return {domain: sorted(selectors) for domain, selectors in domains.items()}
+
+    def min_ttl(self, report):
+        ttls = [result.ttl for result in report.lookups.values() if result.ok and result.answers and result.ttl]
+        return min(ttls) if ttls else self.max_interval
+
+    def interval_for(self, report):
+        return max(self.min_interval, min(self.min_ttl(report), self.max_interval))
+
+    def run_once(self):
+        """Check every due domain; returns the number of domains checked"""
+        now = time.monotonic()
+        tracked = self.tracked_domains()
+        requested = set(
+            DNSDomainState.objects.filter(refresh_requested=True).values_list('domain', flat=True)
+        )
+        due = [d for d in tracked if d in requested or self._next_check.get(d, 0) <= now]
+        if not due:
+            return 0
+
+        reports = self.engine.verify_domains(due, {d: tracked[d] for d in due})
+        states = DNSDomainState.objects.in_bulk(due, field_name='domain')
+        for domain in due:
+            report = reports[domain]
+            self.apply(domain, report, states.get(domain), requested=domain in requested)
+            self._next_check[domain] = now + self.interval_for(report)
+
+        for domain in list(self._next_check):
+            if domain not in tracked:
+                del self._next_check[domain]
+        return len(due)
+
+    def apply(self, domain, report, state, requested=False):
+        """Persist a domain's report if anything changed; returns the drift events"""
+        answers = snapshot(report)
+        previous = state.answers if state is not None else {}
+        # Lookups that failed this round keep their last known answers
+        merged = dict(previous)
+        merged.update(answers)
+        changed_keys = [key for key in sorted(answers) if state is None or previous.get(key) != answers[key]]
+
+        if not changed_keys:
+            if requested:
+                DNSDomainState.objects.filter(pk=state.pk).update(refresh_requested=False)
+            # Records added since the last change still need a verdict
+            self._update_records(domain, report, DNSRecord.objects.filter(domain=domain, last_verified__isnull=True))
+            return []
+
+        events = []
+        history = []
+        for key in changed_keys:
+            drift = detect_drift(key, previous.get(key, []), answers[key]) if state is not None else []
+            history.append(DNSAnswerHistory(domain=domain, lookup=key, answers=answers[key], drift=drift))
+            events.extend(dict(event, domain=domain) for event in drift)
+
+        with transaction.atomic():
+            DNSDomainState.objects.update_or_create(domain=domain, defaults={
+                'answers': merged,
+                'summary': report.summary(),
+                'min_ttl': self.min_ttl(report),
+                'last_changed': timezone.now(),
+                'refresh_requested': False,
+            })
+            DNSAnswerHistory.objects.bulk_create(history)
+            self._update_records(domain, report, DNSRecord.objects.filter(domain=domain))
+
+        if events:
+            logger.warning("DNS drift for %s: %s", domain, events)
+            dns_drift_detected.send(sender=self.__class__, domain=domain, events=events)
+        return events
+
+    def _update_records(self, domain, report, records):
+        if not report.ok:
+            # A failed lookup says nothing about whether a record is published
+            return
+        now = timezone.now()
+        changed = []
+        for record in records:
+            verified = record_matches(record, report)
+            if verified != record.verified or record.last_verified is None:
+                record.verified = verified
+                record.last_verified = now
+                changed.append(record)
+        DNSRecord.objects.bulk_update(changed, ['verified', 'last_verified'], batch_size=500)
+
+    def run_forever(self, poll_interval=5.0, stop_event=None):
+        """Keep checking due domains until ``stop_event`` is set"""
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("DNS monitor pass failed")
+            stop_event.wait(poll_interval)
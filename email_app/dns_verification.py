@@ -0,0 +1,307 @@
+# email_app/dns_verification.py
+import asyncio
+import re
+import threading
+import time
+
+import dns.asyncresolver
+import dns.exception
+import dns.resolver
+from django.conf import settings
+
+from .metrics import DNS_LOOKUP_SECONDS, DNS_VERIFICATION_SECONDS
+
+
+class LookupResult:
+    """Outcome of one DNS query"""
+
+    def __init__(self, name, rdtype, answers=None, ttl=0, error=None, latency_ms=0.0, cached=False,
+                 nxdomain=False):
+        self.name = name
+        self.rdtype = rdtype
+        self.answers = answers or []
+        self.ttl = ttl
+        self.error = error
+        self.latency_ms = latency_ms
+        self.cached = cached
+        self.nxdomain = nxdomain  # The name does not exist, as opposed to having no records of this type
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return f"<LookupResult {self.rdtype} {self.name} answers={len(self.answers)} error={self.error!r}>"
+
+
+class DNSCache:
+    """
+    Thread-safe in-process cache of lookup results that honours record TTLs.
+
+    Negative answers (NXDOMAIN, no records) are cached for ``negative_ttl``
+    seconds; resolver failures such as timeouts are never cached.
+    """
+
+    def __init__(self, max_entries=10000, negative_ttl=60):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, rdtype):
+        key = (name.lower(), rdtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, result, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Drop the entry closest to expiry to make room
+                oldest = min(self._entries, key=lambda k: self._entries[k][0])
+                del self._entries[oldest]
+            self._entries[(result.name.lower(), result.rdtype)] = (time.monotonic() + ttl, result)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_default_cache = DNSCache()
+
+# DNSRecord.value formats written by the dns_management view
+MX_VALUE_RE = re.compile(r'^Priority:\s*(\d+),\s*Server:\s*(\S+?)\.?$')
+DKIM_VALUE_RE = re.compile(r'^Selector:\s*([^,\s]+),\s*Value:\s*(.*?)(?:\.\.\.)?$', re.DOTALL)
+
+
+def _parse_rdata(rdtype, rdata):
+    if rdtype == 'MX':
+        return (rdata.preference, str(rdata.exchange).rstrip('.'))
+    if rdtype == 'TXT':
+        return b''.join(rdata.strings).decode('utf-8', 'replace')
+    return rdata.to_text()
+
+
+class DomainReport:
+    """Parsed MX/SPF/DMARC/DKIM state for one domain"""
+
+    def __init__(self, domain):
+        self.domain = domain
+        self.lookups = {}
+
+    @property
+    def mx(self):
+        result = self.lookups.get('MX')
+        return sorted(result.answers) if result else []
+
+    def _txt_with_prefix(self, key, prefix):
+        result = self.lookups.get(key)
+        if result is None:
+            return None
+        for txt in result.answers:
+            if txt.startswith(prefix):
+                return txt
+        return None
+
+    @property
+    def spf(self):
+        return self._txt_with_prefix('TXT', 'v=spf1')
+
+    @property
+    def dmarc(self):
+        return self._txt_with_prefix('DMARC', 'v=DMARC1')
+
+    @property
+    def dkim(self):
+        """Selector -> DKIM TXT value, or None when the selector has no record"""
+        records = {}
+        for key, result in self.lookups.items():
+            if key.startswith('DKIM:'):
+                records[key.split(':', 1)[1]] = result.answers[0] if result.answers else None
+        return records
+
+    @property
+    def ok(self):
+        return all(result.ok for result in self.lookups.values())
+
+    def summary(self):
+        """Human readable lines in the format DNSManager has always reported"""
+        lines = []
+        mx = self.lookups.get('MX')
+        if mx is not None:
+            if mx.ok:
+                lines.append(f"Found {len(mx.answers)} MX records for {self.domain} ({mx.latency_ms:.0f} ms)")
+                lines.extend(f"Priority: {pref}, Server: {server}" for pref, server in self.mx)
+            else:
+                lines.append(f"Error checking MX records: {mx.error}")
+
+        txt = self.lookups.get('TXT')
+        if txt is not None:
+            if self.spf:
+                lines.append(f"Found SPF record: {self.spf}")
+            elif txt.ok:
+                lines.append("No SPF record found")
+            else:
+                lines.append(f"Error checking SPF records: {txt.error}")
+
+        dmarc = self.lookups.get('DMARC')
+        if dmarc is not None:
+            lines.append(f"Found DMARC record: {self.dmarc}" if self.dmarc else "No DMARC record found")
+
+        for selector, value in self.dkim.items():
+            if value:
+                lines.append(f"Found DKIM record for selector {selector}")
+            else:
+                lines.append(f"No DKIM record found for selector {selector}")
+        return lines
+
+
+class DNSVerificationEngine:
+    """
+    Resolve MX, SPF, DMARC and DKIM records for many domains concurrently.
+
+    Lookups run on dnspython's asyncio resolver (or any object with a
+    compatible ``async resolve(qname, rdtype)``), are capped at
+    ``concurrency`` in flight and are served from a TTL-respecting cache when
+    possible.
+    """
+
+    def __init__(self, resolver=None, cache=None, concurrency=None, lifetime=None):
+        self._resolver = resolver
+        self.cache = cache if cache is not None else _default_cache
+        self.concurrency = concurrency or getattr(settings, 'DNS_VERIFICATION_CONCURRENCY', 50)
+        self.lifetime = lifetime or getattr(settings, 'DNS_VERIFICATION_TIMEOUT', 5)
+
+    @property
+    def resolver(self):
+        if self._resolver is None:
+            self._resolver = dns.asyncresolver.Resolver()
+            self._resolver.lifetime = self.lifetime
+        return self._resolver
+
+    async def lookup(self, name, rdtype, semaphore=None):
+        cached = self.cache.get(name, rdtype)
+        if cached is not None:
+            DNS_LOOKUP_SECONDS.observe(0.0, rdtype=rdtype, outcome='cached')
+            return LookupResult(
+                cached.name, cached.rdtype, cached.answers, cached.ttl,
+                cached.error, latency_ms=0.0, cached=True, nxdomain=cached.nxdomain
+            )
+
+        start = time.perf_counter()
+        try:
+            if semaphore is not None:
+                async with semaphore:
+                    answer = await self.resolver.resolve(name, rdtype)
+            else:
+                answer = await self.resolver.resolve(name, rdtype)
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+            DNS_LOOKUP_SECONDS.observe(time.perf_counter() - start, rdtype=rdtype, outcome='negative')
+            result = LookupResult(name, rdtype, [], latency_ms=(time.perf_counter() - start) * 1000,
+                                  nxdomain=isinstance(e, dns.resolver.NXDOMAIN))
+            self.cache.set(result, self.cache.negative_ttl)
+            return result
+        except (dns.exception.DNSException, OSError) as e:
+            DNS_LOOKUP_SECONDS.observe(time.perf_counter() - start, rdtype=rdtype, outcome='error')
+            return LookupResult(name, rdtype, error=str(e) or e.__class__.__name__,
+                                latency_ms=(time.perf_counter() - start) * 1000)
+        DNS_LOOKUP_SECONDS.observe(time.perf_counter() - start, rdtype=rdtype, outcome='answer')
+
+        ttl = answer.rrset.ttl if answer.rrset is not None else 0
+        result = LookupResult(
+            name,
+            rdtype,
+            [_parse_rdata(rdtype, rdata) for rdata in answer],
+            ttl=ttl,
+            latency_ms=(time.perf_counter() - start) * 1000
+        )
+        self.cache.set(result, ttl)
+        return result
+
+    def _queries(self, domain, dkim_selectors):
+        yield 'MX', domain, 'MX'
+        yield 'TXT', domain, 'TXT'
+        yield 'DMARC', f'_dmarc.{domain}', 'TXT'
+        for selector in dkim_selectors:
+            yield f'DKIM:{selector}', f'{selector}._domainkey.{domain}', 'TXT'
+
+    async def verify_domains_async(self, domains, dkim_selectors=None):
+        """
+        Verify every domain at once. ``dkim_selectors`` maps a domain to the
+        selectors to check, or is a single iterable used for every domain.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        reports = {}
+        tasks = []
+        for domain in dict.fromkeys(domains):
+            if isinstance(dkim_selectors, dict):
+                selectors = dkim_selectors.get(domain, ())
+            else:
+                selectors = dkim_selectors or ()
+            report = reports[domain] = DomainReport(domain)
+            for key, name, rdtype in self._queries(domain, selectors):
+                tasks.append((report, key, self.lookup(name, rdtype, semaphore)))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(coro for _, _, coro in tasks))
+        DNS_VERIFICATION_SECONDS.observe(time.perf_counter() - start)
+        for (report, key, _), result in zip(tasks, results):
+            report.lookups[key] = result
+        return reports
+
+    def verify_domains(self, domains, dkim_selectors=None):
+        """Blocking wrapper around ``verify_domains_async`` for sync callers"""
+        return asyncio.run(self.verify_domains_async(domains, dkim_selectors))
+
+    async def mx_records_async(self, domains):
+        """``{domain: LookupResult}`` with one MX lookup per distinct domain"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        domains = list(dict.fromkeys(domains))
+        results = await asyncio.gather(*(self.lookup(domain, 'MX', semaphore) for domain in domains))
+        return dict(zip(domains, results))
+
+    def mx_records(self, domains):
+        """Blocking wrapper around ``mx_records_async`` for sync callers"""
+        return asyncio.run(self.mx_records_async(domains))
+
+
+def dkim_selector(record):
+    """Selector of a stored DKIM DNSRecord, or None for other record types"""
+    if record.record_type != 'DKIM':
+        return None
+    match = DKIM_VALUE_RE.match(record.value)
+    return match.group(1) if match else None
+
+
+def record_matches(record, report):
+    """Whether a stored DNSRecord is actually published according to ``report``"""
+    if record.record_type == 'MX':
+        match = MX_VALUE_RE.match(record.value.strip())
+        if not match:
+            return False
+        expected = (int(match.group(1)), match.group(2).lower())
+        return any((pref, server.lower()) == expected for pref, server in report.mx)
+
+    if record.record_type == 'SPF':
+        expected = ' '.join(record.value.split())
+        txt = report.lookups.get('TXT')
+        return bool(txt) and any(' '.join(answer.split()) == expected for answer in txt.answers)
+
+    if record.record_type == 'DKIM':
+        match = DKIM_VALUE_RE.match(record.value.strip())
+        if not match:
+            return False
+        published = report.dkim.get(match.group(1))
+        return bool(published) and published.startswith(match.group(2))
+
+    return False
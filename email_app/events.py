@@ -0,0 +1,309 @@
+# email_app/events.py
+import atexit
+import datetime
+import json
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import EmailEvent, EmailMessage, EmailRecipient, SuppressedAddress
+from .reconciler import apply_delivery_reports
+
+logger = logging.getLogger(__name__)
+
+DELIVERY_REPORT = 'Microsoft.Communication.EmailDeliveryReportReceived'
+ENGAGEMENT_REPORT = 'Microsoft.Communication.EmailEngagementTrackingReportReceived'
+SUBSCRIPTION_VALIDATION = 'Microsoft.EventGrid.SubscriptionValidationEvent'
+
+# Delivery statuses after which an address is never mailed again
+HARD_BOUNCE_STATUSES = {'Bounced', 'Suppressed'}
+
+# Rows per existence check and bulk_create, well under SQLite's parameter limit
+WRITE_CHUNK_SIZE = 500
+
+# Errors caused by the events rather than the database being unavailable
+BAD_EVENT_ERRORS = (DataError, IntegrityError, TypeError, ValueError)
+
+
+class InvalidEvents(ValueError):
+    """Raised for a webhook body that is not a batch of Event Grid or CloudEvents events"""
+
+
+def _timestamp(value):
+    """An aware datetime; Event Grid times are UTC, so one without an offset is read as UTC"""
+    try:
+        parsed = parse_datetime(value) if isinstance(value, str) else None
+    except ValueError:
+        return None
+    if parsed is not None and timezone.is_naive(parsed):
+        # Mixed naive and aware times cannot be compared when a batch is sorted
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+def _string(data, key, max_length=None):
+    """``data[key]`` when it is a string that fits its column, or None when it is missing"""
+    value = data.get(key)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise InvalidEvents(f'{key} must be a string')
+    if max_length is not None and len(value) > max_length:
+        raise InvalidEvents(f'{key} is longer than {max_length} characters')
+    return value
+
+
+def _field_length(name):
+    return EmailEvent._meta.get_field(name).max_length
+
+
+def parse_events(body):
+    """
+    ``(validation_code, events)`` for a webhook body: a JSON array of Event
+    Grid events or CloudEvents, or a single CloudEvent.
+
+    ``validation_code`` is set for an Event Grid subscription handshake.
+    ``events`` are unsaved EmailEvent rows for the delivery and engagement
+    reports; other event types routed to the same endpoint are skipped. Only
+    the fields that are stored are looked at, so a batch costs one
+    ``json.loads`` and a pass over it. Those fields must be strings that fit
+    their columns; a batch with one that is not raises InvalidEvents.
+    """
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise InvalidEvents('Invalid JSON')
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list):
+        raise InvalidEvents('Expected an array of events')
+
+    events = []
+    for event in payload:
+        if not isinstance(event, dict):
+            raise InvalidEvents('Expected an array of events')
+        event_id = event.get('id')
+        event_type = event.get('eventType') or event.get('type')
+        data = event.get('data')
+        if not event_id or not event_type or not isinstance(data, dict):
+            raise InvalidEvents('Every event needs an id, a type and a data object')
+
+        if event_type == SUBSCRIPTION_VALIDATION:
+            return data.get('validationCode'), []
+        if event_type == DELIVERY_REPORT:
+            status = _string(data, 'status', _field_length('status'))
+            details = data.get('deliveryStatusDetails') or {}
+            if not isinstance(details, dict):
+                raise InvalidEvents('deliveryStatusDetails must be an object')
+            detail = _string(details, 'statusMessage')
+            occurred_at = data.get('deliveryAttemptTimeStamp')
+        elif event_type == ENGAGEMENT_REPORT:
+            status = _string(data, 'engagementType', _field_length('status'))
+            detail = _string(data, 'engagementContext')
+            occurred_at = data.get('userActionTimeStamp')
+        else:
+            continue
+
+        recipient = _string(data, 'recipient')
+        if recipient is not None:
+            recipient = EmailRecipient.normalize(recipient)
+            if len(recipient) > _field_length('recipient'):
+                raise InvalidEvents(f"recipient is longer than {_field_length('recipient')} characters")
+        events.append(EmailEvent(
+            event_id=str(event_id)[:_field_length('event_id')],
+            event_type=event_type,
+            provider_message_id=_string(data, 'messageId', _field_length('provider_message_id')),
+            recipient=recipient,
+            status=status,
+            detail=detail,
+            occurred_at=_timestamp(occurred_at or event.get('eventTime') or event.get('time')),
+        ))
+    return None, events
+
+
+def write_events(events):
+    """
+    Store events not seen before and apply their delivery reports; returns
+    how many were new. Each chunk costs one query for known event ids, one
+    for the messages they refer to and one ``bulk_create``, plus the bulk
+    updates of ``reconciler.apply_delivery_reports``. Hard-bounced
+    recipients are added to the suppression list.
+    """
+    written = 0
+    for start in range(0, len(events), WRITE_CHUNK_SIZE):
+        chunk = events[start:start + WRITE_CHUNK_SIZE]
+        seen = set(
+            EmailEvent.objects.filter(event_id__in=[event.event_id for event in chunk])
+            .values_list('event_id', flat=True)
+        )
+        new = [event for event in chunk if event.event_id not in seen]
+        if not new:
+            continue
+        message_ids = dict(
+            EmailMessage.objects
+            .filter(provider_message_id__in={event.provider_message_id for event in new if event.provider_message_id})
+            .values_list('provider_message_id', 'pk')
+        )
+        for event in new:
+            event.message_id = message_ids.get(event.provider_message_id)
+        # Reports can arrive out of order; apply them oldest first
+        new.sort(key=lambda event: (event.occurred_at is not None, event.occurred_at))
+        with transaction.atomic():
+            # ignore_conflicts covers another worker storing the same event meanwhile
+            EmailEvent.objects.bulk_create(new, ignore_conflicts=True)
+            apply_delivery_reports([
+                (event.provider_message_id, event.recipient, event.status, event.detail)
+                for event in new
+                if event.event_type == DELIVERY_REPORT and event.message_id is not None
+            ])
+            SuppressedAddress.suppress(
+                {
+                    event.recipient for event in new
+                    if event.event_type == DELIVERY_REPORT and event.status in HARD_BOUNCE_STATUSES
+                    and event.recipient
+                },
+                reason='BOUNCE'
+            )
+        written += len(new)
+    return written
+
+
+class EventBuffer:
+    """
+    Collect webhook events in memory and write them in batches.
+
+    The buffer is flushed by the request that fills it to ``max_size`` events
+    and otherwise by a background thread every ``flush_interval`` seconds, so
+    a webhook request normally only parses and appends. Events with the same
+    id collapse in the buffer and are skipped at write time if already
+    stored, so provider redeliveries are harmless. Events still buffered when
+    a worker is killed are lost; the provider only redelivers batches that
+    were not acknowledged, so set EMAIL_EVENT_BUFFER_SIZE to 1 where every
+    event must be written before the response.
+    """
+
+    def __init__(self, max_size=None, flush_interval=None):
+        self.max_size = max_size or getattr(settings, 'EMAIL_EVENT_BUFFER_SIZE', 500)
+        self.flush_interval = flush_interval or getattr(settings, 'EMAIL_EVENT_FLUSH_INTERVAL', 1.0)
+        self.written = 0
+        self._events = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, events):
+        """Buffer ``events``, flushing in this thread when the buffer is full"""
+        with self._lock:
+            for event in events:
+                self._events.setdefault(event.event_id, event)
+            full = len(self._events) >= self.max_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='email-events', daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+        return len(events)
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of new events"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = list(self._events.values()), {}
+            if not events:
+                return 0
+            try:
+                written = write_events(events)
+            except BAD_EVENT_ERRORS:
+                # One event the database refuses must not hold back the others
+                written = self._write_each(events)
+            except Exception:
+                self._requeue(events)
+                raise
+            self.written += written
+            return written
+
+    def _requeue(self, events):
+        # Kept for the next flush; ids already written are skipped then
+        with self._lock:
+            for event in events:
+                self._events.setdefault(event.event_id, event)
+
+    def _write_each(self, events):
+        """Write ``events`` one at a time, dropping (and logging) the ones that cannot be stored"""
+        written = 0
+        for index, event in enumerate(events):
+            try:
+                written += write_events([event])
+            except BAD_EVENT_ERRORS:
+                logger.exception("Dropping email event %s that cannot be stored", event.event_id)
+            except Exception:
+                self.written += written
+                self._requeue(events[index:])
+                raise
+        return written
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            if not self._events:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing email events failed")
+            finally:
+                close_old_connections()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_event_buffer():
+    """Return the process-wide EventBuffer configured from settings"""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = EventBuffer()
+        return _buffer
+
+
+def reset_event_buffer():
+    """Flush and drop the process-wide buffer"""
+    global _buffer
+    with _buffer_lock:
+        buffer, _buffer = _buffer, None
+    if buffer is not None:
+        buffer.close()
+
+
+def _flush_at_exit():
+    if _buffer is not None:
+        try:
+            _buffer.close()
+        except Exception:
+            logger.exception("Flushing email events at exit failed")
+
+
+def _forget_buffer_after_fork():
+    # The parent's events and flush thread stay with the parent
+    global _buffer, _buffer_lock
+    _buffer_lock = threading.Lock()
+    _buffer = None
+
+
+atexit.register(_flush_at_exit)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_buffer_after_fork)
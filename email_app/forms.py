@@ -1,61 +1,208 @@
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, JsonResponse
+from django.utils.crypto import constant_time_compare
+from django.contrib.auth.views import redirect_to_login
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from urllib.parse import urlencode
 from .forms import EmailForm, MXRecordForm, SPFRecordForm, DKIMRecordForm
-from .models import EmailMessage, DNSRecord
-from .services import AzureEmailService, DNSManager
-from django.utils import timezone
+from .models import EmailMessage, DNSRecord, DNSDomainState
+from .services import DNSManager
+from .async_services import AsyncAzureEmailService, close_async_clients
+from .registry import connection_stats
+from .dashboard import dashboard_stats, record_outcomes
+from .metrics import metrics_response
+from .events import InvalidEvents, get_event_buffer, parse_events
+from .sso import InvalidToken, validate_token
+from .recipients import parse_recipients
+from .dns_verification import DNSVerificationEngine
+from .history import MAX_PAGE_SIZE, PAGE_SIZE, InvalidCursor, history_page, history_queryset
 
 @login_required
 def index(request):
-    recent_emails = EmailMessage.objects.filter(created_by=request.user).order_by('-sent_at')[:10]
+    recent_emails = history_queryset(request.user)[:10]
     return render(request, 'email_app/index.html', {
-        'recent_emails': recent_emails
+        'recent_emails': recent_emails,
+        'stats': dashboard_stats(request.user),
     })
 
+def _history_filters(request):
+    return {
+        name: request.GET[name].strip()
+        for name in ('status', 'sender', 'recipient')
+        if request.GET.get(name, '').strip()
+    }
+
+@login_required
+def email_history(request):
+    filters = _history_filters(request)
+    try:
+        emails, next_cursor = history_page(history_queryset(request.user, **filters), request.GET.get('cursor'))
+    except InvalidCursor:
+        # A stale or hand-edited link; start again from the newest message
+        emails, next_cursor = history_page(history_queryset(request.user, **filters))
+    
+    return render(request, 'email_app/history.html', {
+        'emails': emails,
+        'filters': filters,
+        'status_choices': EmailMessage.STATUS_CHOICES,
+        'next_query': urlencode({**filters, 'cursor': next_cursor}) if next_cursor else None,
+    })
+
+@login_required
+def email_history_api(request):
+    """JSON history for the current user, paged with the opaque ``next_cursor``"""
+    try:
+        limit = min(max(int(request.GET.get('limit', PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': 'limit must be an integer'}, status=400)
+    
+    try:
+        emails, next_cursor = history_page(
+            history_queryset(request.user, **_history_filters(request)),
+            request.GET.get('cursor'),
+            limit
+        )
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    return JsonResponse({
+        'results': [
+            {
+                'id': email.pk,
+                'sender': email.sender,
+                'recipients': email.recipient_list(),
+                'subject': email.subject,
+                'sent_at': email.sent_at.isoformat(),
+                'status': email.status,
+            }
+            for email in emails
+        ],
+        'next_cursor': next_cursor,
+    })
+
+def _clean_recipients(form):
+    """
+    Parse, validate and dedupe the form's recipients; returns the
+    RecipientList, or None after adding the error to the form. With
+    EMAIL_RECIPIENT_MX_CHECK on, domains that cannot receive mail are
+    rejected too, with one MX lookup per domain.
+    """
+    try:
+        recipients = parse_recipients(form.cleaned_data['recipients']).require_valid()
+        if getattr(settings, 'EMAIL_RECIPIENT_MX_CHECK', False):
+            undeliverable = recipients.undeliverable_domains(DNSVerificationEngine())
+            if undeliverable:
+                raise ValidationError(f"These domains do not accept email: {', '.join(undeliverable)}")
+    except ValidationError as e:
+        form.add_error('recipients', e)
+        return None
+    return recipients
+
 @login_required
 def send_email(request):
     if request.method == 'POST':
         form = EmailForm(request.POST)
-        if form.is_valid():
+        recipients = _clean_recipients(form) if form.is_valid() else None
+        if recipients is not None:
             email = form.save(commit=False)
+            email.recipients = recipients.as_field()
             email.created_by = request.user
             
-            # Process recipients
-            recipients = email.recipients.split(',')
+            # Hand the message to the outbox worker instead of sending inline;
+            # see email_app/outbox.py and the send_queued_emails command
+            email.status = 'QUEUED'
+            email.use_direct_api = bool(request.POST.get('use_direct_api', False))
+            with transaction.atomic():
+                email.save()
+                email.save_recipients()
             
-            # Send email
-            email_service = AzureEmailService()
+            messages.success(request, 'Email queued for delivery')
             
-            # Choose between SMTP and direct API
-            use_direct_api = request.POST.get('use_direct_api', False)
+            return redirect('index')
+    else:
+        form = EmailForm()
+    
+    return render(request, 'email_app/send_email.html', {
+        'form': form
+    })
+
+def _save_sent(email, suppressed, outcomes):
+    """Save a sent email with its recipient rows and stats in one transaction"""
+    with transaction.atomic():
+        email.save()
+        email.save_recipients(suppressed)
+        record_outcomes(outcomes)
+
+async def send_email_async(request):
+    """
+    ASGI variant of send_email that delivers inline without blocking a thread.
+    
+    Under uvicorn a single worker can keep many of these sends in flight, so
+    there is no need to go through the outbox queue.
+    """
+    # login_required cannot wrap coroutines on Django 4.2
+    user = await sync_to_async(lambda: request.user if request.user.is_authenticated else None)()
+    if user is None:
+        return redirect_to_login(request.get_full_path())
+    
+    if request.method == 'POST':
+        form = EmailForm(request.POST)
+        recipients = await sync_to_async(_clean_recipients)(form) if form.is_valid() else None
+        if recipients is not None:
+            email = form.save(commit=False)
+            email.recipients = recipients.as_field()
+            email.created_by = user
+            recipients = recipients.addresses
             
-            if use_direct_api:
-                success, message = email_service.send_email_direct_api(
-                    email.sender,
-                    recipients,
-                    email.subject,
-                    email.body,
-                    email.html_body
-                )
-            else:
-                success, message = email_service.send_email(
-                    email.sender,
-                    recipients,
-                    email.subject,
-                    email.body,
-                    email.html_body
-                )
+            email_service = AsyncAzureEmailService()
+            email.use_direct_api = bool(request.POST.get('use_direct_api', False))
+            
+            try:
+                if email.use_direct_api:
+                    result = await email_service.send_email_direct_api(
+                        email.sender,
+                        recipients,
+                        email.subject,
+                        email.body,
+                        email.html_body
+                    )
+                else:
+                    result = await email_service.send_email(
+                        email.sender,
+                        recipients,
+                        email.subject,
+                        email.body,
+                        email.html_body
+                    )
+            finally:
+                if not isinstance(request, ASGIRequest):
+                    # Under WSGI the view runs through async_to_sync on a new
+                    # event loop per request; its client and pool die with it
+                    await close_async_clients()
             
             # Update and save email record
-            email.status = 'SENT' if success else 'FAILED'
-            email.error_message = None if success else message
-            email.save()
+            email.status = result.status
+            email.error_message = None if result.success else result.detail
+            email.attempts = 1
+            for field, value in EmailMessage.result_fields(result).items():
+                setattr(email, field, value)
+            await sync_to_async(_save_sent)(
+                email, result.suppressed, [(user.pk, email.sent_at, recipients, None, email.status)]
+            )
             
-            if success:
+            if result.success:
                 messages.success(request, 'Email sent successfully!')
             else:
-                messages.error(request, f'Failed to send email: {message}')
+                messages.error(request, f'Failed to send email: {result.detail}')
             
             return redirect('index')
     else:
@@ -65,6 +212,77 @@ def send_email(request):
         'form': form
     })
 
+@staff_member_required
+def service_stats(request):
+    """Connection reuse counters for the email service in this worker process"""
+    return JsonResponse(connection_stats())
+
+def metrics(request):
+    """
+    Prometheus scrape endpoint. Requires 'Authorization: Bearer
+    <EMAIL_METRICS_TOKEN>'; without a configured token only staff users
+    are served.
+    """
+    token = getattr(settings, 'EMAIL_METRICS_TOKEN', None)
+    if token:
+        allowed = constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}')
+    else:
+        allowed = request.user.is_authenticated and request.user.is_staff
+    if not allowed:
+        return HttpResponseForbidden('Forbidden')
+    return metrics_response()
+
+@csrf_exempt
+@require_http_methods(['OPTIONS', 'POST'])
+def email_events(request):
+    """
+    Event Grid webhook for ACS email delivery and engagement reports.
+
+    The subscription URL carries EMAIL_WEBHOOK_SECRET as ``?token=``; without
+    a configured secret every request is refused. Accepts the Event Grid
+    schema (with its validation handshake) and CloudEvents (validated
+    through OPTIONS). Events are buffered and written in batches, see
+    ``events.EventBuffer``.
+    """
+    secret = getattr(settings, 'EMAIL_WEBHOOK_SECRET', None)
+    token = request.GET.get('token') or request.headers.get('X-Webhook-Token', '')
+    if not secret or not constant_time_compare(token, secret):
+        return HttpResponseForbidden('Forbidden')
+    
+    if request.method == 'OPTIONS':
+        response = HttpResponse()
+        response['WebHook-Allowed-Origin'] = request.headers.get('WebHook-Request-Origin', '*')
+        return response
+    
+    try:
+        validation_code, events = parse_events(request.body)
+    except InvalidEvents as e:
+        return HttpResponseBadRequest(str(e))
+    if validation_code is not None:
+        return JsonResponse({'validationResponse': validation_code})
+    return JsonResponse({'received': get_event_buffer().add(events)})
+
+@csrf_exempt
+@require_http_methods(['POST'])
+def roundcube_sso_validate(request):
+    """
+    Called by RoundCube's SSO plugin with the ``token`` it was handed; answers
+    with the email and redirect the token was issued for, once.
+
+    The plugin authenticates with ROUNDCUBE_SSO_VALIDATION_SECRET in the
+    X-SSO-Secret header; without a configured secret every request is
+    refused.
+    """
+    secret = getattr(settings, 'ROUNDCUBE_SSO_VALIDATION_SECRET', None)
+    if not secret or not constant_time_compare(request.headers.get('X-SSO-Secret', ''), secret):
+        return HttpResponseForbidden('Forbidden')
+    
+    try:
+        claims = validate_token(request.POST.get('token', ''))
+    except InvalidToken as e:
+        return JsonResponse({'valid': False, 'error': str(e)}, status=403)
+    return JsonResponse({'valid': True, 'email': claims.email, 'redirect': claims.redirect_to})
+
 @login_required
 def dns_management(request):
     dns_manager = DNSManager()
@@ -137,34 +355,24 @@ def dns_management(request):
     else:
         dkim_form = DKIMRecordForm()
     
-    # Handle DNS verification
+    # Handle DNS verification. The monitor_dns command does the lookups;
+    # the view only asks it to re-check this domain on its next pass.
     if request.method == 'POST' and 'verify_dns' in request.POST:
-        success, results = dns_manager.verify_dns_records()
-        
-        if success:
-            # Update verification status of records
-            dns_records = DNSRecord.objects.filter(domain=dns_manager.domain)
-            for record in dns_records:
-                record.verified = True
-                record.last_verified = timezone.now()
-                record.save()
-            
-            messages.success(request, 'DNS verification completed')
-        else:
-            messages.error(request, 'DNS verification failed')
-        
-        return render(request, 'email_app/dns_management.html', {
-            'mx_form': mx_form,
-            'spf_form': spf_form,
-            'dkim_form': dkim_form,
-            'verification_results': results,
-            'dns_records': DNSRecord.objects.filter(domain=dns_manager.domain).order_by('-created_at')
-        })
+        DNSDomainState.objects.update_or_create(
+            domain=dns_manager.domain,
+            defaults={'refresh_requested': True}
+        )
+        messages.success(request, 'DNS re-check requested')
+        return redirect('dns_management')
+    
+    state = DNSDomainState.objects.filter(domain=dns_manager.domain).first()
     
     return render(request, 'email_app/dns_management.html', {
         'mx_form': mx_form,
         'spf_form': spf_form,
         'dkim_form': dkim_form,
+        'verification_results': state.summary if state else None,
+        'dns_state': state,
         'dns_records': DNSRecord.objects.filter(domain=dns_manager.domain).order_by('-created_at')
     })
 
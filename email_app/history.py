@@ -0,0 +1,64 @@
+# email_app/history.py
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+from .models import EmailMessage, EmailRecipient
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Columns shown in history listings; body and html_body are never loaded
+LIST_FIELDS = ('id', 'sender', 'recipients', 'subject', 'sent_at', 'status')
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor cannot be decoded"""
+
+
+def encode_cursor(email):
+    """Opaque cursor pointing just past ``email`` in newest-first order"""
+    raw = f"{email.sent_at.isoformat()}|{email.pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """``(sent_at, id)`` for a cursor produced by ``encode_cursor``"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        sent_at, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(sent_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+
+
+def history_queryset(user, status=None, sender=None, recipient=None):
+    """A user's messages newest first, optionally filtered, without the bodies"""
+    queryset = EmailMessage.objects.filter(created_by=user).only(*LIST_FIELDS)
+    if status:
+        queryset = queryset.filter(status=status)
+    if sender:
+        queryset = queryset.filter(sender=sender)
+    if recipient:
+        queryset = queryset.filter(recipient_rows__address=EmailRecipient.normalize(recipient))
+    return queryset.order_by('-sent_at', '-id')
+
+
+def history_page(queryset, cursor=None, limit=PAGE_SIZE):
+    """
+    One page of ``queryset`` (ordered by ``-sent_at, -id``) and the cursor of
+    the next page, or None on the last page.
+
+    Pages are found with a keyset condition on ``(sent_at, id)`` rather than
+    OFFSET, so page 10,000 costs the same index seek as page 1.
+    """
+    if cursor:
+        sent_at, pk = decode_cursor(cursor)
+        # The redundant ``sent_at <= x`` bound lets the database seek the
+        # (created_by, sent_at) index instead of scanning it for the OR
+        queryset = queryset.filter(Q(sent_at__lt=sent_at) | Q(id__lt=pk), sent_at__lte=sent_at)
+    # One extra row tells whether another page exists without a COUNT
+    rows = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,36 @@
+# email_app/management/commands/monitor_dns.py
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from email_app.dns_monitor import DNSMonitor
+
+
+class Command(BaseCommand):
+    help = 'Re-verify every domain with stored DNS records on a TTL-driven schedule and record drift'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-interval', type=int, help='Shortest time in seconds between checks of one domain')
+        parser.add_argument('--max-interval', type=int, help='Longest time in seconds between checks of one domain')
+        parser.add_argument('--poll-interval', type=float, default=5.0, help='Seconds between scheduling passes')
+        parser.add_argument('--once', action='store_true', help='Check every domain once and exit')
+
+    def handle(self, *args, **options):
+        monitor = DNSMonitor(
+            min_interval=options['min_interval'],
+            max_interval=options['max_interval'],
+        )
+
+        if options['once']:
+            checked = monitor.run_once()
+            self.stdout.write(self.style.SUCCESS(f'Checked {checked} domains'))
+            return
+
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop_event.set())
+
+        self.stdout.write('DNS monitor started')
+        monitor.run_forever(poll_interval=options['poll_interval'], stop_event=stop_event)
+        self.stdout.write('DNS monitor stopped')
@@ -0,0 +1,21 @@
+# email_app/management/commands/rebuild_dashboard_stats.py
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from email_app.dashboard import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the per-user daily rollups behind the index page from the stored messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, help='Only rebuild this many recent days instead of all history')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days']:
+            since = timezone.localdate() - timedelta(days=options['days'] - 1)
+        written = rebuild_rollups(since=since)
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written} rollup rows'))
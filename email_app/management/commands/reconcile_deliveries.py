@@ -0,0 +1,40 @@
+# email_app/management/commands/reconcile_deliveries.py
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from email_app.reconciler import DeliveryReconciler
+
+
+class Command(BaseCommand):
+    help = 'Poll direct API sends that are still ACCEPTED and record whether they were sent or failed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages polled per pass')
+        parser.add_argument('--concurrency', type=int, help='Send operations polled at once')
+        parser.add_argument('--poll-interval', type=float, help='Seconds between polls of one operation')
+        parser.add_argument('--once', action='store_true', help='Poll one batch and exit')
+
+    def handle(self, *args, **options):
+        reconciler = DeliveryReconciler(
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+        )
+
+        if options['once']:
+            try:
+                checked = reconciler.run_once()
+            finally:
+                reconciler.close()
+            self.stdout.write(self.style.SUCCESS(f'Checked {checked} messages'))
+            return
+
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop_event.set())
+
+        self.stdout.write('Delivery reconciler started')
+        reconciler.run_forever(stop_event=stop_event)
+        self.stdout.write('Delivery reconciler stopped')
@@ -0,0 +1,137 @@
+# email_app/management/commands/send_campaign.py
+import csv
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from email_app.dashboard import record_outcomes
+from email_app.models import EmailMessage, EmailRecipient, EmailTemplate
+from email_app.recipients import RecipientList
+from email_app.registry import get_email_service
+from email_app.templating import CompiledEmailTemplate, get_compiled_template
+
+
+class Command(BaseCommand):
+    help = (
+        'Send one personalised email per recipient through the direct API. '
+        'Subject and bodies come from a stored EmailTemplate or are given '
+        'inline, and are rendered with each CSV row or user as context.'
+    )
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--csv', help='CSV file with an "email" column plus merge fields')
+        source.add_argument('--all-users', action='store_true', help='Send to every active user with an email address')
+        parser.add_argument('--sender', required=True)
+        parser.add_argument('--template', help='Name of a stored EmailTemplate; replaces the inline options below')
+        parser.add_argument('--subject')
+        parser.add_argument('--body')
+        parser.add_argument('--html-body')
+        parser.add_argument('--created-by', required=True, help='Username recorded as the author of the sent messages')
+        parser.add_argument('--concurrency', type=int, help='Direct API sends kept in flight')
+        parser.add_argument('--record-batch-size', type=int, default=500, help='EmailMessage rows written per insert')
+
+    def csv_rows(self, path):
+        with open(path, newline='', encoding='utf-8') as f:
+            reader = csv.DictReader(f)
+            if 'email' not in (reader.fieldnames or []):
+                raise CommandError(f'{path} has no "email" column')
+            for row in reader:
+                if row['email']:
+                    yield row
+
+    def user_rows(self):
+        users = (
+            User.objects.filter(is_active=True)
+            .exclude(email='')
+            .only('email', 'username', 'first_name', 'last_name')
+            .iterator(chunk_size=2000)
+        )
+        for user in users:
+            yield {
+                'email': user.email,
+                'username': user.username,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+            }
+
+    def save_records(self, records):
+        # bulk_create sets the primary keys the recipient rows point at
+        with transaction.atomic():
+            EmailMessage.objects.bulk_create(records)
+            EmailRecipient.objects.bulk_create(
+                [row for record in records for row in EmailRecipient.rows_for(record)]
+            )
+            record_outcomes(
+                (record.created_by_id, record.sent_at, record.recipients.split(','), None, record.status)
+                for record in records
+            )
+
+    def handle(self, *args, **options):
+        try:
+            created_by = User.objects.get(username=options['created_by'])
+        except User.DoesNotExist:
+            raise CommandError(f"User {options['created_by']} does not exist")
+
+        # Compile once, render per recipient
+        if options['template']:
+            try:
+                template = EmailTemplate.objects.get(name=options['template'])
+            except EmailTemplate.DoesNotExist:
+                raise CommandError(f"Email template {options['template']} does not exist")
+            compiled = get_compiled_template(template)
+        elif options['subject'] and options['body']:
+            compiled = CompiledEmailTemplate(options['subject'], options['body'], options['html_body'])
+        else:
+            raise CommandError('Give either --template or both --subject and --body')
+
+        rows = self.csv_rows(options['csv']) if options['csv'] else self.user_rows()
+        recipients = RecipientList()
+
+        def valid_rows():
+            # One message per distinct valid address; the rest are counted and skipped
+            for row in rows:
+                address = recipients.add(row['email'])
+                if address is not None:
+                    yield dict(row, email=address)
+
+        def messages():
+            for row, rendered in compiled.render_batch(valid_rows()):
+                yield dict(rendered, sender=options['sender'], recipients=[row['email']])
+
+        service = get_email_service()
+        records = []
+        sent = failed = 0
+
+        for message, result in service.send_bulk(messages(), concurrency=options['concurrency']):
+            if result.success:
+                sent += 1
+            else:
+                failed += 1
+            records.append(EmailMessage(
+                sender=message['sender'],
+                recipients=','.join(message['recipients']),
+                subject=message['subject'],
+                body=message['body'],
+                html_body=message['html_body'],
+                status=result.status,
+                error_message=None if result.success else result.detail,
+                use_direct_api=True,
+                attempts=1,
+                created_by=created_by,
+                **EmailMessage.result_fields(result),
+            ))
+            if len(records) >= options['record_batch_size']:
+                self.save_records(records)
+                records = []
+                self.stdout.write(f'{sent + failed} processed ({failed} failed)')
+
+        if records:
+            self.save_records(records)
+
+        if recipients.invalid or recipients.duplicates:
+            self.stdout.write(self.style.WARNING(
+                f'Skipped {len(recipients.invalid)} invalid and {recipients.duplicates} duplicate addresses'
+            ))
+        self.stdout.write(self.style.SUCCESS(f'Campaign finished: {sent} sent, {failed} failed'))
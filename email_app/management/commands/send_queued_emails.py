@@ -0,0 +1,46 @@
+# email_app/management/commands/send_queued_emails.py
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from email_app.outbox import OutboxWorker
+
+
+class Command(BaseCommand):
+    help = 'Deliver queued emails in the background, separately from the web workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help='Messages claimed per round trip')
+        parser.add_argument('--concurrency', type=int, help='Messages sent in parallel')
+        parser.add_argument('--lease-seconds', type=int, help='How long a claimed message stays locked')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--once', action='store_true', help='Drain the queue once and exit')
+
+    def handle(self, *args, **options):
+        worker = OutboxWorker(
+            batch_size=options['batch_size'],
+            concurrency=options['concurrency'],
+            lease_seconds=options['lease_seconds'],
+        )
+
+        if options['once']:
+            total = 0
+            try:
+                while True:
+                    processed = worker.run_once()
+                    if not processed:
+                        break
+                    total += processed
+            finally:
+                worker.close()
+            self.stdout.write(self.style.SUCCESS(f'Processed {total} queued emails'))
+            return
+
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop_event.set())
+
+        self.stdout.write(f'Outbox worker {worker.worker_id} started')
+        worker.run_forever(poll_interval=options['poll_interval'], stop_event=stop_event)
+        self.stdout.write(f'Outbox worker {worker.worker_id} stopped')
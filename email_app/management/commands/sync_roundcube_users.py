@@ -0,0 +1,33 @@
+# email_app/management/commands/sync_roundcube_users.py
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from email_app.roundcube_sync import RoundCubeUserSync
+
+
+class Command(BaseCommand):
+    help = 'Provision, rename and remove RoundCube accounts for Django users changed since the last sync'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, help='Users read and written per batch')
+        parser.add_argument('--interval', type=float, help='Seconds between incremental syncs')
+        parser.add_argument('--full', action='store_true', help='Compare every user instead of the changed ones, then exit')
+        parser.add_argument('--once', action='store_true', help='Sync once and exit')
+
+    def handle(self, *args, **options):
+        sync = RoundCubeUserSync(chunk_size=options['chunk_size'])
+
+        if options['once'] or options['full']:
+            stats = sync.run(full=options['full'])
+            self.stdout.write(self.style.SUCCESS(f'Synchronized RoundCube users: {stats}'))
+            return
+
+        stop_event = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: stop_event.set())
+
+        self.stdout.write('RoundCube user sync started')
+        sync.run_forever(interval=options['interval'], stop_event=stop_event)
+        self.stdout.write('RoundCube user sync stopped')
@@ -0,0 +1,443 @@
+# email_app/metrics.py
+import atexit
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+
+# Upper bounds of the default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric:
+    """
+    A family of samples, one per combination of label values.
+
+    Updates are a dict lookup and an add under the metric's own lock, so the
+    hot path never does I/O; see ``MetricsRegistry`` for how processes share.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    @staticmethod
+    def merge(into, value):
+        return (into or 0) + value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+    @staticmethod
+    def merge(into, value):
+        if into is None:
+            return [list(value[0]), value[1], value[2]]
+        return [[a + b for a, b in zip(into[0], value[0])], into[1] + value[1], into[2] + value[2]]
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running, under another user
+        return True
+    except OSError:
+        return False
+    return True
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """
+    The process's metrics plus, when ``directory`` is set, every other
+    worker's.
+
+    Each process aggregates in memory and, at most every ``flush_interval``
+    seconds (checked on update), writes its totals to
+    ``<directory>/<pid>.json``. A scrape served by any gunicorn worker merges
+    its live values with the files of all the other running workers, so the
+    endpoint reports the whole server. A worker's file is removed when it
+    exits, and files left by workers that died without exiting cleanly are
+    removed by the next scrape, so the directory does not grow with every
+    restart; Prometheus treats the drop in the totals as a counter reset.
+    """
+
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.metrics = {}
+        self._last_flush = time.monotonic()
+        self._flush_lock = threading.Lock()
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def _path(self, pid):
+        return os.path.join(self.directory, f'{pid}.json')
+
+    def mark_process_dead(self, pid):
+        """Remove ``pid``'s file, as at exit or when a new process reuses the pid"""
+        if not self.directory:
+            return
+        try:
+            os.remove(self._path(pid))
+        except FileNotFoundError:
+            pass
+
+    def maybe_flush(self):
+        """Write this process's totals if the flush interval has passed; cheap otherwise"""
+        if self.directory and time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self.directory:
+            return
+        with self._flush_lock:
+            self._last_flush = time.monotonic()
+            data = {
+                name: [[list(key), value] for key, value in metric.snapshot().items()]
+                for name, metric in self.metrics.items()
+            }
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(os.getpid())
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+
+    def collect(self):
+        """``{name: {label values: value}}`` merged over this process and every flushed one"""
+        merged = {name: metric.snapshot() for name, metric in self.metrics.items()}
+        if not self.directory or not os.path.isdir(self.directory):
+            return merged
+
+        own = f'{os.getpid()}.json'
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            pid = filename[:-len('.json')]
+            if not pid.isdigit():
+                continue
+            if not _pid_alive(int(pid)):
+                self.mark_process_dead(pid)
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                # A worker is mid-write or the file is gone; skip it this scrape
+                continue
+            for name, samples in data.items():
+                metric = self.metrics.get(name)
+                if metric is None:
+                    continue
+                values = merged[name]
+                for key, value in samples:
+                    key = tuple(key)
+                    values[key] = metric.merge(values.get(key), value)
+        return merged
+
+    def exposition(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key in sorted(values):
+                value = values[key]
+                if metric.kind == 'counter':
+                    lines.append(f'{name}{_labels(metric.labelnames, key)} {_number(value)}')
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip([*metric.buckets, float('inf')], counts):
+                    cumulative += bucket_count
+                    le = (('le', _number(bound)),)
+                    lines.append(f'{name}_bucket{_labels(metric.labelnames, key, le)} {cumulative}')
+                lines.append(f'{name}_sum{_labels(metric.labelnames, key)} {_number(total)}')
+                lines.append(f'{name}_count{_labels(metric.labelnames, key)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        for metric in self.metrics.values():
+            metric.reset()
+
+
+registry = MetricsRegistry(
+    directory=getattr(settings, 'EMAIL_METRICS_DIR', None),
+    flush_interval=getattr(settings, 'EMAIL_METRICS_FLUSH_INTERVAL', 5),
+)
+
+SENDS = registry.counter(
+    'email_sends_total', 'Messages handed to a transport, by outcome.',
+    ('transport', 'outcome', 'error_class'),
+)
+SUPPRESSED_RECIPIENTS = registry.counter(
+    'email_suppressed_recipients_total', 'Recipients dropped from sends by the suppression list.',
+)
+DELIVERY_REPORTS = registry.counter(
+    'email_delivery_reports_total', 'Delivery reports received, by provider status.',
+    ('status',),
+)
+SSO_VALIDATIONS = registry.counter(
+    'roundcube_sso_validations_total', 'RoundCube SSO tokens checked, by outcome.',
+    ('outcome',),
+)
+SEND_PHASE_SECONDS = registry.histogram(
+    'email_send_phase_seconds',
+    'Time per send phase: connect, tls, auth, submit, poll (direct API) and total.',
+    ('transport', 'phase'),
+)
+DNS_LOOKUP_SECONDS = registry.histogram(
+    'email_dns_lookup_seconds', 'DNS query latency by record type and outcome.',
+    ('rdtype', 'outcome'),
+)
+DNS_VERIFICATION_SECONDS = registry.histogram(
+    'email_dns_verification_seconds', 'Time to verify a batch of domains.',
+)
+HTTP_REQUEST_SECONDS = registry.histogram(
+    'email_http_request_seconds', 'View handler latency by route, method and status.',
+    ('view', 'method', 'status'),
+)
+
+
+def record_send(result):
+    """Count a ``results.SendResult`` and observe its phase timings"""
+    transport = result.transport or 'unknown'
+    SENDS.inc(
+        transport=transport,
+        outcome=result.status.lower(),
+        error_class=result.error_class or '',
+    )
+    timings = result.timings
+    for phase in type(timings).__slots__:
+        seconds = getattr(timings, phase)
+        if seconds is not None:
+            SEND_PHASE_SECONDS.observe(seconds, transport=transport, phase=phase)
+    registry.maybe_flush()
+
+
+def metrics_response():
+    registry.flush()
+    return HttpResponse(registry.exposition(), content_type=CONTENT_TYPE)
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for one thread: a background thread records the
+    target's stack every ``interval`` seconds. ``collapsed()`` returns the
+    samples in the folded-stack format flame graph tools read.
+    """
+
+    def __init__(self, thread_id=None, interval=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval or getattr(settings, 'EMAIL_PROFILER_INTERVAL', 0.005)
+        self.samples = StackCounter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.samples[self._stack(frame)] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self):
+        return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common()) + '\n'
+
+
+def _profile_requested(request):
+    """Profiling is opt-in twice: EMAIL_PROFILER_ENABLED, then ``?profile`` from a staff user"""
+    return getattr(settings, 'EMAIL_PROFILER_ENABLED', False) and 'profile' in request.GET
+
+
+def _is_staff(request):
+    user = getattr(request, 'user', None)
+    return bool(user is not None and user.is_staff)
+
+
+def _profile_response(profiler, elapsed):
+    header = f'# {sum(profiler.samples.values())} samples over {elapsed * 1000:.1f} ms\n'
+    return HttpResponse(header + profiler.collapsed(), content_type='text/plain; charset=utf-8')
+
+
+class MetricsMiddleware:
+    """
+    Time every view into email_http_request_seconds and, when asked for,
+    profile the request and return the collapsed stacks instead of the page.
+    Works for both the sync views and send_email_async.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _record(self, request, response, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        HTTP_REQUEST_SECONDS.observe(
+            elapsed,
+            view=match.view_name if match is not None else 'unmatched',
+            method=request.method,
+            status=response.status_code,
+        )
+        registry.maybe_flush()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        wanted = _profile_requested(request) and _is_staff(request)
+        profiler = SamplingProfiler().start() if wanted else None
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        elapsed = time.perf_counter() - started
+        self._record(request, response, elapsed)
+        return _profile_response(profiler, elapsed) if profiler is not None else response
+
+    async def __acall__(self, request):
+        # request.user is a lazy database lookup, so it is only touched off the loop
+        wanted = _profile_requested(request) and await sync_to_async(_is_staff)(request)
+        profiler = SamplingProfiler().start() if wanted else None
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if profiler is not None:
+                profiler.stop()
+        elapsed = time.perf_counter() - started
+        self._record(request, response, elapsed)
+        return _profile_response(profiler, elapsed) if profiler is not None else response
+
+
+def _exit():
+    registry.mark_process_dead(os.getpid())
+
+
+def _forget_metrics_after_fork():
+    # A preloaded master's counts belong to the master, not to every worker
+    registry.mark_process_dead(os.getpid())
+    registry.reset()
+    registry._flush_lock = threading.Lock()
+    for metric in registry.metrics.values():
+        metric._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_metrics_after_fork)
+
+# A file already under this pid was left by a process that died without exiting
+registry.mark_process_dead(os.getpid())
+atexit.register(_exit)
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:26
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DNSRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=255)),
+                ('record_type', models.CharField(choices=[('MX', 'MX Record'), ('SPF', 'SPF Record'), ('DKIM', 'DKIM Record')], max_length=10)),
+                ('value', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('verified', models.BooleanField(default=False)),
+                ('last_verified', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EmailMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sender', models.EmailField(max_length=254)),
+                ('recipients', models.TextField()),
+                ('subject', models.CharField(max_length=255)),
+                ('body', models.TextField()),
+                ('html_body', models.TextField(blank=True, null=True)),
+                ('sent_at', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(max_length=50)),
+                ('error_message', models.TextField(blank=True, null=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
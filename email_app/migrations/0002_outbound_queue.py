@@ -0,0 +1,47 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='locked_by',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='use_direct_api',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='emailmessage',
+            name='status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='QUEUED', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='email_queue_due_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0002_outbound_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DNSDomainState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=255, unique=True)),
+                ('answers', models.JSONField(default=dict)),
+                ('summary', models.JSONField(default=list)),
+                ('min_ttl', models.PositiveIntegerField(default=300)),
+                ('last_changed', models.DateTimeField(blank=True, null=True)),
+                ('refresh_requested', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DNSAnswerHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('domain', models.CharField(max_length=255)),
+                ('lookup', models.CharField(max_length=100)),
+                ('answers', models.JSONField(default=list)),
+                ('drift', models.JSONField(default=list)),
+                ('resolved_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['domain', 'resolved_at'], name='dns_history_domain_idx')],
+            },
+        ),
+    ]
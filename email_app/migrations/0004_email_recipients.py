@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0003_dns_monitor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.EmailField(max_length=254)),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('SENT', 'Sent'), ('FAILED', 'Failed')], default='QUEUED', max_length=50)),
+                ('error_message', models.TextField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['created_by', 'sent_at'], name='email_user_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['status', 'sent_at'], name='email_status_sent_idx'),
+        ),
+        migrations.AddField(
+            model_name='emailrecipient',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipient_rows', to='email_app.emailmessage'),
+        ),
+        migrations.AddIndex(
+            model_name='emailrecipient',
+            index=models.Index(fields=['address', 'message'], name='email_recipient_address_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='emailrecipient',
+            constraint=models.UniqueConstraint(fields=('message', 'address'), name='email_recipient_unique'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+import re
+
+from django.db import migrations
+
+BATCH_SIZE = 2000
+
+# A frozen copy of EmailRecipient.normalize (recipients.normalize_address),
+# so rows written here match the ones the app writes and looks up, and later
+# changes to the app's validation cannot change what this migration does
+_LOCAL_PART = re.compile(r"[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+(?:\.[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+)*\Z")
+_DOMAIN_LABEL = re.compile(r'(?!-)[a-z0-9-]{1,63}(?<!-)\Z')
+
+MAX_ADDRESS_LENGTH = 254
+MAX_LOCAL_PART_LENGTH = 64
+
+
+def normalize_domain(domain):
+    try:
+        ascii_domain = domain.encode('idna').decode('ascii').lower()
+    except UnicodeError:
+        return None
+    labels = ascii_domain.split('.')
+    if len(ascii_domain) > 253 or len(labels) < 2:
+        return None
+    if not (labels[-1].isalpha() or labels[-1].startswith('xn--')):
+        return None
+    if not all(_DOMAIN_LABEL.match(label) for label in labels):
+        return None
+    return ascii_domain
+
+
+def normalize_address(address):
+    local, at, domain = address.strip().rpartition('@')
+    if not at or not local or len(local) > MAX_LOCAL_PART_LENGTH or not _LOCAL_PART.match(local):
+        return None
+    domain = normalize_domain(domain)
+    if domain is None or len(local) + len(domain) + 1 > MAX_ADDRESS_LENGTH:
+        return None
+    return f'{local}@{domain}'
+
+
+def normalize(address):
+    return normalize_address(address) or address.strip()
+
+
+def split_recipients(apps, schema_editor):
+    """Create one EmailRecipient row per address of every existing EmailMessage"""
+    EmailMessage = apps.get_model('email_app', 'EmailMessage')
+    EmailRecipient = apps.get_model('email_app', 'EmailRecipient')
+
+    rows = []
+    messages = (
+        EmailMessage.objects.order_by('pk')
+        .values_list('pk', 'recipients', 'status', 'error_message')
+        .iterator(chunk_size=BATCH_SIZE)
+    )
+    for pk, recipients, status, error_message in messages:
+        # Legacy junk longer than EmailRecipient.address cannot be stored (and
+        # fails the insert on PostgreSQL); it stays in EmailMessage.recipients
+        addresses = dict.fromkeys(
+            address for address in (normalize(r) for r in recipients.split(',') if r.strip())
+            if len(address) <= MAX_ADDRESS_LENGTH
+        )
+        rows.extend(
+            EmailRecipient(message_id=pk, address=address, status=status, error_message=error_message)
+            for address in addresses
+        )
+        if len(rows) >= BATCH_SIZE:
+            EmailRecipient.objects.bulk_create(rows, ignore_conflicts=True)
+            rows = []
+    if rows:
+        EmailRecipient.objects.bulk_create(rows, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0004_email_recipients'),
+    ]
+
+    operations = [
+        migrations.RunPython(split_recipients, migrations.RunPython.noop),
+    ]
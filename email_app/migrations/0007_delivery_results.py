@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0006_email_template'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='auth_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='connect_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='provider_message_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='submit_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='tls_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='total_ms',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailmessage',
+            name='transport',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0007_delivery_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailmessage',
+            name='continuation_token',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='emailmessage',
+            name='status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('ACCEPTED', 'Accepted'), ('SENT', 'Sent'), ('DELIVERED', 'Delivered'), ('FAILED', 'Failed')], default='QUEUED', max_length=50),
+        ),
+        migrations.AlterField(
+            model_name='emailrecipient',
+            name='status',
+            field=models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('ACCEPTED', 'Accepted'), ('SENT', 'Sent'), ('DELIVERED', 'Delivered'), ('FAILED', 'Failed')], default='QUEUED', max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='emailmessage',
+            index=models.Index(fields=['provider_message_id'], name='email_provider_id_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0008_async_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=100, unique=True)),
+                ('event_type', models.CharField(max_length=100)),
+                ('provider_message_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('recipient', models.EmailField(blank=True, max_length=254, null=True)),
+                ('status', models.CharField(blank=True, max_length=50, null=True)),
+                ('detail', models.TextField(blank=True, null=True)),
+                ('occurred_at', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='events', to='email_app.emailmessage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['message', 'occurred_at'], name='email_event_message_idx')],
+            },
+        ),
+    ]
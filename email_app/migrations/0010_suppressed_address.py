@@ -0,0 +1,26 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0009_email_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SuppressedAddress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address', models.EmailField(max_length=254, unique=True)),
+                ('reason', models.CharField(choices=[('BOUNCE', 'Hard bounce'), ('COMPLAINT', 'Spam complaint'), ('UNSUBSCRIBE', 'Unsubscribed'), ('MANUAL', 'Added manually')], default='MANUAL', max_length=20)),
+                ('detail', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'suppressed addresses',
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:30
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0010_suppressed_address'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoundCubeAccount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField(unique=True)),
+                ('rc_user_id', models.IntegerField(blank=True, null=True)),
+                ('username', models.CharField(blank=True, max_length=128, null=True)),
+                ('name', models.CharField(blank=True, default='', max_length=255)),
+                ('changed_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('synced_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RoundCubeSyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=50, unique=True)),
+                ('high_water', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:37
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('email_app', '0011_roundcube_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailDomainDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('domain', models.CharField(max_length=253)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EmailDailyStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('status', models.CharField(choices=[('QUEUED', 'Queued'), ('SENDING', 'Sending'), ('ACCEPTED', 'Accepted'), ('SENT', 'Sent'), ('DELIVERED', 'Delivered'), ('FAILED', 'Failed')], max_length=50)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='emaildomaindailystat',
+            constraint=models.UniqueConstraint(fields=('user', 'day', 'domain'), name='email_domain_stat_unique'),
+        ),
+        migrations.AddConstraint(
+            model_name='emaildailystat',
+            constraint=models.UniqueConstraint(fields=('user', 'day', 'status'), name='email_daily_stat_unique'),
+        ),
+    ]
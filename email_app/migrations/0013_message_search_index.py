@@ -0,0 +1,111 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+# Kept in step with email_app/search.py
+FTS_TABLE = 'email_app_emailmessage_fts'
+SEARCH_VECTOR_COLUMN = 'search_vector'
+SEARCH_VECTOR_FUNCTION = 'email_app_emailmessage_search_vector'
+
+# SQLite drops triggers with their table, and Django rebuilds the table for
+# most column changes: a later migration altering EmailMessage on SQLite
+# has to create the triggers again (and 'rebuild' the index).
+# search.has_search_index refuses to search while they are missing.
+SQLITE_FORWARD = [
+    f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+        subject, sender, recipients, body,
+        content='email_app_emailmessage', content_rowid='id'
+    )""",
+    f"""CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON email_app_emailmessage BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, subject, sender, recipients, body)
+        VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+    END""",
+    f"""CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON email_app_emailmessage BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, subject, sender, recipients, body)
+        VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+    END""",
+    # Status and bookkeeping updates, the common kind, leave the index alone
+    f"""CREATE TRIGGER {FTS_TABLE}_update AFTER UPDATE OF subject, sender, recipients, body
+        ON email_app_emailmessage BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, subject, sender, recipients, body)
+        VALUES ('delete', old.id, old.subject, old.sender, old.recipients, old.body);
+        INSERT INTO {FTS_TABLE} (rowid, subject, sender, recipients, body)
+        VALUES (new.id, new.subject, new.sender, new.recipients, new.body);
+    END""",
+    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_update',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_delete',
+    f'DROP TRIGGER IF EXISTS {FTS_TABLE}_insert',
+    f'DROP TABLE IF EXISTS {FTS_TABLE}',
+]
+
+POSTGRESQL_FORWARD = [
+    # Nullable with no default, so adding it only touches the catalog; a
+    # generated column would rewrite the whole table under ACCESS EXCLUSIVE.
+    # Existing rows are filled in batches and indexed concurrently by 0014.
+    f'ALTER TABLE email_app_emailmessage ADD COLUMN {SEARCH_VECTOR_COLUMN} tsvector',
+    # Subject and addresses rank above the body
+    f"""CREATE FUNCTION {SEARCH_VECTOR_FUNCTION}(subject text, sender text, recipients text, body text)
+        RETURNS tsvector LANGUAGE sql IMMUTABLE AS $$
+        SELECT setweight(to_tsvector('simple', coalesce(subject, '')), 'A')
+            || setweight(to_tsvector('simple', coalesce(sender, '') || ' ' || coalesce(recipients, '')), 'B')
+            || setweight(to_tsvector('simple', coalesce(body, '')), 'C')
+    $$""",
+    f"""CREATE FUNCTION {SEARCH_VECTOR_FUNCTION}_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.{SEARCH_VECTOR_COLUMN} := {SEARCH_VECTOR_FUNCTION}(NEW.subject, NEW.sender, NEW.recipients, NEW.body);
+        RETURN NEW;
+    END
+    $$""",
+    # Status and bookkeeping updates, the common kind, skip it
+    f"""CREATE TRIGGER {SEARCH_VECTOR_FUNCTION}
+        BEFORE INSERT OR UPDATE OF subject, sender, recipients, body ON email_app_emailmessage
+        FOR EACH ROW EXECUTE FUNCTION {SEARCH_VECTOR_FUNCTION}_trigger()""",
+]
+
+POSTGRESQL_REVERSE = [
+    f'DROP TRIGGER IF EXISTS {SEARCH_VECTOR_FUNCTION} ON email_app_emailmessage',
+    f'DROP FUNCTION IF EXISTS {SEARCH_VECTOR_FUNCTION}_trigger()',
+    f'DROP FUNCTION IF EXISTS {SEARCH_VECTOR_FUNCTION}(text, text, text, text)',
+    f'ALTER TABLE email_app_emailmessage DROP COLUMN IF EXISTS {SEARCH_VECTOR_COLUMN}',
+]
+
+
+def _run(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def create_search_index(apps, schema_editor):
+    """Full-text index over subject, sender, recipients and body, where the database has one"""
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRESQL_FORWARD)
+    elif vendor == 'sqlite':
+        try:
+            _run(schema_editor, SQLITE_FORWARD[:1])
+        except OperationalError:
+            # SQLite built without FTS5; the admin falls back to LIKE searches
+            return
+        _run(schema_editor, SQLITE_FORWARD[1:])
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _run(schema_editor, POSTGRESQL_REVERSE)
+    elif vendor == 'sqlite':
+        _run(schema_editor, SQLITE_REVERSE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0012_dashboard_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,53 @@
+from django.db import migrations
+
+SEARCH_VECTOR_COLUMN = 'search_vector'
+SEARCH_VECTOR_FUNCTION = 'email_app_emailmessage_search_vector'
+SEARCH_INDEX = 'email_message_search_idx'
+
+# Rows per UPDATE; each batch commits on its own, so row locks stay short
+BATCH_SIZE = 5000
+
+
+def backfill_search_vector(apps, schema_editor):
+    """Fill the search vector of rows written before 0013 added its trigger, in id ranges"""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT MAX(id) FROM email_app_emailmessage')
+        last_id = cursor.fetchone()[0] or 0
+        for start in range(0, last_id, BATCH_SIZE):
+            cursor.execute(
+                f'UPDATE email_app_emailmessage '
+                f'SET {SEARCH_VECTOR_COLUMN} = {SEARCH_VECTOR_FUNCTION}(subject, sender, recipients, body) '
+                f'WHERE id > %s AND id <= %s AND {SEARCH_VECTOR_COLUMN} IS NULL',
+                [start, start + BATCH_SIZE]
+            )
+
+
+def create_index(apps, schema_editor):
+    # CONCURRENTLY keeps the table writable while the GIN index builds
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {SEARCH_INDEX} '
+            f'ON email_app_emailmessage USING gin ({SEARCH_VECTOR_COLUMN})'
+        )
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {SEARCH_INDEX}')
+
+
+class Migration(migrations.Migration):
+    # Batches commit as they go and CREATE INDEX CONCURRENTLY cannot run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('email_app', '0013_message_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_search_vector, migrations.RunPython.noop),
+        migrations.RunPython(create_index, drop_index),
+    ]
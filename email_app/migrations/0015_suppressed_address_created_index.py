@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-17 12:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('email_app', '0014_message_search_backfill'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='suppressedaddress',
+            index=models.Index(fields=['created_at'], name='email_suppressed_created_idx'),
+        ),
+    ]
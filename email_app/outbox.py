@@ -0,0 +1,213 @@
+# email_app/outbox.py
+import os
+import random
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .dashboard import record_outcomes
+from .models import EmailMessage, EmailRecipient
+from .registry import get_email_service
+from .results import SendResult
+from .transports import get_transport_router
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    base = getattr(settings, 'EMAIL_QUEUE_RETRY_BACKOFF', 30)
+    cap = getattr(settings, 'EMAIL_QUEUE_RETRY_BACKOFF_MAX', 3600)
+    delay = min(cap, base * (2 ** max(attempts - 1, 0)))
+    return random.uniform(delay / 2, delay)
+
+
+class OutboxWorker:
+    """
+    Deliver queued EmailMessage rows in the background.
+
+    Each worker claims a batch of due messages, sends them concurrently and
+    records the outcome. On databases that support it the claim uses
+    ``SELECT ... FOR UPDATE SKIP LOCKED``; elsewhere (SQLite) it relies on a
+    conditional UPDATE of the ``locked_by``/``locked_until`` lease columns.
+    A lease that expires (e.g. the worker crashed mid-send) makes the message
+    claimable again.
+
+    With EMAIL_TRANSPORTS configured, messages go through the TransportRouter
+    and its load balancing and failover; ``use_direct_api`` only applies to
+    the single-transport setup.
+    """
+
+    def __init__(self, worker_id=None, batch_size=None, concurrency=None,
+                 lease_seconds=None, max_attempts=None, service=None, router=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size or getattr(settings, 'EMAIL_QUEUE_BATCH_SIZE', 50)
+        self.concurrency = concurrency or getattr(settings, 'EMAIL_QUEUE_CONCURRENCY', 8)
+        self.lease_seconds = lease_seconds or getattr(settings, 'EMAIL_QUEUE_LEASE_SECONDS', 300)
+        self.max_attempts = max_attempts or getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', 5)
+        self._service = service
+        self._router = router
+        self._executor = None
+
+    @property
+    def service(self):
+        if self._service is None:
+            self._service = get_email_service()
+        return self._service
+
+    @property
+    def router(self):
+        if self._router is None:
+            self._router = get_transport_router()
+        return self._router
+
+    def due_messages(self, now):
+        """Queued messages ready for an attempt, plus ones whose lease has expired"""
+        return EmailMessage.objects.filter(
+            Q(status='QUEUED', next_attempt_at__isnull=True)
+            | Q(status='QUEUED', next_attempt_at__lte=now)
+            | Q(status='SENDING', locked_until__lt=now)
+        )
+
+    def claim_batch(self):
+        """Lease up to ``batch_size`` due messages to this worker and return them"""
+        now = timezone.now()
+        lease_until = now + timedelta(seconds=self.lease_seconds)
+        claim = {
+            'status': 'SENDING',
+            'locked_by': self.worker_id,
+            'locked_until': lease_until,
+            'attempts': F('attempts') + 1,
+        }
+
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                ids = list(
+                    self.due_messages(now)
+                    .select_for_update(skip_locked=True)
+                    .order_by('sent_at')
+                    .values_list('id', flat=True)[:self.batch_size]
+                )
+                EmailMessage.objects.filter(id__in=ids).update(**claim)
+        else:
+            ids = list(
+                self.due_messages(now)
+                .order_by('sent_at')
+                .values_list('id', flat=True)[:self.batch_size]
+            )
+            # Re-checking the due condition makes the UPDATE a compare-and-set,
+            # so a concurrent worker that got there first wins the row
+            self.due_messages(now).filter(id__in=ids).update(**claim)
+
+        return list(EmailMessage.objects.filter(
+            id__in=ids,
+            locked_by=self.worker_id,
+            locked_until=lease_until
+        ))
+
+    def deliver(self, email):
+        """Send a single claimed message; returns ``(email, result)`` with a ``results.SendResult``"""
+        try:
+            recipients = email.recipient_list()
+            if self.router is not None:
+                result = self.router.send(
+                    email.sender,
+                    recipients,
+                    email.subject,
+                    email.body,
+                    email.html_body
+                )
+            elif email.use_direct_api:
+                result = self.service.send_email_direct_api(
+                    email.sender,
+                    recipients,
+                    email.subject,
+                    email.body,
+                    email.html_body
+                )
+            else:
+                result = self.service.send_email(
+                    email.sender,
+                    recipients,
+                    email.subject,
+                    email.body,
+                    email.html_body
+                )
+            return email, result
+        except Exception as e:
+            return email, SendResult.failed(e, f"Failed to send email: {str(e)}")
+
+    def record_result(self, email, result):
+        """
+        Store the outcome, rescheduling failed sends until attempts run out.
+        Errors that no retry can fix (see ``results.is_permanent_error``) fail
+        the message straight away.
+        """
+        if result.success:
+            # SENT, or ACCEPTED for the reconciler to settle
+            fields = {'status': result.status, 'error_message': None}
+        elif not result.retryable or email.attempts >= self.max_attempts:
+            fields = {'status': 'FAILED', 'error_message': result.detail}
+        else:
+            fields = {
+                'status': 'QUEUED',
+                'error_message': result.detail,
+                'next_attempt_at': timezone.now() + timedelta(seconds=retry_delay(email.attempts)),
+            }
+        with transaction.atomic():
+            updated = EmailMessage.objects.filter(pk=email.pk, locked_by=self.worker_id).update(
+                locked_by=None,
+                locked_until=None,
+                **fields,
+                **EmailMessage.result_fields(result)
+            )
+            if updated:
+                EmailRecipient.objects.filter(message_id=email.pk).update(
+                    status=fields['status'],
+                    error_message=fields['error_message']
+                )
+                if result.success:
+                    EmailRecipient.mark_suppressed(email.pk, result.suppressed)
+        if updated:
+            email.status = fields['status']
+        return updated
+
+    def run_once(self):
+        """Claim and deliver one batch; returns the number of messages processed"""
+        batch = self.claim_batch()
+        if not batch:
+            return 0
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency,
+                thread_name_prefix='outbox'
+            )
+        recorded = []
+        for email, result in self._executor.map(self.deliver, batch):
+            if self.record_result(email, result):
+                recorded.append(email)
+        # One rollup update for the batch; retries and ACCEPTED sends are skipped there
+        record_outcomes(
+            (email.created_by_id, email.sent_at, email.recipient_list(), 'SENDING', email.status)
+            for email in recorded
+        )
+        return len(batch)
+
+    def run_forever(self, poll_interval=1.0, stop_event=None):
+        """Keep draining the queue, sleeping ``poll_interval`` seconds when it is empty"""
+        stop_event = stop_event or threading.Event()
+        try:
+            while not stop_event.is_set():
+                if not self.run_once():
+                    stop_event.wait(poll_interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
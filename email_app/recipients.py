@@ -0,0 +1,185 @@
+# email_app/recipients.py
+import re
+from collections import defaultdict
+from functools import lru_cache
+
+from django.core.exceptions import ValidationError
+
+# Separators accepted between addresses in a recipients string
+_SEPARATORS = re.compile(r'[,;\s]+')
+
+# Dot-atom local part, as django.core.validators.EmailValidator accepts it
+_LOCAL_PART = re.compile(r"[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+(?:\.[-!#$%&'*+/=?^_`{}|~0-9A-Za-z]+)*\Z")
+_DOMAIN_LABEL = re.compile(r'(?!-)[a-z0-9-]{1,63}(?<!-)\Z')
+
+MAX_ADDRESS_LENGTH = 254
+MAX_LOCAL_PART_LENGTH = 64
+
+
+@lru_cache(maxsize=65536)
+def normalize_domain(domain):
+    """
+    The lowercased, IDNA-encoded form of ``domain``, or None when it is not a
+    valid mail domain. Cached: recipient lists repeat a handful of domains.
+    """
+    try:
+        ascii_domain = domain.encode('idna').decode('ascii').lower()
+    except UnicodeError:
+        return None
+    labels = ascii_domain.split('.')
+    if len(ascii_domain) > 253 or len(labels) < 2:
+        return None
+    # Top-level domains are alphabetic, or IDNA-encoded
+    if not (labels[-1].isalpha() or labels[-1].startswith('xn--')):
+        return None
+    if not all(_DOMAIN_LABEL.match(label) for label in labels):
+        return None
+    return ascii_domain
+
+
+def normalize_address(address):
+    """
+    ``address`` with its domain lowercased and IDNA-encoded, or None when it
+    is not a valid address. Local parts are case-sensitive and kept as given.
+    """
+    local, at, domain = address.strip().rpartition('@')
+    if not at or not local or len(local) > MAX_LOCAL_PART_LENGTH or not _LOCAL_PART.match(local):
+        return None
+    domain = normalize_domain(domain)
+    if domain is None or len(local) + len(domain) + 1 > MAX_ADDRESS_LENGTH:
+        return None
+    return f'{local}@{domain}'
+
+
+class RecipientList:
+    """
+    Recipients parsed, validated and deduplicated in one pass.
+
+    ``addresses`` keeps the first occurrence of every valid address in
+    input order, ``invalid`` the entries that failed validation and
+    ``by_domain`` the valid addresses grouped by domain, so per-domain work
+    (MX lookups, per-domain limits) runs once per domain. ``add`` takes
+    addresses one at a time for streamed sources like a campaign CSV.
+    """
+    __slots__ = ('addresses', 'invalid', 'duplicates', 'by_domain', '_seen')
+
+    def __init__(self, value=None):
+        self.addresses = []
+        self.invalid = []
+        self.duplicates = 0
+        self.by_domain = defaultdict(list)
+        self._seen = set()
+        if value:
+            self.extend(value)
+
+    def add(self, address):
+        """Normalise and record one address; returns it, or None if it is invalid or a duplicate"""
+        # "Name <user@example.com>" contributes just the address
+        if address.endswith('>') and '<' in address:
+            address = address[address.rindex('<') + 1:-1]
+        normalized = normalize_address(address)
+        if normalized is None:
+            self.invalid.append(address.strip())
+            return None
+        if normalized in self._seen:
+            self.duplicates += 1
+            return None
+        self._seen.add(normalized)
+        self.addresses.append(normalized)
+        self.by_domain[normalized[normalized.rindex('@') + 1:]].append(normalized)
+        return normalized
+
+    def extend(self, value):
+        """Add a separated string (commas, semicolons or whitespace) or an iterable of addresses"""
+        if isinstance(value, str):
+            value = _SEPARATORS.split(value) if '<' not in value else _split_named(value)
+        add = self.add
+        for address in value:
+            if address:
+                add(address)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def __contains__(self, address):
+        return normalize_address(address) in self._seen
+
+    def as_field(self):
+        """The comma-separated form stored in ``EmailMessage.recipients``"""
+        return ','.join(self.addresses)
+
+    def require_valid(self, limit=10):
+        """Return self, or raise ValidationError naming up to ``limit`` invalid entries"""
+        if self.invalid:
+            shown = ', '.join(self.invalid[:limit])
+            more = len(self.invalid) - limit
+            raise ValidationError(
+                'Invalid recipient addresses: %(addresses)s%(more)s',
+                code='invalid_recipients',
+                params={'addresses': shown, 'more': f' (+{more} more)' if more > 0 else ''},
+            )
+        if not self.addresses:
+            raise ValidationError('Enter at least one recipient address.', code='no_recipients')
+        return self
+
+    def undeliverable_domains(self, engine):
+        """
+        Domains that publish a null MX (RFC 7505) or do not exist, with one
+        cached MX lookup per domain through ``engine``
+        (a ``dns_verification.DNSVerificationEngine``). Lookup errors count
+        as deliverable.
+        """
+        results = engine.mx_records(self.by_domain)
+        return [
+            domain for domain, result in results.items()
+            if result.ok and (result.nxdomain or any(host in ('', '.') for _, host in result.answers))
+        ]
+
+
+def _split_named(value):
+    # Display names may contain spaces and quoted commas, so only commas,
+    # semicolons and line breaks outside quotes separate addresses here
+    parts, current, quoted = [], [], False
+    for char in value:
+        if char == '"':
+            quoted = not quoted
+        elif not quoted and char in ',;\r\n':
+            parts.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(char)
+    parts.append(''.join(current).strip())
+    return parts
+
+
+def parse_recipients(value):
+    """A RecipientList for a separated string or an iterable of addresses"""
+    return RecipientList(value)
+
+
+def clean_recipients(value):
+    """
+    Form-cleaning helper for a recipients field: the normalised,
+    comma-separated addresses, or ValidationError for invalid entries.
+    """
+    return parse_recipients(value).require_valid().as_field()
+
+
+def summarize_recipients(value, shown=2, total=None):
+    """
+    ``"a@x.com, b@x.com (+N more)"`` for a stored recipients string without
+    splitting all of it. Given ``total``, the number of addresses counted
+    elsewhere (like the database), ``value`` need only hold the first ones.
+    """
+    parts = value.split(',', shown)
+    if total is None:
+        if len(parts) <= shown:
+            return ', '.join(part.strip() for part in parts)
+        # The last part is the unsplit remainder; count its addresses in C
+        total = shown + parts[shown].count(',') + 1
+    if total <= shown:
+        return ', '.join(part.strip() for part in parts[:total])
+    return f"{', '.join(part.strip() for part in parts[:shown])} (+{total - shown} more)"
@@ -0,0 +1,267 @@
+# email_app/reconciler.py
+import logging
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .dashboard import record_outcomes
+from .metrics import DELIVERY_REPORTS
+from .models import EmailMessage, EmailRecipient
+from .registry import get_email_service
+from .results import OPERATION_STATUSES
+from .transports import get_transport_router
+
+logger = logging.getLogger(__name__)
+
+# Delivery report statuses from Event Grid -> EmailRecipient.status
+DELIVERY_REPORT_STATUSES = {
+    'Delivered': 'DELIVERED',
+    'Expanded': 'DELIVERED',
+    'Bounced': 'FAILED',
+    'Suppressed': 'FAILED',
+    'FilteredSpam': 'FAILED',
+    'Quarantined': 'FAILED',
+    'Failed': 'FAILED',
+}
+
+
+def _settle(pks, status, error_message=None):
+    """
+    Move ACCEPTED messages (and their recipients) to ``status`` in two UPDATEs
+    and count them on the dashboard. Rows a delivery report has already moved
+    on are left alone. Call inside a transaction.
+    """
+    if not pks:
+        return 0
+    rows = list(
+        EmailMessage.objects.select_for_update().filter(pk__in=pks, status='ACCEPTED')
+        .values_list('pk', 'created_by_id', 'sent_at', 'recipients')
+    )
+    pks = [row[0] for row in rows]
+    EmailRecipient.objects.filter(message_id__in=pks, status='ACCEPTED').update(
+        status=status,
+        error_message=error_message
+    )
+    updated = EmailMessage.objects.filter(pk__in=pks, status='ACCEPTED').update(
+        status=status,
+        error_message=error_message,
+        continuation_token=None,
+        next_attempt_at=None
+    )
+    record_outcomes(
+        (user_id, sent_at, recipients.split(','), 'ACCEPTED', status)
+        for _, user_id, sent_at, recipients in rows
+    )
+    return updated
+
+
+class DeliveryReconciler:
+    """
+    Settle direct API sends that Azure accepted but had not finished.
+
+    Each pass takes a batch of due ACCEPTED messages, polls their send
+    operations concurrently and writes the outcomes back with one UPDATE per
+    outcome rather than one per message. Operations still running are polled
+    again after ``poll_interval`` seconds; ones still unfinished ``max_age``
+    seconds after the message was created are failed.
+
+    Operations are resumed from the continuation token stored with the
+    message, through the transport that accepted it: a router APITransport
+    when EMAIL_TRANSPORTS names one, otherwise the default service.
+    """
+
+    def __init__(self, batch_size=None, concurrency=None, poll_interval=None, max_age=None, service=None):
+        self.batch_size = batch_size or getattr(settings, 'EMAIL_DELIVERY_BATCH_SIZE', 200)
+        self.concurrency = concurrency or getattr(settings, 'EMAIL_DELIVERY_CONCURRENCY', 16)
+        self.poll_interval = poll_interval or getattr(settings, 'EMAIL_DELIVERY_POLL_INTERVAL', 5)
+        self.max_age = max_age or getattr(settings, 'EMAIL_DELIVERY_MAX_AGE', 86400)
+        self._service = service
+        self._executor = None
+
+    @property
+    def service(self):
+        if self._service is None:
+            self._service = get_email_service()
+        return self._service
+
+    def due(self):
+        """
+        ``(pk, provider_message_id, sent_at, transport, continuation_token)``
+        for the next batch of ACCEPTED messages
+        """
+        now = timezone.now()
+        return list(
+            EmailMessage.objects
+            .filter(status='ACCEPTED')
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+            .order_by('next_attempt_at', 'pk')
+            .values_list('pk', 'provider_message_id', 'sent_at', 'transport', 'continuation_token')[:self.batch_size]
+        )
+
+    def source(self, transport):
+        """Whatever accepted a message sent through ``transport`` and can poll its operation"""
+        router = get_transport_router()
+        accepted_by = router.transport(transport) if router is not None else None
+        if accepted_by is not None and accepted_by.kind == 'api':
+            return accepted_by
+        return self.service
+
+    def poll(self, row):
+        """``(row, operation)``; ``operation`` is None when the poll itself failed"""
+        if row[4] is None:
+            # Nothing to resume it from; run_once fails it
+            return row, None
+        try:
+            return row, self.source(row[3]).get_operation_status(row[4])
+        except Exception:
+            logger.warning("Polling send operation %s failed", row[1], exc_info=True)
+            return row, None
+
+    def run_once(self):
+        """Poll one batch; returns the number of messages checked"""
+        batch = self.due()
+        if not batch:
+            return 0
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='reconciler')
+
+        now = timezone.now()
+        expired_before = now - timedelta(seconds=self.max_age)
+        sent = []
+        failed = defaultdict(list)
+        pending = []
+        for (pk, _, created, _, continuation_token), operation in self._executor.map(self.poll, batch):
+            status = 'ACCEPTED'
+            if operation is not None:
+                status = OPERATION_STATUSES.get(operation.get('status'), 'ACCEPTED')
+            if status == 'SENT':
+                sent.append(pk)
+            elif status == 'FAILED':
+                error = operation.get('error') or {}
+                failed[error.get('message') or f"Send operation {operation.get('status')}"].append(pk)
+            elif continuation_token is None or created < expired_before:
+                failed[f"Send operation did not finish within {self.max_age} seconds"].append(pk)
+            else:
+                pending.append(pk)
+
+        with transaction.atomic():
+            _settle(sent, 'SENT')
+            for error_message, pks in failed.items():
+                _settle(pks, 'FAILED', error_message)
+            EmailMessage.objects.filter(pk__in=pending, status='ACCEPTED').update(
+                next_attempt_at=now + timedelta(seconds=self.poll_interval)
+            )
+        return len(batch)
+
+    def run_forever(self, poll_interval=None, stop_event=None):
+        """Keep reconciling until ``stop_event`` is set, sleeping when nothing is due"""
+        stop_event = stop_event or threading.Event()
+        try:
+            while not stop_event.is_set():
+                try:
+                    checked = self.run_once()
+                except Exception:
+                    logger.exception("Delivery reconciler pass failed")
+                    checked = 0
+                if not checked:
+                    stop_event.wait(poll_interval or self.poll_interval)
+        finally:
+            self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+def apply_delivery_reports(reports):
+    """
+    Record delivery reports given as ``(message_id, recipient, status, detail)``.
+
+    The messages and their recipient rows are locked and loaded with one
+    query each and written back with one UPDATE per distinct outcome. A
+    message becomes FAILED once every recipient failed, DELIVERED once every
+    recipient has a final report and SENT while reports are still
+    outstanding. Message UPDATEs only apply to rows still in the status that
+    was read, so a concurrent ``_settle`` is never counted twice on the
+    dashboard. Returns the number of reports applied.
+    """
+    reports = [report for report in reports if report[2] in DELIVERY_REPORT_STATUSES]
+    if not reports:
+        return 0
+    with transaction.atomic():
+        messages = {
+            message.provider_message_id: message
+            for message in EmailMessage.objects.select_for_update()
+            .filter(provider_message_id__in={report[0] for report in reports})
+            .exclude(status__in=('QUEUED', 'SENDING'))
+            .only('pk', 'provider_message_id', 'status', 'created_by_id', 'sent_at')
+            .order_by('pk')
+        }
+        rows = {}
+        rows_by_message = defaultdict(list)
+        for row in (EmailRecipient.objects.select_for_update()
+                    .filter(message__in=list(messages.values())).order_by('pk')):
+            rows[(row.message_id, row.address)] = row
+            rows_by_message[row.message_id].append(row)
+
+        changed = {}
+        for message_id, recipient, status, detail in reports:
+            message = messages.get(message_id)
+            row = message and rows.get((message.pk, EmailRecipient.normalize(recipient or '')))
+            if row is None:
+                continue
+            row.status = DELIVERY_REPORT_STATUSES[status]
+            row.error_message = None if row.status == 'DELIVERED' else (detail or status)
+            changed[row.pk] = row
+            DELIVERY_REPORTS.inc(status=status)
+        if not changed:
+            return 0
+
+        touched = {row.message_id for row in changed.values()}
+        outcomes = defaultdict(list)
+        for message in messages.values():
+            if message.pk not in touched:
+                continue
+            statuses = rows_by_message[message.pk]
+            if all(row.status == 'FAILED' for row in statuses):
+                outcome = ('FAILED', statuses[0].error_message)
+            elif all(row.status in ('DELIVERED', 'FAILED') for row in statuses):
+                outcome = ('DELIVERED', None)
+            else:
+                outcome = ('SENT', None)
+            outcomes[(message.status,) + outcome].append(message)
+
+        # Reports mostly share a status and message, so one UPDATE per distinct
+        # pair beats bulk_update's per-row CASE expression
+        updates = defaultdict(list)
+        for row in changed.values():
+            updates[(row.status, row.error_message)].append(row.pk)
+        for (status, error_message), pks in updates.items():
+            EmailRecipient.objects.filter(pk__in=pks).update(status=status, error_message=error_message)
+        # A report means the send operation went out, even if polling has not caught up yet
+        EmailRecipient.objects.filter(message_id__in=touched, status='ACCEPTED').update(status='SENT')
+        finished = []
+        for (old_status, status, error_message), group in outcomes.items():
+            updated = EmailMessage.objects.filter(pk__in=[message.pk for message in group], status=old_status).update(
+                status=status,
+                error_message=error_message,
+                continuation_token=None,
+                next_attempt_at=None
+            )
+            # The rows are locked, so this only comes up short on a backend
+            # without SELECT ... FOR UPDATE; count nothing rather than guess
+            if updated == len(group):
+                finished.extend((message, old_status, status) for message in group)
+        record_outcomes(
+            (message.created_by_id, message.sent_at, [row.address for row in rows_by_message[message.pk]],
+             old_status, status)
+            for message, old_status, status in finished
+        )
+    return len(changed)
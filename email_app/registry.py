@@ -0,0 +1,108 @@
+# email_app/registry.py
+import os
+import threading
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from django.conf import settings
+
+from .services import AzureEmailService
+
+# Settings that shape the service; a change to any of them rebuilds it
+SERVICE_SETTINGS = (
+    'AZURE_COMMUNICATION_CONNECTION_STRING',
+    'AZURE_COMMUNICATION_API_KEY',
+    'AZURE_COMMUNICATION_ENDPOINT',
+    'EMAIL_HOST',
+    'EMAIL_PORT',
+    'EMAIL_HOST_USER',
+    'EMAIL_HOST_PASSWORD',
+    'EMAIL_USE_TLS',
+)
+
+_lock = threading.Lock()
+_state = {}
+_counters = {'services_created': 0, 'services_reused': 0}
+
+
+def _fingerprint():
+    return tuple(getattr(settings, name, None) for name in SERVICE_SETTINGS)
+
+
+def _build_service():
+    # Own the HTTP session so keep-alive reuse can be inspected below
+    session = requests.Session()
+    transport = RequestsTransport(session=session, session_owner=False)
+    service = AzureEmailService(transport=transport)
+    return service, session
+
+
+def get_email_service():
+    """
+    Return the process-wide AzureEmailService, creating it on first use.
+
+    The service (and its EmailClient HTTP pipeline) is rebuilt when one of
+    ``SERVICE_SETTINGS`` changes and is never shared with a forked child.
+    """
+    fingerprint = _fingerprint()
+    with _lock:
+        if _state.get('pid') == os.getpid() and _state.get('fingerprint') == fingerprint:
+            _counters['services_reused'] += 1
+            return _state['service']
+        old_session = _state.get('session') if _state.get('pid') == os.getpid() else None
+
+        service, session = _build_service()
+        _state.update(pid=os.getpid(), fingerprint=fingerprint, service=service, session=session)
+        _counters['services_created'] += 1
+
+    if old_session is not None:
+        old_session.close()
+    return service
+
+
+def reset_email_service():
+    """Close and forget the cached service; the next call builds a new one"""
+    with _lock:
+        session = _state.get('session') if _state.get('pid') == os.getpid() else None
+        _state.clear()
+    if session is not None:
+        session.close()
+
+
+def connection_stats():
+    """
+    Counters for this process: how often the service was built versus reused,
+    and how many HTTP requests went over how many TCP connections. With
+    keep-alive working ``http_requests`` grows much faster than
+    ``http_connections``.
+    """
+    with _lock:
+        stats = dict(_counters)
+        session = _state.get('session') if _state.get('pid') == os.getpid() else None
+
+    connections = requests_sent = 0
+    if session is not None:
+        for adapter in session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+    stats['http_connections'] = connections
+    stats['http_requests'] = requests_sent
+    stats['http_connections_reused'] = max(requests_sent - connections, 0)
+    return stats
+
+
+def _forget_after_fork():
+    """Forked children (gunicorn --preload) must not reuse the parent's sockets"""
+    global _lock
+    _lock = threading.Lock()
+    _state.clear()
+    for name in _counters:
+        _counters[name] = 0
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_after_fork)
@@ -0,0 +1,173 @@
+# email_app/results.py
+import smtplib
+
+from azure.core.exceptions import HttpResponseError
+
+from .attachments import AttachmentTooLarge
+from .throttling import RETRYABLE_STATUS_CODES
+
+
+def is_permanent_error(exc):
+    """
+    True for failures caused by the message rather than the transport
+    (rejected sender or recipients, oversized attachments, a 4xx from the
+    API, bad arguments). They fail the same way on every attempt and every
+    transport; anything else may succeed later.
+    """
+    if isinstance(exc, (AttachmentTooLarge, smtplib.SMTPRecipientsRefused, ValueError, TypeError)):
+        return True
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        # The account is misconfigured, not the message
+        return False
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 500 <= exc.smtp_code < 600
+    if isinstance(exc, HttpResponseError) and exc.status_code is not None:
+        return 400 <= exc.status_code < 500 and exc.status_code not in RETRYABLE_STATUS_CODES
+    return False
+
+
+class Result:
+    """
+    Outcome of an operation that used to return ``(success, message)``.
+
+    Unpacks like the old tuple, so ``success, message = manager.verify_dns_records()``
+    keeps working, but also says what kind of error occurred and whether
+    trying again could help.
+    """
+    __slots__ = ('success', 'detail', 'error_class', 'retryable')
+
+    def __init__(self, success, detail, error_class=None, retryable=False):
+        self.success = success
+        self.detail = detail
+        self.error_class = error_class
+        self.retryable = retryable
+
+    @classmethod
+    def failed(cls, exc, detail, **kwargs):
+        """The result for an exception; ``detail`` is the message shown to users"""
+        return cls(False, detail, type(exc).__name__, not is_permanent_error(exc), **kwargs)
+
+    def __iter__(self):
+        yield self.success
+        yield self.detail
+
+    def __eq__(self, other):
+        if isinstance(other, tuple):
+            return tuple(self) == other
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self._fields())
+
+    __hash__ = None
+
+    @classmethod
+    def _fields(cls):
+        return [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ())]
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields())
+        return f'{type(self).__name__}({fields})'
+
+
+class SendTimings:
+    """
+    Seconds spent in each phase of one send; phases that did not happen stay
+    None. ``poll`` is the direct API's wait for the send operation to finish.
+    """
+    __slots__ = ('connect', 'tls', 'auth', 'submit', 'poll', 'total')
+
+    # Phases stored on EmailMessage as ``<phase>_ms``
+    COLUMNS = ('connect', 'tls', 'auth', 'submit', 'total')
+
+    def __init__(self, connect=None, tls=None, auth=None, submit=None, poll=None, total=None):
+        self.connect = connect
+        self.tls = tls
+        self.auth = auth
+        self.submit = submit
+        self.poll = poll
+        self.total = total
+
+    def reset(self):
+        self.connect = self.tls = self.auth = self.submit = self.poll = self.total = None
+
+    def as_milliseconds(self):
+        """``{'connect_ms': ..., ...}`` for the EmailMessage timing columns"""
+        return {
+            f'{name}_ms': None if getattr(self, name) is None else round(getattr(self, name) * 1000)
+            for name in self.COLUMNS
+        }
+
+    def __eq__(self, other):
+        if not isinstance(other, SendTimings):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'SendTimings({fields})'
+
+
+# Status of Azure's long-running send operation -> EmailMessage.status
+OPERATION_STATUSES = {
+    'NotStarted': 'ACCEPTED',
+    'Running': 'ACCEPTED',
+    'Succeeded': 'SENT',
+    'Failed': 'FAILED',
+    'Canceled': 'FAILED',
+}
+
+
+class SendResult(Result):
+    """
+    Outcome of sending one message: which transport carried it, the
+    provider's message id and where the time went.
+
+    ``status`` is the EmailMessage status it leads to. A direct API send that
+    Azure has accepted but not finished is a success with status
+    ``ACCEPTED`` and a ``continuation_token``; the reconciler settles it.
+    ``suppressed`` lists the recipients left out by the suppression list.
+    """
+    __slots__ = ('transport', 'message_id', 'timings', 'status', 'continuation_token', 'suppressed')
+
+    def __init__(self, success, detail, error_class=None, retryable=False, transport=None,
+                 message_id=None, timings=None, status=None, continuation_token=None, suppressed=()):
+        super().__init__(success, detail, error_class, retryable)
+        self.transport = transport
+        self.message_id = message_id
+        self.timings = timings or SendTimings()
+        self.status = status or ('SENT' if success else 'FAILED')
+        self.continuation_token = continuation_token
+        self.suppressed = suppressed
+
+    @classmethod
+    def sent(cls, detail, transport=None, message_id=None, timings=None):
+        return cls(True, detail, transport=transport, message_id=message_id, timings=timings)
+
+    @classmethod
+    def from_operation(cls, operation, transport=None, timings=None, continuation_token=None):
+        """The result for a direct API send operation body (``id``, ``status``, ``error``)"""
+        operation_id = operation.get('id')
+        status = OPERATION_STATUSES.get(operation.get('status'), 'ACCEPTED')
+        if status == 'SENT':
+            return cls.sent(f"Email sent successfully. Message ID: {operation_id}", transport, operation_id, timings)
+        if status == 'FAILED':
+            error = operation.get('error') or {}
+            return cls(
+                False,
+                f"Failed to send email via direct API: {error.get('message') or operation.get('status')}",
+                error.get('code') or 'OperationFailed',
+                transport=transport,
+                message_id=operation_id,
+                timings=timings,
+            )
+        return cls(
+            True,
+            f"Email accepted for delivery. Message ID: {operation_id}",
+            transport=transport,
+            message_id=operation_id,
+            timings=timings,
+            status='ACCEPTED',
+            continuation_token=continuation_token,
+        )
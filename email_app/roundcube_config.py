@@ -0,0 +1,357 @@
+# email_app/roundcube_config.py
+import hashlib
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: writes stay atomic, concurrent updates may overwrite each other
+    fcntl = None
+
+# Where a scan for assignments has to stop and look: comments, strings and $config
+_INTERESTING = re.compile(r"""//|#|/\*|['"]|\$config\b""")
+_ASSIGNMENT = re.compile(r"""\$config\s*\[\s*(?:'((?:[^'\\]|\\.)*)'|"((?:[^"\\$]|\\.)*)")\s*\]\s*=(?!=)\s*""")
+_NUMBER = re.compile(r'[-+]?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+_DOUBLE_QUOTED_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'v': '\v', 'e': '\x1b', 'f': '\f',
+                          '\\': '\\', '$': '$', '"': '"', '0': '\0'}
+
+
+class PHPExpression:
+    """A value that is not a plain literal (a constant, a concatenation), kept as PHP source"""
+    __slots__ = ('source',)
+
+    def __init__(self, source):
+        self.source = source
+
+    def __eq__(self, other):
+        return isinstance(other, PHPExpression) and other.source == self.source
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'PHPExpression({self.source!r})'
+
+
+def _skip_string(text, pos):
+    """Index just past the PHP string starting at ``pos``"""
+    quote = text[pos]
+    pos += 1
+    while pos < len(text):
+        char = text[pos]
+        if char == '\\':
+            pos += 2
+            continue
+        if char == quote:
+            return pos + 1
+        pos += 1
+    raise ValueError('Unterminated string')
+
+
+def _skip_comment(text, pos):
+    if text.startswith('/*', pos):
+        end = text.find('*/', pos + 2)
+        return len(text) if end < 0 else end + 2
+    end = text.find('\n', pos)
+    return len(text) if end < 0 else end
+
+
+def _statement_end(text, pos):
+    """Index of the ``;`` ending the expression that starts at ``pos``"""
+    depth = 0
+    while pos < len(text):
+        char = text[pos]
+        if char in '\'"':
+            pos = _skip_string(text, pos)
+            continue
+        if char == '#' or text.startswith('//', pos) or text.startswith('/*', pos):
+            pos = _skip_comment(text, pos)
+            continue
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+        elif char == ';' and depth == 0:
+            return pos
+        pos += 1
+    raise ValueError('Unterminated $config assignment')
+
+
+class _LiteralParser:
+    """Recursive descent over the PHP literals config files use; anything else raises ValueError"""
+
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+
+    def parse(self):
+        value = self.value()
+        self.space()
+        if self.pos != len(self.source):
+            raise ValueError('Trailing input')
+        return value
+
+    def space(self):
+        source = self.source
+        while self.pos < len(source):
+            if source[self.pos].isspace():
+                self.pos += 1
+            elif source[self.pos] == '#' or source.startswith('//', self.pos) or source.startswith('/*', self.pos):
+                self.pos = _skip_comment(source, self.pos)
+            else:
+                break
+
+    def value(self):
+        self.space()
+        source, pos = self.source, self.pos
+        char = source[pos:pos + 1]
+        if char in ("'", '"'):
+            end = _skip_string(source, pos)
+            self.pos = end
+            body = source[pos + 1:end - 1]
+            if char == "'":
+                return re.sub(r"\\([\\'])", r'\1', body)
+            if '$' in body.replace('\\$', ''):
+                raise ValueError('Interpolated string')
+            return re.sub(r'\\(.)', lambda m: _DOUBLE_QUOTED_ESCAPES.get(m.group(1), m.group(0)), body)
+        if char == '[':
+            self.pos += 1
+            return self.array(']')
+        if source[pos:pos + 5].lower() == 'array':
+            self.pos += 5
+            self.space()
+            if self.source[self.pos:self.pos + 1] == '(':
+                self.pos += 1
+                return self.array(')')
+        match = _NUMBER.match(source, pos)
+        if match:
+            self.pos = match.end()
+            text = match.group()
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        for word, value in (('true', True), ('false', False), ('null', None)):
+            if source[pos:pos + len(word)].lower() == word and not source[pos + len(word):pos + len(word) + 1].isalnum():
+                self.pos += len(word)
+                return value
+        raise ValueError('Not a literal')
+
+    def array(self, closing):
+        items = []
+        keyed = False
+        while True:
+            self.space()
+            if self.source[self.pos:self.pos + 1] == closing:
+                self.pos += 1
+                break
+            key = self.value()
+            self.space()
+            if self.source.startswith('=>', self.pos):
+                self.pos += 2
+                items.append((key, self.value()))
+                keyed = True
+            else:
+                items.append((len(items), key))
+            self.space()
+            if self.source[self.pos:self.pos + 1] == ',':
+                self.pos += 1
+            elif self.source[self.pos:self.pos + 1] != closing:
+                raise ValueError('Expected , or end of array')
+        if keyed or [key for key, _ in items] != list(range(len(items))):
+            return dict(items)
+        return [value for _, value in items]
+
+
+def parse_php_value(source):
+    """The Python value of a PHP literal, or a PHPExpression when it is not one"""
+    try:
+        return _LiteralParser(source).parse()
+    except (ValueError, IndexError):
+        return PHPExpression(source.strip())
+
+
+def to_php(value):
+    """PHP source for a Python value"""
+    if isinstance(value, PHPExpression):
+        return value.source
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+    if isinstance(value, dict):
+        return '[' + ', '.join(f'{to_php(key)} => {to_php(item)}' for key, item in value.items()) + ']'
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(to_php(item) for item in value) + ']'
+    raise TypeError(f'Cannot write {type(value).__name__} to a PHP config file')
+
+
+class Assignment:
+    """One ``$config['key'] = value;`` statement; ``start``/``end`` span its value source"""
+    __slots__ = ('key', 'start', 'end', 'value')
+
+    def __init__(self, key, start, end, value):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.value = value
+
+
+class RoundCubeConfig:
+    """
+    The ``$config[...]`` assignments of a RoundCube config file.
+
+    Everything else (comments, layout, other PHP) is kept verbatim; only the
+    values of keys that actually change are rewritten, and new keys are
+    appended. When a key is assigned more than once the last assignment is
+    the one PHP uses, so that is the one read and rewritten.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.assignments = {}
+        pos = 0
+        while True:
+            match = _INTERESTING.search(text, pos)
+            if match is None:
+                break
+            token, pos = match.group(), match.start()
+            if token in ("'", '"'):
+                pos = _skip_string(text, pos)
+            elif token != '$config':
+                pos = _skip_comment(text, pos)
+            else:
+                assignment = _ASSIGNMENT.match(text, pos)
+                if assignment is None:
+                    pos += len(token)
+                    continue
+                start = assignment.end()
+                end = _statement_end(text, start)
+                key = assignment.group(1) if assignment.group(1) is not None else assignment.group(2)
+                self.assignments[key] = Assignment(key, start, end, parse_php_value(text[start:end]))
+                pos = end + 1
+
+    def __contains__(self, key):
+        return key in self.assignments
+
+    def __getitem__(self, key):
+        return self.assignments[key].value
+
+    def get(self, key, default=None):
+        assignment = self.assignments.get(key)
+        return default if assignment is None else assignment.value
+
+    def as_dict(self):
+        return {key: assignment.value for key, assignment in self.assignments.items()}
+
+    def changes(self, values):
+        """The keys of ``values`` whose value differs from the file's"""
+        # Compared as canonical PHP, so 1 and true or 1 and 1.0 still count as different
+        return [
+            key for key, value in values.items()
+            if key not in self.assignments or to_php(self.assignments[key].value) != to_php(value)
+        ]
+
+    def render(self, values):
+        """``(text, changed_keys)`` with ``values`` applied"""
+        changed = self.changes(values)
+        if not changed:
+            return self.text, []
+        text = self.text
+        new = []
+        for key in sorted(changed, key=lambda key: -self.assignments[key].start if key in self.assignments else 0):
+            assignment = self.assignments.get(key)
+            if assignment is None:
+                new.append(key)
+            else:
+                text = text[:assignment.start] + to_php(values[key]) + text[assignment.end:]
+        if new:
+            lines = ''.join(f"$config[{to_php(key)}] = {to_php(values[key])};\n" for key in new)
+            # Before a closing tag, if the file has one
+            stripped = text.rstrip()
+            if stripped.endswith('?>'):
+                head = stripped[:-2]
+                text = head + ('' if head.endswith('\n') else '\n') + lines + text[len(stripped) - 2:]
+            else:
+                text = text + ('' if not text or text.endswith('\n') else '\n') + lines
+        return text, changed
+
+
+class ConfigUpdate:
+    """Outcome of ``RoundCubeConfigFile.update``"""
+    __slots__ = ('changed', 'written', 'digest')
+
+    def __init__(self, changed, written, digest):
+        self.changed = changed
+        self.written = written
+        self.digest = digest
+
+
+class RoundCubeConfigFile:
+    """
+    Read-modify-write access to ``config/config.inc.php``.
+
+    Updates hold an exclusive lock on ``<path>.lock`` so concurrent pushes
+    to one host serialise instead of losing each other's keys, compare the
+    SHA-256 of the new content with the current one and skip the write when
+    they match, and otherwise write a temporary file next to the config and
+    ``os.replace`` it over the old one, so RoundCube never reads a partial
+    file. Pushing the same settings again is a read and a hash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """The current file as a RoundCubeConfig; an empty one if the file does not exist"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return RoundCubeConfig(f.read())
+        except FileNotFoundError:
+            return RoundCubeConfig('<?php\n\n')
+
+    @contextmanager
+    def _lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, values):
+        """Apply ``values`` (key -> Python value or PHPExpression); returns a ConfigUpdate"""
+        with self._lock():
+            config = self.read()
+            text, changed = config.render(values)
+            digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            if digest == hashlib.sha256(config.text.encode('utf-8')).hexdigest():
+                return ConfigUpdate(changed, False, digest)
+            self._write(text)
+            return ConfigUpdate(changed, True, digest)
+
+    def _write(self, text):
+        directory = os.path.dirname(self.path) or '.'
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.config.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                # Keep the owner-only permissions RoundCube configs usually have
+                os.chmod(temp_path, os.stat(self.path).st_mode & 0o7777)
+            except FileNotFoundError:
+                pass
+            os.replace(temp_path, self.path)
+        except BaseException:
+            try:
+                os.unlink(temp_path)
+            except FileNotFoundError:
+                pass
+            raise
@@ -3,8 +3,12 @@ import os
 import json
 import requests
 import subprocess
+from urllib.parse import urlencode
 from django.conf import settings
-from django.contrib.auth.models import User
+from .results import Result
+from .roundcube_config import RoundCubeConfigFile
+from .roundcube_sync import RoundCubeUserSync
+from .sso import get_sso_service
 
 class RoundCubeIntegrator:
     """Class to handle integration with RoundCube webmail"""
@@ -19,32 +23,24 @@ class RoundCubeIntegrator:
         """
         Configure RoundCube SMTP settings
         
-        Note: This requires filesystem access to the RoundCube installation directory
-        and will likely need to be run with elevated permissions.
+        Rewrites only the SMTP keys that differ in config/config.inc.php, and
+        leaves the file untouched when they are already set (see
+        email_app/roundcube_config.py). Needs write access to the RoundCube
+        config directory.
         """
         try:
-            # Sample implementation - in practice, this would need to parse and modify
-            # the PHP configuration files
-            
-            # This is a simulated implementation for demonstration purposes
-            config = f"""
-            $config['smtp_server'] = '{smtp_server}';
-            $config['smtp_port'] = {smtp_port};
-            $config['smtp_user'] = '%u';
-            $config['smtp_pass'] = '%p';
-            $config['smtp_auth_type'] = 'LOGIN';
-            $config['smtp_conn_options'] = array(
-                'ssl' => array(
-                    'verify_peer' => false,
-                    'verify_peer_name' => false,
-                )
-            );
-            """
-            
-            print(f"RoundCube SMTP settings would be configured as:\n{config}")
-            return True, "SMTP settings configured successfully (simulation)"
+            update = RoundCubeConfigFile(self.config_path).update({
+                'smtp_server': f'tls://{smtp_server}' if tls else smtp_server,
+                'smtp_port': int(smtp_port),
+                'smtp_user': '%u',
+                'smtp_pass': '%p',
+                'smtp_auth_type': 'LOGIN',
+            })
+            if not update.written:
+                return Result(True, "RoundCube SMTP settings are already up to date")
+            return Result(True, f"Updated RoundCube SMTP settings: {', '.join(update.changed)}")
         except Exception as e:
-            return False, f"Failed to configure RoundCube SMTP settings: {str(e)}"
+            return Result.failed(e, f"Failed to configure RoundCube SMTP settings: {str(e)}")
     
     def create_user(self, email, password, name):
         """
@@ -62,54 +58,35 @@ class RoundCubeIntegrator:
         except Exception as e:
             return False, f"Failed to create RoundCube user: {str(e)}"
     
-    def sync_users_from_django(self):
+    def sync_users_from_django(self, full=False):
         """
         Synchronize users from Django to RoundCube
         
-        This is useful when you want to keep the same user base between
-        your Django application and RoundCube.
+        Provisions, renames and removes RoundCube accounts for the users
+        changed since the last run, or for every user when ``full`` is set,
+        in batched statements against the ROUNDCUBE_DATABASE connection
+        (see email_app/roundcube_sync.py).
         """
         try:
-            # Get all Django users
-            django_users = User.objects.all()
-            
-            success_count = 0
-            for user in django_users:
-                if user.email:
-                    # This would actually create or update the RoundCube user
-                    print(f"Would sync user {user.email} to RoundCube")
-                    success_count += 1
-            
-            return True, f"Successfully synchronized {success_count} users to RoundCube (simulation)"
+            stats = RoundCubeUserSync().run(full=full)
+            return Result(True, f"Synchronized users to RoundCube: {stats}")
         except Exception as e:
-            return False, f"Failed to synchronize users to RoundCube: {str(e)}"
+            return Result.failed(e, f"Failed to synchronize users to RoundCube: {str(e)}")
     
     def generate_sso_url(self, email, redirect_to=None):
         """
         Generate a Single Sign-On URL for RoundCube
         
-        This would allow users to log in to RoundCube directly from your Django app
-        without entering credentials again.
-        
-        Note: This is a simplified implementation. In practice, you would need to:
-        1. Use a secure token generation mechanism
-        2. Implement a corresponding plugin or code in RoundCube to validate the token
+        The URL carries a signed, single-use token that expires after
+        ROUNDCUBE_SSO_TOKEN_TTL seconds. RoundCube's SSO plugin exchanges it
+        at the ``roundcube_sso_validate`` endpoint for the email to log in
+        and the page to open (see email_app/sso.py).
         """
         try:
-            # Simulated SSO token (in practice, use a secure method)
-            import time
-            import hashlib
-            
-            timestamp = int(time.time())
-            token = hashlib.sha256(f"{email}|{timestamp}|{settings.SECRET_KEY}".encode()).hexdigest()
-            
-            sso_url = f"{self.roundcube_url}/?_user={email}&_token={token}&_timestamp={timestamp}"
-            if redirect_to:
-                sso_url += f"&_redirect={redirect_to}"
-            
-            return True, sso_url
+            token = get_sso_service().issue(email, redirect_to)
+            return Result(True, f"{self.roundcube_url}/?{urlencode({'_action': 'sso', '_sso_token': token})}")
         except Exception as e:
-            return False, f"Failed to generate SSO URL: {str(e)}"
+            return Result.failed(e, f"Failed to generate SSO URL: {str(e)}")
 
 
 # Example usage in views.py:
@@ -0,0 +1,334 @@
+# email_app/roundcube_sync.py
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models.signals import post_delete, post_save
+from django.utils import timezone, translation
+
+from .models import RoundCubeAccount, RoundCubeSyncState
+
+logger = logging.getLogger(__name__)
+
+SYNC_STATE_KEY = 'roundcube_users'
+
+# Incremental runs look back this far past the stored mark, so a change
+# stamped just before the mark but committed after it is not missed
+HIGH_WATER_OVERLAP = timedelta(seconds=60)
+
+# The only user fields RoundCube's users and identities depend on
+USER_FIELDS = ('pk', 'email', 'first_name', 'last_name', 'is_active')
+
+
+def desired_account(user):
+    """``(username, name)`` RoundCube should hold for ``user``, or None when it should have no account"""
+    if user is None or not user.is_active:
+        return None
+    username = (user.email or '').strip().lower()
+    if not username:
+        return None
+    return username, f'{user.first_name} {user.last_name}'.strip() or username
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+class SyncStats:
+    """Counts of one synchronisation run"""
+    __slots__ = ('checked', 'created', 'updated', 'deleted', 'conflicts')
+
+    def __init__(self):
+        self.checked = self.created = self.updated = self.deleted = self.conflicts = 0
+
+    def __str__(self):
+        return (f'{self.checked} users checked, {self.created} created, '
+                f'{self.updated} updated, {self.deleted} deleted, {self.conflicts} conflicts')
+
+
+class RoundCubeUserSync:
+    """
+    Mirror active Django users with an email address into RoundCube's
+    ``users`` table and their default ``identities`` row.
+
+    Django users have no modification time, so saving or deleting one stamps
+    its RoundCubeAccount row, and a run only looks at rows stamped after the
+    stored high-water mark. The first run, or one with ``full=True``, streams
+    every user instead. Users are read ``chunk_size`` at a time with only the
+    fields RoundCube needs, diffed against their accounts, and each chunk is
+    written to RoundCube with one multi-row statement per kind of change.
+    Accounts RoundCube created itself on first login are adopted rather than
+    duplicated. Bulk ``QuerySet.update()`` calls on users send no signals;
+    run a full sync after those.
+
+    Django does not require unique email addresses, but RoundCube usernames
+    are unique. A username belongs to the account already holding it, or
+    else to the lowest user id asking for it; other users wanting it are
+    skipped and logged, and wait with a pending account until the owner
+    lets the username go.
+    """
+
+    def __init__(self, connection=None, mail_host=None, chunk_size=None, language=None, overlap=HIGH_WATER_OVERLAP):
+        self.connection = connection or connections[getattr(settings, 'ROUNDCUBE_DATABASE', 'roundcube')]
+        self.mail_host = mail_host or getattr(settings, 'ROUNDCUBE_MAIL_HOST', 'localhost')
+        self.chunk_size = chunk_size or getattr(settings, 'ROUNDCUBE_SYNC_CHUNK_SIZE', 500)
+        self.language = language or translation.to_locale(settings.LANGUAGE_CODE)
+        self.overlap = overlap
+
+    def run(self, full=False):
+        """Apply changes since the last run (or all users when ``full``); returns SyncStats"""
+        stats = SyncStats()
+        state, _ = RoundCubeSyncState.objects.get_or_create(key=SYNC_STATE_KEY)
+        started = timezone.now()
+        users = User.objects.only(*USER_FIELDS).order_by('pk')
+
+        if full or state.high_water is None:
+            for chunk in _chunks(users.iterator(chunk_size=self.chunk_size), self.chunk_size):
+                self.sync_chunk({user.pk: user for user in chunk}, stats)
+            # Accounts of deleted users; listed up front since syncing removes the rows
+            gone = list(
+                RoundCubeAccount.objects.exclude(user_id__in=User.objects.values('pk'))
+                .values_list('user_id', flat=True)
+            )
+            for chunk in _chunks(gone, self.chunk_size):
+                self.sync_chunk(dict.fromkeys(chunk), stats)
+        else:
+            changed = (
+                RoundCubeAccount.objects.filter(changed_at__gt=state.high_water - self.overlap)
+                .order_by('changed_at').values_list('user_id', flat=True)
+            )
+            for chunk in _chunks(list(changed), self.chunk_size):
+                found = users.in_bulk(chunk)
+                self.sync_chunk({pk: found.get(pk) for pk in chunk}, stats)
+
+        RoundCubeSyncState.objects.filter(pk=state.pk).update(high_water=started)
+        return stats
+
+    def sync_chunk(self, users, stats):
+        """Bring RoundCube in line with ``users``, a dict of user id -> User, or None for a deleted user"""
+        accounts = RoundCubeAccount.objects.in_bulk(list(users), field_name='user_id')
+        targets = {pk: desired_account(user) for pk, user in users.items()}
+        owners = self._owners(accounts, targets)
+        create, update, delete, waiting = [], [], [], []
+        for pk, target in targets.items():
+            account = accounts.get(pk)
+            if target is not None and owners[target[0]] != pk:
+                logger.warning("RoundCube username %s is taken by user %s; skipping user %s",
+                               target[0], owners[target[0]], pk)
+                stats.conflicts += 1
+                if account is None or account.rc_user_id is None:
+                    # Pending on the username, so releasing it re-stamps this user
+                    waiting.append(account or RoundCubeAccount(user_id=pk))
+                    waiting[-1].username = target[0]
+            elif target is None:
+                if account is not None:
+                    delete.append(account)
+            elif account is None or account.rc_user_id is None:
+                create.append((account or RoundCubeAccount(user_id=pk), target))
+            elif (account.username, account.name) != target:
+                update.append((account, target))
+        stats.checked += len(users)
+        if waiting:
+            RoundCubeAccount.objects.bulk_create([account for account in waiting if account.pk is None])
+            RoundCubeAccount.objects.bulk_update([account for account in waiting if account.pk is not None], ['username'])
+        if not (create or update or delete):
+            return
+
+        provisioned = [account.rc_user_id for account in delete if account.rc_user_id is not None]
+        if provisioned:
+            # Never remove a RoundCube user another account still points at
+            shared = set(
+                RoundCubeAccount.objects.filter(rc_user_id__in=provisioned)
+                .exclude(user_id__in=[account.user_id for account in delete])
+                .values_list('rc_user_id', flat=True)
+            )
+            provisioned = [rc_user_id for rc_user_id in provisioned if rc_user_id not in shared]
+        released = [account.username for account in delete if account.rc_user_id is not None] + [
+            account.username for account, target in update if account.username != target[0]
+        ]
+
+        with self._transaction() as cursor:
+            if provisioned:
+                self._delete(cursor, provisioned)
+            # Renames first, so a username given up in this chunk is free for a new account
+            renames = [(account.rc_user_id, target[0]) for account, target in update if account.username != target[0]]
+            if renames:
+                self._rename(cursor, renames)
+            update_identities = [(account.rc_user_id, target) for account, target in update]
+            if create:
+                user_ids, adopted = self._insert(cursor, [target for _, target in create])
+                for account, target in create:
+                    account.rc_user_id = user_ids[target[0]]
+                update_identities += [(account.rc_user_id, target) for account, target in create if target[0] in adopted]
+            if update_identities:
+                self._update_identities(cursor, update_identities)
+
+        # Recorded only once RoundCube has committed; a crash in between is
+        # repaired by the next run adopting the accounts it finds
+        now = timezone.now()
+        for account, (username, name) in create + update:
+            account.username, account.name, account.synced_at = username, name, now
+        RoundCubeAccount.objects.filter(pk__in=[account.pk for account in delete]).delete()
+        RoundCubeAccount.objects.bulk_create([account for account, _ in create if account.pk is None])
+        RoundCubeAccount.objects.bulk_update(
+            [account for account, _ in create + update if account.pk is not None],
+            ['rc_user_id', 'username', 'name', 'synced_at']
+        )
+        if released:
+            # Users skipped for wanting these usernames get their turn on the next run
+            RoundCubeAccount.objects.filter(username__in=released, rc_user_id__isnull=True).update(changed_at=now)
+        stats.created += len(create)
+        stats.updated += len(update)
+        stats.deleted += len(provisioned)
+
+    def _owners(self, accounts, targets):
+        """The user id each username wanted in this chunk belongs to"""
+        usernames = {target[0] for target in targets.values() if target is not None}
+        owners = dict(
+            RoundCubeAccount.objects.filter(username__in=usernames, rc_user_id__isnull=False)
+            .exclude(user_id__in=list(targets)).values_list('username', 'user_id')
+        )
+        # Accounts in the chunk keeping their username come next, then the lowest user id
+        for pk, account in sorted(accounts.items()):
+            target = targets.get(pk)
+            if account.rc_user_id is not None and target is not None and target[0] == account.username:
+                owners.setdefault(account.username, pk)
+        for pk in sorted(targets):
+            if targets[pk] is not None:
+                owners.setdefault(targets[pk][0], pk)
+        return owners
+
+    @contextmanager
+    def _transaction(self):
+        connection = self.connection
+        if connection.in_atomic_block or not connection.get_autocommit():
+            # Part of a transaction the caller manages
+            with connection.cursor() as cursor:
+                yield cursor
+            return
+        connection.set_autocommit(False)
+        try:
+            with connection.cursor() as cursor:
+                yield cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            connection.set_autocommit(True)
+
+    def _batches(self, rows, params_per_row):
+        # Stay under the backend's bind parameter limit (999 on older SQLite)
+        limit = self.connection.features.max_query_params
+        size = max(limit // params_per_row - 1, 1) if limit else len(rows)
+        return _chunks(rows, size)
+
+    def _insert_rows(self, cursor, sql, rows):
+        placeholders = '(%s)' % ', '.join(['%s'] * len(rows[0]))
+        for batch in self._batches(rows, len(rows[0])):
+            cursor.execute(sql + ', '.join([placeholders] * len(batch)), [value for row in batch for value in row])
+
+    def _user_ids(self, cursor, usernames):
+        user_ids = {}
+        for batch in self._batches(usernames, 1):
+            cursor.execute(
+                'SELECT username, user_id FROM users WHERE mail_host = %%s AND username IN (%s)'
+                % ', '.join(['%s'] * len(batch)),
+                [self.mail_host] + batch
+            )
+            user_ids.update(cursor.fetchall())
+        return user_ids
+
+    def _insert(self, cursor, targets):
+        """
+        Create users with their default identity; returns the RoundCube user
+        ids by username and the set of usernames that already existed.
+        """
+        user_ids = self._user_ids(cursor, [username for username, _ in targets])
+        adopted = set(user_ids)
+        new = [(username, name) for username, name in targets if username not in adopted]
+        if new:
+            now = self.connection.ops.adapt_datetimefield_value(timezone.now())
+            self._insert_rows(
+                cursor,
+                'INSERT INTO users (username, mail_host, created, language) VALUES ',
+                [(username, self.mail_host, now, self.language) for username, _ in new]
+            )
+            created = self._user_ids(cursor, [username for username, _ in new])
+            self._insert_rows(
+                cursor,
+                'INSERT INTO identities (user_id, changed, del, standard, name, email) VALUES ',
+                [(created[username], now, 0, 1, name, username) for username, name in new]
+            )
+            user_ids.update(created)
+        return user_ids, adopted
+
+    def _rename(self, cursor, renames):
+        for batch in self._batches(renames, 3):
+            cursor.execute(
+                'UPDATE users SET username = CASE user_id %s END WHERE user_id IN (%s)' % (
+                    ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                    ', '.join(['%s'] * len(batch))
+                ),
+                [value for row in batch for value in row] + [user_id for user_id, _ in batch]
+            )
+
+    def _update_identities(self, cursor, changes):
+        now = self.connection.ops.adapt_datetimefield_value(timezone.now())
+        for batch in self._batches(changes, 5):
+            cases = ' '.join(['WHEN %s THEN %s'] * len(batch))
+            cursor.execute(
+                'UPDATE identities SET name = CASE user_id %s END, email = CASE user_id %s END, changed = %%s '
+                'WHERE standard = 1 AND del = 0 AND user_id IN (%s)' % (cases, cases, ', '.join(['%s'] * len(batch))),
+                [value for user_id, (_, name) in batch for value in (user_id, name)]
+                + [value for user_id, (username, _) in batch for value in (user_id, username)]
+                + [now]
+                + [user_id for user_id, _ in batch]
+            )
+
+    def _delete(self, cursor, user_ids):
+        for batch in self._batches(user_ids, 1):
+            placeholders = ', '.join(['%s'] * len(batch))
+            # RoundCube's schema cascades the rest; identities go explicitly
+            # so the stand-in schemas used in tests stay consistent too
+            cursor.execute('DELETE FROM identities WHERE user_id IN (%s)' % placeholders, batch)
+            cursor.execute('DELETE FROM users WHERE user_id IN (%s)' % placeholders, batch)
+
+    def run_forever(self, interval=None, stop_event=None):
+        """Run incremental syncs every ``interval`` seconds until ``stop_event`` is set"""
+        interval = interval or getattr(settings, 'ROUNDCUBE_SYNC_INTERVAL', 60)
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                stats = self.run()
+                if stats.created or stats.updated or stats.deleted:
+                    logger.info("RoundCube user sync: %s", stats)
+            except Exception:
+                logger.exception("RoundCube user sync failed")
+            stop_event.wait(interval)
+
+
+def _mark_changed(sender, instance, update_fields=None, **kwargs):
+    """Stamp the user's RoundCubeAccount so the next incremental sync picks it up"""
+    if not getattr(settings, 'ROUNDCUBE_SYNC_ENABLED', True):
+        return
+    # Logins save last_login alone, which RoundCube does not care about
+    if update_fields is not None and set(update_fields) <= {'last_login'}:
+        return
+    now = timezone.now()
+    if not RoundCubeAccount.objects.filter(user_id=instance.pk).update(changed_at=now):
+        RoundCubeAccount.objects.bulk_create(
+            [RoundCubeAccount(user_id=instance.pk, changed_at=now)],
+            ignore_conflicts=True
+        )
+
+
+post_save.connect(_mark_changed, sender=User, dispatch_uid='roundcube_sync_user_saved')
+post_delete.connect(_mark_changed, sender=User, dispatch_uid='roundcube_sync_user_deleted')
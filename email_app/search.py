@@ -0,0 +1,191 @@
+# email_app/search.py
+import re
+
+from django.conf import settings
+from django.core import checks
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils.functional import cached_property
+from django.utils.text import smart_split, unescape_string_literal
+
+# The full-text index over subject, sender, recipients and body created by
+# migrations 0013 and 0014: a trigger-maintained tsvector column with a GIN
+# index on PostgreSQL, an external-content FTS5 table kept in sync by
+# triggers on SQLite
+SEARCH_VECTOR_COLUMN = 'search_vector'
+FTS_TABLE = 'email_app_emailmessage_fts'
+FTS_TRIGGERS = tuple(f'{FTS_TABLE}_{event}' for event in ('insert', 'delete', 'update'))
+
+_WORD = re.compile(r'\w+')
+
+_fts_tables = {}
+
+
+def _terms(search_term):
+    """The admin's search terms (quoted phrases kept together), each as its word tokens"""
+    terms = []
+    for bit in smart_split(search_term):
+        if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+            bit = unescape_string_literal(bit)
+        tokens = _WORD.findall(bit)
+        if tokens:
+            terms.append((bit, tokens))
+    return terms
+
+
+def _missing_triggers(connection):
+    """None when SQLite has no FTS table, else the names of its missing triggers"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT type, name FROM sqlite_master WHERE (type = 'table' AND name = %s) OR "
+            "(type = 'trigger' AND tbl_name = 'email_app_emailmessage')",
+            [FTS_TABLE]
+        )
+        names = {(kind, name) for kind, name in cursor.fetchall()}
+    if ('table', FTS_TABLE) not in names:
+        return None
+    return [name for name in FTS_TRIGGERS if ('trigger', name) not in names]
+
+
+def has_search_index(connection):
+    """
+    True when migration 0013 could build the full-text index on this
+    database. Raises ImproperlyConfigured when the SQLite index exists but
+    its triggers were dropped (by a later migration rebuilding the table),
+    rather than searching an index that no longer follows the table.
+    """
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor != 'sqlite':
+        return False
+    if connection.alias not in _fts_tables:
+        # SQLite builds without FTS5 skip the table; a good index is remembered per process
+        missing = _missing_triggers(connection)
+        if missing:
+            raise ImproperlyConfigured(
+                f"The {FTS_TABLE} search index is stale: triggers {', '.join(missing)} are missing. "
+                f"Recreate them as in migration 0013 and run "
+                f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')."
+            )
+        _fts_tables[connection.alias] = missing is not None
+    return _fts_tables[connection.alias]
+
+
+@checks.register(checks.Tags.database)
+def check_search_index(app_configs=None, databases=None, **kwargs):
+    """``manage.py check --database`` reports a SQLite search index that lost its triggers"""
+    errors = []
+    for alias in databases or []:
+        connection = connections[alias]
+        if connection.vendor != 'sqlite':
+            continue
+        try:
+            missing = _missing_triggers(connection)
+        except DatabaseError:
+            continue
+        if missing:
+            errors.append(checks.Error(
+                f"The {FTS_TABLE} search index no longer follows email_app_emailmessage: "
+                f"triggers {', '.join(missing)} are missing.",
+                hint="Recreate them as in migration 0013 and rebuild the index.",
+                id='email_app.E001',
+            ))
+    return errors
+
+
+def full_text_filter(queryset, search_term):
+    """
+    ``queryset`` narrowed to messages matching every term of ``search_term``
+    through the full-text index, or None when the database has no index.
+
+    Terms match whole words, the last word of each term also as a prefix;
+    a term with punctuation, like an email address, matches as a phrase.
+    """
+    connection = connections[queryset.db]
+    if not has_search_index(connection):
+        return None
+    terms = _terms(search_term)
+    if not terms:
+        return queryset
+    table = connection.ops.quote_name(queryset.model._meta.db_table)
+
+    if connection.vendor == 'postgresql':
+        parts, params = [], []
+        for bit, tokens in terms:
+            if len(tokens) == 1 and tokens[0] == bit:
+                parts.append("to_tsquery('simple', %s)")
+                params.append(f'{tokens[0]}:*')
+            else:
+                # Parsed like the indexed text, so "user@example.com" stays one lexeme
+                parts.append("phraseto_tsquery('simple', %s)")
+                params.append(bit)
+        match = RawSQL(
+            f'{table}.{connection.ops.quote_name(SEARCH_VECTOR_COLUMN)} @@ ({" && ".join(parts)})',
+            params,
+            output_field=BooleanField()
+        )
+        return queryset.filter(match)
+
+    # FTS5: space-separated strings must all match; a quoted string is a
+    # phrase, and a trailing * makes its last token a prefix
+    query = ' '.join('"%s"*' % ' '.join(tokens) for _, tokens in terms)
+    return queryset.filter(pk__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [query]))
+
+
+def estimate_count(queryset):
+    """
+    A cheap row count estimate for ``queryset``, or None when the database
+    cannot give one. Uses the planner's statistics on PostgreSQL (pg_class
+    for a whole table, EXPLAIN for a filtered query); on SQLite only whole
+    tables are estimated, from ANALYZE statistics or the highest id.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    filtered = bool(queryset.query.where)
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                if not filtered:
+                    cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+                    row = cursor.fetchone()
+                    return row[0] if row and row[0] >= 0 else None
+                sql, params = queryset.order_by().values('pk').query.sql_with_params()
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+                return int(plan[0]['Plan']['Plan Rows'])
+            if connection.vendor == 'sqlite' and not filtered:
+                try:
+                    cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s AND idx IS NULL', [table])
+                    row = cursor.fetchone()
+                except DatabaseError:
+                    # Never ANALYZEd
+                    row = None
+                if row:
+                    return int(row[0].split()[0])
+                if queryset.model._meta.pk.get_internal_type() in ('AutoField', 'BigAutoField'):
+                    cursor.execute(f'SELECT MAX({connection.ops.quote_name(queryset.model._meta.pk.column)}) '
+                                   f'FROM {connection.ops.quote_name(table)}')
+                    return cursor.fetchone()[0] or 0
+    except (DatabaseError, KeyError, IndexError, ValueError):
+        return None
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that trusts ``estimate_count`` once it is above
+    EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD rows and counts exactly below it,
+    so the admin changelist does not ``COUNT(*)`` millions of rows for its
+    page links. The last page may come up short or empty for large results.
+    """
+
+    @cached_property
+    def count(self):
+        threshold = getattr(settings, 'EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD', 10000)
+        estimate = estimate_count(self.object_list)
+        if estimate is not None and estimate > threshold:
+            return estimate
+        return super().count
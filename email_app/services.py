@@ -1,24 +1,202 @@
 import os
 import smtplib
+import time
+import uuid
 import dns.resolver
 import dns.zone
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from email.message import Message
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from email.utils import make_msgid
 from azure.communication.email import EmailClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.polling.base_polling import LROBasePolling
 from django.conf import settings
+from .smtp_pool import get_smtp_pool
+from .attachments import check_attachments_size, iter_mime_message
+from .throttling import get_throttle
+from .results import OPERATION_STATUSES, Result, SendResult, SendTimings
+from .metrics import record_send
+from .suppression import allowed_recipients
+from .dns_verification import DNSVerificationEngine
+
+
+def build_mime_message(sender, recipients, subject, body, html_body=None, attachments=None):
+    """
+    Build the MIME message sent over SMTP
+    
+    ``body`` and ``html_body`` may be strings or pre-encoded MIMEText parts
+    (see templating.CompiledEmailTemplate). Attachments are added as
+    placeholder parts; send the result with ``iter_mime_message`` so their
+    content is streamed in.
+    """
+    alternative = MIMEMultipart('alternative')
+    
+    # Attach text body; an already encoded part is attached as it is
+    alternative.attach(body if isinstance(body, Message) else MIMEText(body, 'plain'))
+    
+    # Attach HTML body if provided
+    if html_body:
+        alternative.attach(html_body if isinstance(html_body, Message) else MIMEText(html_body, 'html'))
+    
+    if attachments:
+        message = MIMEMultipart('mixed')
+        message.attach(alternative)
+        for attachment in attachments:
+            message.attach(attachment.mime_part())
+    else:
+        message = alternative
+    
+    message['From'] = sender
+    message['To'] = ", ".join(recipients) if isinstance(recipients, list) else recipients
+    message['Subject'] = subject
+    # Our own id, so SMTP sends can be matched up with later delivery reports
+    message['Message-ID'] = make_msgid(domain=sender.rpartition('@')[2] or None)
+    
+    return message
+
+
+def build_api_message(sender, recipients, subject, body, html_body=None, attachments=None):
+    """Build the JSON payload expected by EmailClient.begin_send"""
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    
+    # Create the email content
+    content = {
+        "subject": subject,
+        "plainText": body,
+    }
+    
+    if html_body:
+        content["html"] = html_body
+    
+    message = {
+        "senderAddress": sender,
+        "recipients": {"to": [{"address": r} for r in recipients]},
+        "content": content,
+    }
+    if attachments:
+        message["attachments"] = [attachment.api_payload() for attachment in attachments]
+    return message
+
+
+def deliver_smtp(pool, throttle, sender, recipients, subject, body, html_body=None, attachments=None,
+                 timings=None, suppressed=None):
+    """
+    Send one message over a pooled, already authenticated SMTP session and
+    return its Message-ID.
+
+    Raises on failure; ``attachments`` are streamed to the server rather than
+    built into the message. Phase timings of the last attempt go on
+    ``timings`` when given. Suppressed recipients are left out, and added to
+    the ``suppressed`` list when one is given.
+    """
+    recipients = allowed_recipients(recipients, suppressed)
+    check_attachments_size(attachments)
+    message = build_mime_message(sender, recipients, subject, body, html_body, attachments)
+    if attachments:
+        throttle.call(lambda: pool.send_chunks(
+            sender,
+            recipients,
+            lambda: iter_mime_message(message, attachments),
+            timings=timings
+        ))
+    else:
+        throttle.call(lambda: pool.send_message(message, timings=timings))
+    return message['Message-ID']
+
+
+class StatusPolling(LROBasePolling):
+    """
+    Polling method that checks a send operation at most ``polls`` times
+    (none: just the accepted response) instead of waiting for it to finish.
+    Unlike ``polling=False`` it can hand out a continuation token.
+    """
+
+    def __init__(self, polls=1):
+        super().__init__(0, lro_options={'final-state-via': 'azure-async-operation'})
+        self.polls = polls
+
+    def run(self):
+        for _ in range(self.polls):
+            if self.finished():
+                break
+            self.update_status()
+
+
+def deliver_api(email_client, throttle, sender, recipients, subject, body, html_body=None, attachments=None,
+                timings=None, wait=False, suppressed=None):
+    """
+    Submit one message through the direct API; raises on failure.
+
+    Returns ``(operation, continuation_token)``: the send operation's body
+    (``id``, ``status`` and maybe ``error``) and, while it is still running,
+    the SDK token to resume polling it. Unless ``wait`` is set the call
+    returns as soon as Azure accepts the message instead of polling the
+    operation to completion. Suppressed recipients are left out, and added
+    to the ``suppressed`` list when one is given.
+    """
+    recipients = allowed_recipients(recipients, suppressed)
+    check_attachments_size(attachments)
+    message = build_api_message(sender, recipients, subject, body, html_body, attachments)
+
+    # The SDK's own retries are off so 429s reach the throttle; the fixed
+    # operation id makes a retried submit idempotent on the service side.
+    operation_id = str(uuid.uuid4())
+
+    def submit():
+        started = time.perf_counter()
+        try:
+            return email_client.begin_send(
+                message, operation_id=operation_id, retry_total=0, polling=True if wait else StatusPolling(0)
+            )
+        finally:
+            if timings is not None:
+                timings.submit = time.perf_counter() - started
+
+    poller = throttle.call(submit)
+    started = time.perf_counter()
+    try:
+        operation = poller.result()
+    finally:
+        if timings is not None and wait:
+            timings.poll = time.perf_counter() - started
+    if OPERATION_STATUSES.get(operation.get('status'), 'ACCEPTED') != 'ACCEPTED':
+        return operation, None
+    return operation, poller.continuation_token()
+
+
+def get_operation_status(email_client, throttle, continuation_token):
+    """
+    One poll of the direct API send operation ``continuation_token`` (from
+    ``deliver_api``) resumes; returns its body like ``deliver_api``. The
+    token's operation URL is polled with ``email_client``, which must belong
+    to the ACS resource that accepted the message.
+    """
+    return throttle.call(lambda: email_client.begin_send(
+        None, continuation_token=continuation_token, polling=StatusPolling()
+    ).result())
+
 
 class AzureEmailService:
-    def __init__(self):
-        """Initialize Azure Email Service using settings from Django"""
+    def __init__(self, **client_kwargs):
+        """
+        Initialize Azure Email Service using settings from Django
+        
+        ``client_kwargs`` are passed through to ``EmailClient`` (e.g. a shared
+        ``transport``). Prefer ``registry.get_email_service()`` over building
+        a service per call so the client's HTTP connections are reused.
+        """
         connection_string = settings.AZURE_COMMUNICATION_CONNECTION_STRING
         api_key = getattr(settings, 'AZURE_COMMUNICATION_API_KEY', None)
         endpoint = getattr(settings, 'AZURE_COMMUNICATION_ENDPOINT', None)
         
         if connection_string:
-            self.email_client = EmailClient.from_connection_string(connection_string)
+            self.email_client = EmailClient.from_connection_string(connection_string, **client_kwargs)
         elif api_key and endpoint:
-            self.email_client = EmailClient(endpoint, AzureKeyCredential(api_key))
+            self.email_client = EmailClient(endpoint, AzureKeyCredential(api_key), **client_kwargs)
         else:
             raise ValueError("Azure Communication Service credentials not properly configured in settings")
         
@@ -27,129 +205,161 @@ class AzureEmailService:
         self.smtp_port = settings.EMAIL_PORT
         self.smtp_username = settings.EMAIL_HOST_USER
         self.smtp_password = settings.EMAIL_HOST_PASSWORD
+        self.smtp_use_tls = getattr(settings, 'EMAIL_USE_TLS', True)
+        
+        # Rate limit, adaptive concurrency and retries shared by every send in this process
+        self.throttle = get_throttle()
+    
+    def get_smtp_pool(self):
+        """Return the shared SMTP connection pool for the configured account"""
+        return get_smtp_pool(
+            self.smtp_server,
+            self.smtp_port,
+            self.smtp_username,
+            self.smtp_password,
+            use_tls=self.smtp_use_tls
+        )
     
     def send_email(self, sender, recipients, subject, body, html_body=None, attachments=None):
-        """Send email using Azure Communication Services SMTP"""
+        """
+        Send email using Azure Communication Services SMTP
+        
+        ``attachments`` is a list of ``attachments.Attachment``; their content
+        is streamed to the server rather than built into the message.
+        Returns a ``results.SendResult``.
+        """
+        timings = SendTimings()
+        suppressed = []
+        started = time.perf_counter()
         try:
-            # Create the email message
-            message = MIMEMultipart('alternative')
-            message['From'] = sender
-            message['To'] = ", ".join(recipients) if isinstance(recipients, list) else recipients
-            message['Subject'] = subject
-            
-            # Attach text body
-            message.attach(MIMEText(body, 'plain'))
-            
-            # Attach HTML body if provided
-            if html_body:
-                message.attach(MIMEText(html_body, 'html'))
-            
-            # Send using Azure Communication Services SMTP
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()  # Secure the connection
-                server.login(self.smtp_username, self.smtp_password)
-                server.send_message(message)
-            
-            return True, "Email sent successfully"
+            message_id = deliver_smtp(
+                self.get_smtp_pool(), self.throttle, sender, recipients, subject, body, html_body, attachments,
+                timings=timings, suppressed=suppressed
+            )
+            result = SendResult.sent("Email sent successfully", 'smtp', message_id, timings)
         except Exception as e:
-            return False, f"Failed to send email: {str(e)}"
+            result = SendResult.failed(e, f"Failed to send email: {str(e)}", transport='smtp', timings=timings)
+        result.suppressed = suppressed
+        timings.total = time.perf_counter() - started
+        record_send(result)
+        return result
     
-    def send_email_direct_api(self, sender, recipients, subject, body, html_body=None):
-        """Send email using Azure Communication Services direct API"""
+    def send_email_direct_api(self, sender, recipients, subject, body, html_body=None, attachments=None, wait=None):
+        """
+        Send email using Azure Communication Services direct API; returns a ``results.SendResult``
+        
+        By default the message is only submitted: the result has status
+        ``ACCEPTED`` until Azure finishes the send operation, which
+        ``reconciler.DeliveryReconciler`` or the delivery report webhook then
+        records. ``wait=True`` (or EMAIL_DIRECT_API_WAIT) polls it to the end.
+        """
+        if wait is None:
+            wait = getattr(settings, 'EMAIL_DIRECT_API_WAIT', False)
+        timings = SendTimings()
+        suppressed = []
+        started = time.perf_counter()
         try:
-            if isinstance(recipients, str):
-                recipients = [recipients]
-                
-            # Create recipient list in the format expected by Azure
-            to_recipients = [{"address": r} for r in recipients]
-            
-            # Create the email content
-            content = {
-                "subject": subject,
-                "plainText": body,
-            }
-            
-            if html_body:
-                content["html"] = html_body
-                
-            # Send using direct API
-            poller = self.email_client.begin_send(
-                sender=sender,
-                recipients={"to": to_recipients},
-                content=content
+            operation, continuation_token = deliver_api(
+                self.email_client, self.throttle, sender, recipients, subject, body, html_body, attachments,
+                timings=timings, wait=wait, suppressed=suppressed
             )
-            
-            result = poller.result()
-            return True, f"Email sent successfully. Message ID: {result.message_id}"
+            result = SendResult.from_operation(operation, 'api', timings, continuation_token)
         except Exception as e:
-            return False, f"Failed to send email via direct API: {str(e)}"
+            result = SendResult.failed(
+                e, f"Failed to send email via direct API: {str(e)}", transport='api', timings=timings
+            )
+        result.suppressed = suppressed
+        timings.total = time.perf_counter() - started
+        record_send(result)
+        return result
+    
+    def get_operation_status(self, continuation_token):
+        """Current body of a direct API send operation (``id``, ``status``, ``error``)"""
+        return get_operation_status(self.email_client, self.throttle, continuation_token)
+    
+    def send_bulk(self, messages, concurrency=None):
+        """
+        Send many messages through the direct API with bounded concurrency.
+        
+        ``messages`` is any iterable of dicts with ``sender``, ``recipients``,
+        ``subject``, ``body`` and optional ``html_body`` and ``attachments``
+        keys. It is consumed lazily and ``(message, result)`` pairs, with a
+        ``results.SendResult`` each, are yielded as sends complete, so at most
+        ``concurrency`` messages are held at once. Messages that share
+        Attachment objects share their base64 encoding too.
+        """
+        concurrency = concurrency or getattr(settings, 'EMAIL_BULK_CONCURRENCY', 32)
+        pending = iter(messages)
+        
+        def send(message):
+            return self.send_email_direct_api(
+                message['sender'],
+                message['recipients'],
+                message['subject'],
+                message['body'],
+                message.get('html_body'),
+                message.get('attachments')
+            )
+        
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bulk-send') as executor:
+            in_flight = {}
+            for message in islice(pending, concurrency):
+                in_flight[executor.submit(send, message)] = message
+            
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    message = in_flight.pop(future)
+                    yield message, future.result()
+                    
+                    # Keep the window full as results come back
+                    for next_message in islice(pending, 1):
+                        in_flight[executor.submit(send, next_message)] = next_message
 
 
 class DNSManager:
     def __init__(self):
         """Initialize DNS Manager"""
         self.domain = settings.EMAIL_DOMAIN
+        self.engine = DNSVerificationEngine()
     
     def create_mx_record(self, mail_server, priority=10):
         """Create MX record for the domain"""
         try:
             # In a real implementation, you would call your DNS provider's API here
             # For demonstration, we're just returning success
-            return True, f"Created MX record for {self.domain} pointing to {mail_server} with priority {priority}"
+            return Result(True, f"Created MX record for {self.domain} pointing to {mail_server} with priority {priority}")
         except Exception as e:
-            return False, f"Failed to create MX record: {str(e)}"
+            return Result.failed(e, f"Failed to create MX record: {str(e)}")
     
     def create_spf_record(self, allowed_servers):
         """Create SPF record for domain authentication"""
         try:
             spf_record = f"v=spf1 {' '.join(allowed_servers)} -all"
             # In a real implementation, you would call your DNS provider's API here
-            return True, f"Created SPF record for {self.domain}: {spf_record}"
+            return Result(True, f"Created SPF record for {self.domain}: {spf_record}")
         except Exception as e:
-            return False, f"Failed to create SPF record: {str(e)}"
+            return Result.failed(e, f"Failed to create SPF record: {str(e)}")
     
     def create_dkim_record(self, selector, dkim_value):
         """Create DKIM record for domain authentication"""
         try:
             # In a real implementation, you would call your DNS provider's API here
-            return True, f"Created DKIM record for {selector}._domainkey.{self.domain}"
+            return Result(True, f"Created DKIM record for {selector}._domainkey.{self.domain}")
         except Exception as e:
-            return False, f"Failed to create DKIM record: {str(e)}"
+            return Result.failed(e, f"Failed to create DKIM record: {str(e)}")
     
-    def verify_dns_records(self):
+    def verify_dns_records(self, dkim_selectors=None):
         """Verify that DNS records exist and are properly configured"""
         try:
-            results = []
-            
-            # Check MX records
-            try:
-                mx_records = dns.resolver.resolve(self.domain, 'MX')
-                mx_results = []
-                for mx in mx_records:
-                    mx_results.append(f"Priority: {mx.preference}, Server: {mx.exchange}")
-                results.append(f"Found {len(mx_records)} MX records for {self.domain}")
-                results.extend(mx_results)
-            except Exception as e:
-                results.append(f"Error checking MX records: {str(e)}")
-            
-            # Check SPF records
-            try:
-                txt_records = dns.resolver.resolve(self.domain, 'TXT')
-                spf_found = False
-                for txt in txt_records:
-                    for string in txt.strings:
-                        if string.startswith(b'v=spf1'):
-                            spf_found = True
-                            results.append(f"Found SPF record: {string.decode('utf-8')}")
-                
-                if not spf_found:
-                    results.append("No SPF record found")
-            except Exception as e:
-                results.append(f"Error checking SPF records: {str(e)}")
-            
-            return True, results
+            reports = self.engine.verify_domains([self.domain], dkim_selectors)
+            return Result(True, reports[self.domain].summary())
         except Exception as e:
-            return False, [f"Error verifying DNS records: {str(e)}"]
+            return Result.failed(e, [f"Error verifying DNS records: {str(e)}"])
+    
+    def verify_domains(self, domains, dkim_selectors=None):
+        """Verify many domains concurrently; returns a DomainReport per domain"""
+        return self.engine.verify_domains(domains, dkim_selectors)
 
 
 # Now let's create models.py to store email and DNS record information
@@ -157,20 +367,260 @@ class DNSManager:
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .recipients import normalize_address, parse_recipients
 
 class EmailMessage(models.Model):
+    STATUS_CHOICES = (
+        ('QUEUED', 'Queued'),
+        ('SENDING', 'Sending'),
+        ('ACCEPTED', 'Accepted'),
+        ('SENT', 'Sent'),
+        ('DELIVERED', 'Delivered'),
+        ('FAILED', 'Failed'),
+    )
+    
     sender = models.EmailField()
     recipients = models.TextField()  # Store as comma-separated emails
     subject = models.CharField(max_length=255)
     body = models.TextField()
     html_body = models.TextField(blank=True, null=True)
     sent_at = models.DateTimeField(auto_now_add=True)
-    status = models.CharField(max_length=50)
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default='QUEUED')
     error_message = models.TextField(blank=True, null=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
     
+    # Outbound queue bookkeeping, see email_app/outbox.py
+    use_direct_api = models.BooleanField(default=False)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    locked_by = models.CharField(max_length=100, blank=True, null=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    
+    # Outcome of the last delivery attempt, see email_app/results.py. For the
+    # direct API the message id is the send operation id, which delivery
+    # reports refer to; ``continuation_token`` resumes polling an ACCEPTED send.
+    provider_message_id = models.CharField(max_length=255, blank=True, null=True)
+    continuation_token = models.TextField(blank=True, null=True)
+    transport = models.CharField(max_length=100, blank=True, null=True)
+    connect_ms = models.PositiveIntegerField(null=True, blank=True)
+    tls_ms = models.PositiveIntegerField(null=True, blank=True)
+    auth_ms = models.PositiveIntegerField(null=True, blank=True)
+    submit_ms = models.PositiveIntegerField(null=True, blank=True)
+    total_ms = models.PositiveIntegerField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='email_queue_due_idx'),
+            # Per-user history and dashboards, newest first
+            models.Index(fields=['created_by', 'sent_at'], name='email_user_sent_idx'),
+            # Admin and reporting filters by status over a date range
+            models.Index(fields=['status', 'sent_at'], name='email_status_sent_idx'),
+            # Delivery reports and the reconciler look messages up by provider id
+            models.Index(fields=['provider_message_id'], name='email_provider_id_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.subject} - {self.sent_at}"
+    
+    def recipient_list(self):
+        """The comma-separated ``recipients`` as a list of distinct, normalised addresses"""
+        return parse_recipients(self.recipients).addresses
+    
+    def save_recipients(self, suppressed=()):
+        """Create the EmailRecipient rows for a saved message; ``suppressed`` addresses were not sent to"""
+        EmailRecipient.objects.bulk_create(EmailRecipient.rows_for(self, suppressed), ignore_conflicts=True)
+    
+    @staticmethod
+    def result_fields(result):
+        """Field values recording a ``results.SendResult``, for ``update()`` or the constructor"""
+        return {
+            'provider_message_id': result.message_id,
+            'transport': result.transport,
+            'continuation_token': result.continuation_token,
+            **result.timings.as_milliseconds(),
+        }
+
+class EmailRecipient(models.Model):
+    """One row per address of an EmailMessage, with its own delivery status"""
+    # error_message of a recipient the suppression list left out of the send
+    SUPPRESSED = 'Suppressed'
+    
+    message = models.ForeignKey(EmailMessage, on_delete=models.CASCADE, related_name='recipient_rows')
+    address = models.EmailField(max_length=254)
+    status = models.CharField(max_length=50, choices=EmailMessage.STATUS_CHOICES, default='QUEUED')
+    error_message = models.TextField(blank=True, null=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['message', 'address'], name='email_recipient_unique'),
+        ]
+        indexes = [
+            # "All mail sent to X"
+            models.Index(fields=['address', 'message'], name='email_recipient_address_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.address} ({self.status})"
+    
+    @staticmethod
+    def normalize(address):
+        """Domains are case-insensitive, so store them lowercased (and IDNA-encoded) for exact-match lookups"""
+        return normalize_address(address) or address.strip()
+    
+    @classmethod
+    def rows_for(cls, message, suppressed=()):
+        """
+        Unsaved rows for every distinct address of ``message``, FAILED for
+        the ``suppressed`` addresses the send left out
+        """
+        addresses = dict.fromkeys(cls.normalize(address) for address in message.recipient_list())
+        suppressed = {cls.normalize(address) for address in suppressed}
+        return [
+            cls(message=message, address=address, status='FAILED', error_message=cls.SUPPRESSED)
+            if address in suppressed else
+            cls(message=message, address=address, status=message.status, error_message=message.error_message)
+            for address in addresses
+        ]
+    
+    @classmethod
+    def mark_suppressed(cls, message_id, suppressed):
+        """Record that the send of ``message_id`` left out the ``suppressed`` addresses"""
+        if suppressed:
+            cls.objects.filter(
+                message_id=message_id, address__in={cls.normalize(address) for address in suppressed}
+            ).update(status='FAILED', error_message=cls.SUPPRESSED)
+
+class EmailDailyStat(models.Model):
+    """Messages per user, day and final status, maintained by email_app/dashboard.py"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    status = models.CharField(max_length=50, choices=EmailMessage.STATUS_CHOICES)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'status'], name='email_daily_stat_unique'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} {self.day} {self.status}: {self.count}"
+
+class EmailDomainDailyStat(models.Model):
+    """Recipients per user, day and domain of messages that finished, see email_app/dashboard.py"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    day = models.DateField()
+    domain = models.CharField(max_length=253)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'day', 'domain'], name='email_domain_stat_unique'),
+        ]
+    
+    def __str__(self):
+        return f"{self.user_id} {self.day} {self.domain}: {self.count}"
+
+class EmailEvent(models.Model):
+    """A delivery or engagement event from the provider, see email_app/events.py"""
+    event_id = models.CharField(max_length=100, unique=True)  # The provider's id; redeliveries are dropped
+    event_type = models.CharField(max_length=100)
+    message = models.ForeignKey(
+        EmailMessage, on_delete=models.CASCADE, related_name='events', null=True, blank=True
+    )
+    provider_message_id = models.CharField(max_length=255, blank=True, null=True)
+    recipient = models.EmailField(max_length=254, blank=True, null=True)
+    status = models.CharField(max_length=50, blank=True, null=True)  # Delivery status or engagement type
+    detail = models.TextField(blank=True, null=True)
+    occurred_at = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['message', 'occurred_at'], name='email_event_message_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.event_type} {self.status} for {self.recipient}"
+
+class SuppressedAddress(models.Model):
+    """An address no message may be sent to, see email_app/suppression.py"""
+    REASON_CHOICES = (
+        ('BOUNCE', 'Hard bounce'),
+        ('COMPLAINT', 'Spam complaint'),
+        ('UNSUBSCRIBE', 'Unsubscribed'),
+        ('MANUAL', 'Added manually'),
+    )
+    
+    address = models.EmailField(max_length=254, unique=True)  # Stored as EmailRecipient.normalize() returns it
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES, default='MANUAL')
+    detail = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        verbose_name_plural = 'suppressed addresses'
+        indexes = [
+            # SuppressionList's incremental refresh
+            models.Index(fields=['created_at'], name='email_suppressed_created_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.address} ({self.reason})"
+    
+    def save(self, *args, **kwargs):
+        self.address = EmailRecipient.normalize(self.address)
+        super().save(*args, **kwargs)
+    
+    @classmethod
+    def suppress(cls, addresses, reason='MANUAL', detail=None):
+        """Add ``addresses``, keeping the original entry for ones already suppressed"""
+        cls.objects.bulk_create(
+            [cls(address=EmailRecipient.normalize(address), reason=reason, detail=detail) for address in addresses],
+            ignore_conflicts=True
+        )
+
+class RoundCubeAccount(models.Model):
+    """
+    A Django user's RoundCube account as last synchronised, see
+    email_app/roundcube_sync.py. ``changed_at`` is stamped whenever the user
+    is saved or deleted; rows without ``rc_user_id`` are pending changes.
+    """
+    user_id = models.IntegerField(unique=True)  # Not a foreign key: the row outlives the user until the sync removes the account
+    rc_user_id = models.IntegerField(null=True, blank=True)  # users.user_id in RoundCube's database
+    username = models.CharField(max_length=128, blank=True, null=True)
+    name = models.CharField(max_length=255, blank=True, default='')
+    changed_at = models.DateTimeField(default=timezone.now, db_index=True)
+    synced_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"RoundCube account {self.username or '(pending)'} for user {self.user_id}"
+
+class RoundCubeSyncState(models.Model):
+    """High-water mark of a RoundCube synchronisation; changes up to it have been applied"""
+    key = models.CharField(max_length=50, unique=True)
+    high_water = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.key} synced up to {self.high_water}"
+
+class EmailTemplate(models.Model):
+    """Reusable subject/text/HTML templates rendered per recipient, see email_app/templating.py"""
+    name = models.CharField(max_length=100, unique=True)
+    subject = models.CharField(max_length=255)
+    text_body = models.TextField()
+    html_body = models.TextField(blank=True, null=True)
+    version = models.PositiveIntegerField(default=0, editable=False)  # Bumped on every save; keys the compiled cache
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def __str__(self):
+        return f"{self.name} (v{self.version})"
+    
+    def save(self, *args, **kwargs):
+        self.version += 1
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        super().save(*args, **kwargs)
 
 class DNSRecord(models.Model):
     RECORD_TYPES = (
@@ -187,4 +637,32 @@ class DNSRecord(models.Model):
     last_verified = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
-        return f"{self.record_type} for {self.domain} - {self.created_at}"
\ No newline at end of file
+        return f"{self.record_type} for {self.domain} - {self.created_at}"
+
+class DNSDomainState(models.Model):
+    """Latest resolved answers for a domain, maintained by the monitor_dns command"""
+    domain = models.CharField(max_length=255, unique=True)
+    answers = models.JSONField(default=dict)  # Lookup key ('MX', 'TXT', 'DMARC', 'DKIM:<selector>') -> answers
+    summary = models.JSONField(default=list)  # DomainReport.summary() lines shown in the DNS view
+    min_ttl = models.PositiveIntegerField(default=300)
+    last_changed = models.DateTimeField(null=True, blank=True)
+    refresh_requested = models.BooleanField(default=False)
+    
+    def __str__(self):
+        return f"DNS state for {self.domain}"
+
+class DNSAnswerHistory(models.Model):
+    """One row per observed change of a lookup's answers"""
+    domain = models.CharField(max_length=255)
+    lookup = models.CharField(max_length=100)
+    answers = models.JSONField(default=list)
+    drift = models.JSONField(default=list)  # Drift events derived from the previous answers
+    resolved_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['domain', 'resolved_at'], name='dns_history_domain_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.lookup} for {self.domain} - {self.resolved_at}"
\ No newline at end of file
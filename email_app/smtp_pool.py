@@ -0,0 +1,298 @@
+# email_app/smtp_pool.py
+import os
+import smtplib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+class SMTPPoolTimeout(Exception):
+    """Raised when no pooled SMTP connection becomes available in time"""
+
+
+class PooledSMTPConnection:
+    """An authenticated SMTP session plus the bookkeeping the pool needs"""
+
+    def __init__(self, server):
+        self.server = server
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.messages_sent = 0
+        # Set between the 354 reply to DATA and the reply to the final dot;
+        # anything written meanwhile becomes part of the message body
+        self.in_data = False
+
+    def close(self):
+        if self.in_data:
+            # QUIT or RSET would only be appended to the half-sent message
+            # (and wait for a reply that never comes); drop the socket
+            try:
+                self.server.close()
+            except Exception:
+                pass
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+
+
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of authenticated SMTP sessions.
+
+    Connections are opened lazily up to ``size``, handed out one caller at a time,
+    and returned to the pool after use. A connection is retired once it has been
+    idle longer than ``idle_timeout`` seconds or has carried ``max_messages``
+    messages. Connections idle for more than ``healthcheck_interval`` seconds are
+    probed with NOOP before being reused.
+    """
+
+    def __init__(self, host, port, username=None, password=None, use_tls=True,
+                 size=4, idle_timeout=60, max_messages=100, healthcheck_interval=5,
+                 timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.healthcheck_interval = healthcheck_interval
+        self.timeout = timeout
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+
+        # Counters, mostly useful to confirm reuse in tests and benchmarks
+        self.connections_opened = 0
+        self.connections_reused = 0
+
+    def _connect(self, timings=None):
+        started = time.perf_counter()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        connected = secured = time.perf_counter()
+        try:
+            if self.use_tls:
+                server.starttls()
+                secured = time.perf_counter()
+            if self.username:
+                server.login(self.username, self.password)
+        except Exception:
+            server.close()
+            raise
+        if timings is not None:
+            timings.connect = connected - started
+            timings.tls = secured - connected if self.use_tls else None
+            timings.auth = time.perf_counter() - secured if self.username else None
+        with self._lock:
+            self.connections_opened += 1
+        return PooledSMTPConnection(server)
+
+    def _is_usable(self, conn):
+        now = time.monotonic()
+        if now - conn.last_used > self.idle_timeout:
+            return False
+        if now - conn.last_used > self.healthcheck_interval:
+            try:
+                code, _ = conn.server.noop()
+            except smtplib.SMTPException:
+                return False
+            except OSError:
+                return False
+            return code == 250
+        return True
+
+    def _checkout(self, timeout=None, timings=None):
+        if not self._slots.acquire(timeout=timeout if timeout is not None else self.timeout):
+            raise SMTPPoolTimeout(f"No SMTP connection to {self.host}:{self.port} available")
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return self._connect(timings)
+                if self._is_usable(conn):
+                    with self._lock:
+                        self.connections_reused += 1
+                    return conn
+                conn.close()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _checkin(self, conn, discard=False):
+        try:
+            conn.last_used = time.monotonic()
+            if discard or self._closed or conn.messages_sent >= self.max_messages:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout=None, timings=None):
+        """
+        Borrow an authenticated ``smtplib.SMTP`` session from the pool. When a
+        new session has to be opened its connect, TLS and auth times are
+        stored on ``timings`` (a ``results.SendTimings``).
+        """
+        with self._borrow(timeout, timings) as conn:
+            yield conn.server
+
+    @contextmanager
+    def _borrow(self, timeout=None, timings=None):
+        conn = self._checkout(timeout, timings)
+        discard = False
+        try:
+            yield conn
+            conn.messages_sent += 1
+        except BaseException as e:
+            # SMTPException subclasses OSError; only the socket-level ones mean the connection is gone
+            socket_error = isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException)
+            if conn.in_data or socket_error or isinstance(e, smtplib.SMTPServerDisconnected):
+                # Mid-message, or the connection failed: never hand it out again
+                discard = True
+            else:
+                # The session may be mid-transaction, so reset it
+                try:
+                    conn.server.rset()
+                except Exception:
+                    discard = True
+            raise
+        finally:
+            self._checkin(conn, discard=discard)
+
+    def send_message(self, message, from_addr=None, to_addrs=None, timings=None):
+        """Send a message, reconnecting once if the pooled session was dropped"""
+        return self._send(lambda conn: conn.server.send_message(message, from_addr, to_addrs), timings)
+
+    def send_chunks(self, from_addr, to_addrs, render, timings=None):
+        """
+        Like ``send_message`` for a message too large to build in memory.
+        ``render()`` returns an iterable of ready-to-send DATA bytes and is
+        called again if the pooled session was dropped.
+        """
+        return self._send(lambda conn: send_chunks(conn.server, from_addr, to_addrs, render(), session=conn), timings)
+
+    def _send(self, submit, timings):
+        for attempt in range(2):
+            if timings is not None:
+                timings.reset()
+            try:
+                with self._borrow(timings=timings) as conn:
+                    started = time.perf_counter()
+                    result = submit(conn)
+                    if timings is not None:
+                        timings.submit = time.perf_counter() - started
+                    return result
+            except smtplib.SMTPServerDisconnected:
+                if attempt:
+                    raise
+
+    def close(self):
+        """Close every idle connection; borrowed ones are closed on return"""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn.close()
+
+
+def send_chunks(server, from_addr, to_addrs, chunks, session=None):
+    """
+    ``smtplib.SMTP.sendmail`` for a message given as an iterable of byte
+    chunks. The chunks must already use CRLF line endings and be dot-stuffed
+    (see ``attachments.iter_mime_message``); they are written to the socket
+    one at a time. ``session``, the PooledSMTPConnection of ``server``, is
+    marked ``in_data`` while the body is being written, so a failure in
+    ``chunks`` gets the connection closed rather than reused.
+    """
+    server.ehlo_or_helo_if_needed()
+    code, resp = server.mail(from_addr)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+
+    refused = {}
+    for addr in to_addrs:
+        code, resp = server.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, resp)
+    if len(refused) == len(to_addrs):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    code, resp = server.docmd('data')
+    if code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    if session is not None:
+        session.in_data = True
+    for chunk in chunks:
+        server.send(chunk)
+    server.send(b'.\r\n')
+    code, resp = server.getreply()
+    if session is not None:
+        session.in_data = False
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(host, port, username=None, password=None, use_tls=True):
+    """Return the process-wide pool for the given SMTP account, creating it on first use"""
+    key = (host, port, username, password, use_tls)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = SMTPConnectionPool(
+                host,
+                port,
+                username=username,
+                password=password,
+                use_tls=use_tls,
+                size=getattr(settings, 'EMAIL_SMTP_POOL_SIZE', 4),
+                idle_timeout=getattr(settings, 'EMAIL_SMTP_POOL_IDLE_TIMEOUT', 60),
+                max_messages=getattr(settings, 'EMAIL_SMTP_POOL_MAX_MESSAGES', 100),
+                healthcheck_interval=getattr(settings, 'EMAIL_SMTP_POOL_HEALTHCHECK_INTERVAL', 5),
+                timeout=getattr(settings, 'EMAIL_TIMEOUT', None) or 30,
+            )
+            _pools[key] = pool
+        return pool
+
+
+def close_smtp_pools():
+    """Close and forget every pool in this process"""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _forget_pools_after_fork():
+    """Drop pools inherited by a forked child without touching the parent's sockets"""
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    _pools.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_pools_after_fork)
@@ -0,0 +1,181 @@
+# email_app/sso.py
+import base64
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from .metrics import SSO_VALIDATIONS
+
+# Separates SSO signatures from every other use of the same secret
+KEY_SALT = 'email_app.sso.roundcube'
+
+
+class InvalidToken(ValueError):
+    """Raised for an SSO token that is malformed, forged, expired or already used"""
+
+
+class ReplayCache:
+    """
+    Bounded in-process record of used token ids.
+
+    Every entry lives for the token lifetime, so insertion order is expiry
+    order and expired ids are dropped from the front in O(1) each. When
+    ``max_entries`` unexpired ids are held, ``add`` refuses rather than
+    forgetting one that could then be replayed. Only covers one process; use
+    a shared Django cache when validation requests reach several workers.
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key, value, timeout):
+        """Record ``key`` for ``timeout`` seconds; False when it is already recorded (like ``cache.add``)"""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries
+            while entries:
+                oldest, expires = next(iter(entries.items()))
+                if expires > now:
+                    break
+                del entries[oldest]
+            if key in entries or len(entries) >= self.max_entries:
+                return False
+            entries[key] = now + timeout
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def configured_keys():
+    """
+    ``{key_id: secret}`` from ROUNDCUBE_SSO_KEYS, the first entry signing
+    and the rest only verifying, or SECRET_KEY and SECRET_KEY_FALLBACKS.
+    """
+    keys = getattr(settings, 'ROUNDCUBE_SSO_KEYS', None)
+    if keys:
+        return dict(keys)
+    fallbacks = getattr(settings, 'SECRET_KEY_FALLBACKS', [])
+    return {'s0': settings.SECRET_KEY, **{f's{i}': key for i, key in enumerate(fallbacks, 1)}}
+
+
+class SSOClaims:
+    """What a valid token asserts"""
+    __slots__ = ('email', 'redirect_to', 'expires')
+
+    def __init__(self, email, redirect_to, expires):
+        self.email = email
+        self.redirect_to = redirect_to
+        self.expires = expires
+
+
+class SSOTokenService:
+    """
+    Expiring, single-use RoundCube login tokens.
+
+    A token is ``<key id>.<claims>.<HMAC-SHA256>``, so issuing one is a JSON
+    dump and an HMAC, and checking one is a dict lookup for the key, an HMAC
+    and one ``add`` to the replay cache; nothing touches the database. Keys
+    rotate by putting a new key first in ROUNDCUBE_SSO_KEYS and dropping the
+    old one once its tokens have expired.
+    """
+
+    def __init__(self, keys=None, ttl=None, replay_cache=None):
+        self.keys = keys or configured_keys()
+        self.signing_key_id = next(iter(self.keys))
+        self.ttl = ttl or getattr(settings, 'ROUNDCUBE_SSO_TOKEN_TTL', 60)
+        if replay_cache is None:
+            alias = getattr(settings, 'ROUNDCUBE_SSO_REPLAY_CACHE', None)
+            replay_cache = caches[alias] if alias else ReplayCache()
+        self.replay_cache = replay_cache
+
+    def _signature(self, key_id, claims):
+        return _b64encode(salted_hmac(KEY_SALT, f'{key_id}.{claims}', self.keys[key_id], algorithm='sha256').digest())
+
+    def issue(self, email, redirect_to=None):
+        """A token that logs ``email`` in once within ``ttl`` seconds"""
+        claims = _b64encode(json.dumps({
+            'sub': email,
+            'nxt': redirect_to,
+            'exp': int(time.time()) + self.ttl,
+            'jti': secrets.token_urlsafe(12),
+        }, separators=(',', ':')).encode())
+        return f'{self.signing_key_id}.{claims}.{self._signature(self.signing_key_id, claims)}'
+
+    def verify(self, token):
+        """Check ``token`` and mark it used; returns SSOClaims or raises InvalidToken"""
+        try:
+            key_id, claims, signature = token.split('.')
+        except (AttributeError, ValueError):
+            raise InvalidToken('Malformed token')
+        if key_id not in self.keys or not constant_time_compare(signature, self._signature(key_id, claims)):
+            raise InvalidToken('Bad signature')
+        try:
+            payload = json.loads(_b64decode(claims))
+            email, redirect_to, expires, token_id = payload['sub'], payload['nxt'], payload['exp'], payload['jti']
+        except (ValueError, TypeError, KeyError):
+            raise InvalidToken('Malformed token')
+        remaining = expires - time.time()
+        if remaining <= 0:
+            raise InvalidToken('Token expired')
+        if not self.replay_cache.add(f'roundcube-sso:{token_id}', 1, int(remaining) + 1):
+            raise InvalidToken('Token already used')
+        return SSOClaims(email, redirect_to, expires)
+
+
+def validate_token(token):
+    """``get_sso_service().verify`` that also counts outcomes for /metrics"""
+    try:
+        claims = get_sso_service().verify(token)
+    except InvalidToken as e:
+        SSO_VALIDATIONS.inc(outcome=str(e).lower().replace(' ', '_'))
+        raise
+    SSO_VALIDATIONS.inc(outcome='ok')
+    return claims
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_sso_service():
+    """Return the process-wide SSOTokenService configured from settings"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = SSOTokenService()
+        return _service
+
+
+def reset_sso_service():
+    global _service
+    with _service_lock:
+        _service = None
+
+
+def _forget_sso_service_after_fork():
+    # The in-process replay cache must not be shared with the parent
+    global _service, _service_lock
+    _service_lock = threading.Lock()
+    _service = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_sso_service_after_fork)
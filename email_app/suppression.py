@@ -0,0 +1,198 @@
+# email_app/suppression.py
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .metrics import SUPPRESSED_RECIPIENTS
+from .models import EmailRecipient, SuppressedAddress
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched per round trip while loading the filter
+LOAD_CHUNK_SIZE = 20000
+
+# Refreshes look back this far past the last one, so a row stamped before it
+# but committed after it (a concurrent bounce or admin edit) is not missed
+HIGH_WATER_OVERLAP = timedelta(seconds=60)
+
+
+class AllRecipientsSuppressed(ValueError):
+    """Raised when every recipient of a message is on the suppression list"""
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings.
+
+    Uses about 1.8 bytes per entry at a 0.1% false positive rate, against
+    well over 100 bytes per entry for a set of the same addresses. Each
+    lookup is one blake2b digest and ``hashes`` bit tests.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(int(capacity), 1)
+        self.size = max(int(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(first + i * step) % size for i in range(self.hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SuppressionList:
+    """
+    In-process view of SuppressedAddress for checking every send.
+
+    Addresses live in a Bloom filter, so a lookup is O(1) and memory stays
+    small with millions of rows. A filter hit is confirmed with one exact
+    query per message. Every ``refresh_interval`` seconds the rows created
+    since the last refresh, less ``overlap``, are loaded; rows seen on an
+    earlier pass are skipped. The filter is rebuilt every
+    ``rebuild_interval`` seconds, or once it holds more than its capacity,
+    which also drops deleted rows.
+    """
+
+    def __init__(self, refresh_interval=None, rebuild_interval=None, error_rate=None, overlap=HIGH_WATER_OVERLAP):
+        self.refresh_interval = refresh_interval or getattr(settings, 'EMAIL_SUPPRESSION_REFRESH_INTERVAL', 5)
+        self.rebuild_interval = rebuild_interval or getattr(settings, 'EMAIL_SUPPRESSION_REBUILD_INTERVAL', 3600)
+        self.error_rate = error_rate or getattr(settings, 'EMAIL_SUPPRESSION_ERROR_RATE', 0.001)
+        self.overlap = overlap
+        self._filter = None
+        self._mark = None
+        # pk -> created_at of the loaded rows a refresh can see again
+        self._recent = {}
+        self._next_refresh = 0.0
+        self._next_rebuild = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self, bloom, queryset):
+        """Add ``queryset``'s rows not loaded yet and move the created_at mark to now"""
+        mark = timezone.now()
+        since = mark - self.overlap
+        rows = queryset.values_list('pk', 'address', 'created_at').iterator(chunk_size=LOAD_CHUNK_SIZE)
+        for pk, address, created_at in rows:
+            if pk in self._recent:
+                continue
+            bloom.add(address)
+            if created_at >= since:
+                self._recent[pk] = created_at
+        self._recent = {pk: created_at for pk, created_at in self._recent.items() if created_at >= since}
+        self._mark = mark
+
+    def refresh(self, force=False):
+        """Load new rows when the refresh interval has passed, rebuilding when due"""
+        now = time.monotonic()
+        if not force and now < self._next_refresh:
+            return
+        # Only the first load makes senders wait; later ones skip while another thread refreshes
+        if not self._lock.acquire(blocking=self._filter is None or force):
+            return
+        try:
+            if not force and now < self._next_refresh:
+                return
+            bloom = self._filter
+            if bloom is None or now >= self._next_rebuild or bloom.count > bloom.capacity:
+                count = SuppressedAddress.objects.count()
+                bloom = BloomFilter(max(count * 2, 1024), self.error_rate)
+                self._recent = {}
+                self._load(bloom, SuppressedAddress.objects.order_by('pk'))
+                self._filter = bloom
+                self._next_rebuild = now + self.rebuild_interval
+            else:
+                self._load(bloom, SuppressedAddress.objects.filter(created_at__gte=self._mark - self.overlap))
+            self._next_refresh = now + self.refresh_interval
+        finally:
+            self._lock.release()
+
+    def split(self, addresses):
+        """``(allowed, suppressed)`` lists for ``addresses``, in their original order"""
+        self.refresh()
+        bloom = self._filter
+        normalized = [EmailRecipient.normalize(address) for address in addresses]
+        candidates = [address for address in normalized if address in bloom]
+        if not candidates:
+            return list(addresses), []
+        suppressed = set(
+            SuppressedAddress.objects.filter(address__in=candidates).values_list('address', flat=True)
+        )
+        allowed, rejected = [], []
+        for address, key in zip(addresses, normalized):
+            (rejected if key in suppressed else allowed).append(address)
+        return allowed, rejected
+
+
+def allowed_recipients(recipients, suppressed=None):
+    """
+    ``recipients`` (a string or a list) without suppressed addresses, which
+    are appended to the ``suppressed`` list when one is given.
+
+    Raises AllRecipientsSuppressed when nothing is left, so the send fails
+    as a permanent error without reaching the provider.
+    """
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    if not getattr(settings, 'EMAIL_SUPPRESSION_ENABLED', True):
+        return list(recipients)
+    allowed, rejected = get_suppression_list().split(recipients)
+    if rejected:
+        SUPPRESSED_RECIPIENTS.inc(len(rejected))
+        logger.info("Skipping suppressed recipients: %s", ', '.join(rejected))
+        if suppressed is not None:
+            suppressed.extend(rejected)
+    if not allowed:
+        raise AllRecipientsSuppressed(f"All recipients are suppressed: {', '.join(rejected)}")
+    return allowed
+
+
+_suppression_list = None
+_suppression_lock = threading.Lock()
+
+
+def get_suppression_list():
+    """Return the process-wide SuppressionList configured from settings"""
+    global _suppression_list
+    with _suppression_lock:
+        if _suppression_list is None:
+            _suppression_list = SuppressionList()
+        return _suppression_list
+
+
+def reset_suppression_list():
+    global _suppression_list
+    with _suppression_lock:
+        _suppression_list = None
+
+
+def _forget_suppression_list_after_fork():
+    global _suppression_list, _suppression_lock
+    _suppression_lock = threading.Lock()
+    _suppression_list = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_suppression_list_after_fork)
@@ -0,0 +1,120 @@
+# email_app/templating.py
+import threading
+from collections import OrderedDict
+from email.mime.text import MIMEText
+
+from django.conf import settings
+from django.template import Context, Template
+from django.template.base import TextNode
+
+from .services import build_mime_message
+
+
+def _is_static(template):
+    """True when a compiled template has no variables or tags to evaluate"""
+    return all(isinstance(node, TextNode) for node in template.nodelist)
+
+
+class CompiledEmailTemplate:
+    """
+    Subject, text and HTML templates compiled once and rendered per recipient.
+
+    Subject and text are rendered without autoescaping, HTML with it, the same
+    way send_campaign has always treated them. Parts without any merge fields
+    are rendered once and, for SMTP, MIME-encoded once; every message then
+    shares the same part.
+    """
+
+    def __init__(self, subject, text_body, html_body=None):
+        self.subject = Template(subject)
+        self.text = Template(text_body)
+        self.html = Template(html_body) if html_body else None
+
+        self._static_subject = self._render_static(self.subject, autoescape=False)
+        self._static_text = self._render_static(self.text, autoescape=False)
+        self._static_html = self._render_static(self.html, autoescape=True)
+        if self._static_subject is not None:
+            self._static_subject = self._static_subject.strip()
+
+        self._text_part = MIMEText(self._static_text, 'plain', 'utf-8') if self._static_text is not None else None
+        self._html_part = MIMEText(self._static_html, 'html', 'utf-8') if self._static_html is not None else None
+
+    @classmethod
+    def from_model(cls, template):
+        return cls(template.subject, template.text_body, template.html_body)
+
+    @staticmethod
+    def _render_static(template, autoescape):
+        if template is None or not _is_static(template):
+            return None
+        return template.render(Context(autoescape=autoescape))
+
+    def render_batch(self, contexts):
+        """
+        Yield ``(context, rendered)`` for each context dict, where ``rendered``
+        has ``subject``, ``body`` and ``html_body`` keys.
+
+        One Context per output type is reused for the whole batch; each
+        recipient's values are pushed onto it and popped again afterwards.
+        """
+        text_context = Context(autoescape=False)
+        html_context = Context()
+        for row in contexts:
+            with text_context.push(row):
+                subject = self._static_subject
+                if subject is None:
+                    subject = self.subject.render(text_context).strip()
+                body = self._static_text
+                if body is None:
+                    body = self.text.render(text_context)
+
+            html_body = self._static_html
+            if html_body is None and self.html is not None:
+                with html_context.push(row):
+                    html_body = self.html.render(html_context)
+
+            yield row, {'subject': subject, 'body': body, 'html_body': html_body}
+
+    def render(self, context):
+        """Render a single recipient; prefer ``render_batch`` for many"""
+        return next(self.render_batch([context]))[1]
+
+    def build_mime_message(self, sender, recipients, rendered):
+        """MIME message for one ``rendered`` result, reusing the pre-encoded static parts"""
+        return build_mime_message(
+            sender,
+            recipients,
+            rendered['subject'],
+            self._text_part or rendered['body'],
+            self._html_part or rendered['html_body'],
+        )
+
+
+_compiled = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def get_compiled_template(template):
+    """
+    Return the CompiledEmailTemplate for an EmailTemplate row, compiling it on
+    first use and again whenever its ``version`` changes.
+    """
+    max_entries = getattr(settings, 'EMAIL_TEMPLATE_CACHE_SIZE', 128)
+    with _compiled_lock:
+        entry = _compiled.get(template.pk)
+        if entry is not None and entry[0] == template.version:
+            _compiled.move_to_end(template.pk)
+            return entry[1]
+
+    compiled = CompiledEmailTemplate.from_model(template)
+    with _compiled_lock:
+        _compiled[template.pk] = (template.version, compiled)
+        _compiled.move_to_end(template.pk)
+        while len(_compiled) > max_entries:
+            _compiled.popitem(last=False)
+    return compiled
+
+
+def clear_compiled_templates():
+    with _compiled_lock:
+        _compiled.clear()
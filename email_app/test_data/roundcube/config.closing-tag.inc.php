@@ -0,0 +1,6 @@
+<?php
+$config["product_name"] = "Webmail \"Example\"";
+$config['default_host'] = 'localhost';
+$config['default_host'] = 'imap.example.com'; // the last assignment wins
+$config['max_message_size'] = '25M';
+?>
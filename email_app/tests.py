@@ -1,11 +1,102 @@
 # email_app/tests.py
-from django.test import TestCase, Client
+import asyncio
+import base64
+import http.server
+import importlib
+import io
+import json
+import logging
+import os
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+import tracemalloc
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from email import message_from_bytes
+from email.mime.text import MIMEText
+
+import dns.resolver
+import requests
+from azure.communication.email import EmailClient
+from azure.core.exceptions import HttpResponseError
+from azure.core.pipeline.transport import HttpTransport
+from azure.core.rest._requests_basic import RestRequestsTransportResponse
+from asgiref.sync import sync_to_async
+from django.apps import apps as django_apps
+from django.contrib import admin
+from django.contrib.admin import site as admin_site
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.core.management import call_command
+from django.core.validators import EmailValidator
+from django.db import connection
+from django.db.utils import ConnectionHandler
+from django.test.utils import CaptureQueriesContext
+from django.template import Context, Template
+from django.test import TestCase, Client, AsyncClient, override_settings, tag
 from django.urls import reverse
 from django.contrib.auth.models import User
-from unittest.mock import patch, MagicMock
+from django.utils import timezone
+from datetime import timedelta
+from unittest.mock import patch, MagicMock, AsyncMock, PropertyMock
+
+from .models import EmailMessage, EmailRecipient, EmailEvent, SuppressedAddress, EmailTemplate, DNSRecord, DNSDomainState, DNSAnswerHistory, RoundCubeAccount, EmailDailyStat, EmailDomainDailyStat
+from .services import AzureEmailService, DNSManager, StatusPolling, build_mime_message, get_operation_status
+from .smtp_pool import SMTPConnectionPool, close_smtp_pools
+from .attachments import Attachment
+from .results import SendResult, SendTimings
+from .throttling import (
+    AdaptiveConcurrencyLimiter, RateLimitTimeout, RetryBudget, TokenBucket, build_throttle, check_rate_limit_cache,
+    reset_throttle,
+)
+from .outbox import OutboxWorker
+from .reconciler import DeliveryReconciler, apply_delivery_reports
+from .dashboard import compute_dashboard, dashboard_stats, record_outcomes
+from .search import EstimatedCountPaginator, check_search_index, full_text_filter, has_search_index
+from .admin import SentAtProbeQuerySet
+from .roundcube_integration import RoundCubeIntegrator
+from .roundcube_config import PHPExpression, RoundCubeConfig, RoundCubeConfigFile
+from .roundcube_sync import RoundCubeUserSync
+from .sso import InvalidToken, ReplayCache, SSOTokenService, reset_sso_service
+from .recipients import clean_recipients, parse_recipients, summarize_recipients
+from .suppression import BloomFilter, SuppressionList, reset_suppression_list
+from .events import EventBuffer, get_event_buffer, parse_events, reset_event_buffer, write_events
+from .transports import CircuitBreaker, LatencyHistogram, Transport, TransportRouter, reset_transport_router
+from .history import encode_cursor, history_page, history_queryset
+from .templating import CompiledEmailTemplate, clear_compiled_templates, get_compiled_template
+from .dns_verification import DNSCache, DNSVerificationEngine, LookupResult
+from .dns_monitor import DNSMonitor, dns_drift_detected
+from .async_services import AsyncAzureEmailService
+from . import metrics
+from . import registry
+
+# Benchmarks are slow and machine-dependent, so they only run when asked
+# for: EMAIL_RUN_BENCHMARKS=1 manage.py test email_app --tag benchmark
+RUN_BENCHMARKS = bool(os.environ.get('EMAIL_RUN_BENCHMARKS'))
+
+benchmark_logger = logging.getLogger('email_app.benchmarks')
+if not benchmark_logger.handlers:
+    _handler = logging.StreamHandler()
+    # Clear of the test runner's progress dots
+    _handler.setFormatter(logging.Formatter('\n%(message)s'))
+    benchmark_logger.addHandler(_handler)
+    benchmark_logger.setLevel(logging.INFO)
+    benchmark_logger.propagate = False
+
+
+def benchmark(test_case):
+    """Tag ``test_case`` as a benchmark, skipped unless EMAIL_RUN_BENCHMARKS is set"""
+    return tag('benchmark')(unittest.skipUnless(RUN_BENCHMARKS, 'set EMAIL_RUN_BENCHMARKS=1 to run')(test_case))
+
+
+def report(message):
+    """Benchmark figures for whoever runs them; reported, never asserted"""
+    benchmark_logger.info(message)
 
-from .models import EmailMessage, DNSRecord
-from .services import AzureEmailService, DNSManager
 
 class AzureEmailServiceTests(TestCase):
     def setUp(self):
@@ -16,12 +107,15 @@ class AzureEmailServiceTests(TestCase):
             password='testpassword'
         )
     
+    def tearDown(self):
+        close_smtp_pools()
+    
     @patch('email_app.services.EmailClient')
     @patch('email_app.services.smtplib.SMTP')
     def test_send_email_smtp(self, mock_smtp, mock_email_client):
         # Mock SMTP server
         mock_server = MagicMock()
-        mock_smtp.return_value.__enter__.return_value = mock_server
+        mock_smtp.return_value = mock_server
         
         # Create service
         service = AzureEmailService()
@@ -41,80 +135,2151 @@ class AzureEmailServiceTests(TestCase):
             html_body='<p>This is a test email.</p>'
         )
         
-        # Assert SMTP was called correctly
-        mock_smtp.assert_called_once_with('test-smtp.example.com', 587)
-        mock_server.starttls.assert_called_once()
-        mock_server.login.assert_called_once_with('test-user', 'test-password')
-        mock_server.send_message.assert_called_once()
+        # Assert SMTP was called correctly
+        mock_smtp.assert_called_once_with('test-smtp.example.com', 587, timeout=30)
+        mock_server.starttls.assert_called_once()
+        mock_server.login.assert_called_once_with('test-user', 'test-password')
+        mock_server.send_message.assert_called_once()
+        
+        # Assert success
+        self.assertTrue(success)
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.services.smtplib.SMTP')
+    def test_send_email_smtp_reuses_pooled_session(self, mock_smtp, mock_email_client):
+        mock_server = MagicMock()
+        mock_smtp.return_value = mock_server
+        
+        service = AzureEmailService()
+        for i in range(3):
+            success, message = service.send_email(
+                sender='noreply@example.com',
+                recipients=['recipient@example.com'],
+                subject=f'Test Email {i}',
+                body='This is a test email.'
+            )
+            self.assertTrue(success)
+        
+        # One TCP/TLS/AUTH handshake for all three messages
+        self.assertEqual(mock_smtp.call_count, 1)
+        self.assertEqual(mock_server.login.call_count, 1)
+        self.assertEqual(mock_server.send_message.call_count, 3)
+    
+    @patch('email_app.services.EmailClient')
+    def test_send_email_direct_api(self, mock_email_client):
+        # Mock EmailClient
+        mock_client = MagicMock()
+        mock_email_client.from_connection_string.return_value = mock_client
+        
+        # Mock poller
+        mock_poller = MagicMock()
+        mock_result = MagicMock()
+        mock_result.message_id = 'test-message-id'
+        mock_poller.result.return_value = mock_result
+        mock_client.begin_send.return_value = mock_poller
+        
+        # Create service
+        service = AzureEmailService()
+        service.email_client = mock_client
+        
+        # Test sending an email
+        success, message = service.send_email_direct_api(
+            sender='noreply@example.com',
+            recipients='recipient@example.com',
+            subject='Test Email',
+            body='This is a test email.',
+            html_body='<p>This is a test email.</p>'
+        )
+        
+        # Assert API was called correctly
+        mock_client.begin_send.assert_called_once()
+        mock_poller.result.assert_called_once()
+        
+        # Assert success
+        self.assertTrue(success)
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.services.smtplib.SMTP')
+    def test_send_results_carry_message_id_and_timings(self, mock_smtp, mock_email_client):
+        mock_server = MagicMock()
+        mock_smtp.return_value = mock_server
+        service = AzureEmailService()
+        
+        first = service.send_email('noreply@example.com', 'one@example.com', 'First', 'Body')
+        second = service.send_email('noreply@example.com', 'one@example.com', 'Second', 'Body')
+        
+        self.assertTrue(first.success)
+        self.assertEqual(first.transport, 'smtp')
+        self.assertRegex(first.message_id, r'^<.+@example\.com>$')
+        self.assertEqual(mock_server.send_message.call_args_list[0].args[0]['Message-ID'], first.message_id)
+        for phase in ('connect', 'tls', 'auth', 'submit', 'total'):
+            self.assertIsNotNone(getattr(first.timings, phase), phase)
+        # The second message reuses the pooled session, so there is no handshake to time
+        self.assertIsNone(second.timings.connect)
+        self.assertIsNone(second.timings.auth)
+        self.assertIsNotNone(second.timings.submit)
+        self.assertNotEqual(first.message_id, second.message_id)
+        
+        mock_server.send_message.side_effect = smtplib.SMTPRecipientsRefused(
+            {'nobody@example.com': (550, b'No such user')}
+        )
+        refused = service.send_email('noreply@example.com', 'nobody@example.com', 'Third', 'Body')
+        self.assertFalse(refused.success)
+        self.assertEqual(refused.error_class, 'SMTPRecipientsRefused')
+        self.assertFalse(refused.retryable)
+        # Still unpacks like the old (success, message) tuple
+        success, message = refused
+        self.assertIn('Failed to send email', message)
+        
+        mock_server.send_message.side_effect = smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+        dropped = service.send_email('noreply@example.com', 'one@example.com', 'Fourth', 'Body')
+        self.assertEqual(dropped.error_class, 'SMTPServerDisconnected')
+        self.assertTrue(dropped.retryable)
+        
+        mock_client = mock_email_client.from_connection_string.return_value
+        mock_client.begin_send.return_value.result.return_value = {'id': 'api-message-id'}
+        sent = service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Fifth', 'Body')
+        self.assertEqual(sent.message_id, 'api-message-id')
+        self.assertEqual(sent.transport, 'api')
+        self.assertIsNotNone(sent.timings.submit)
+        
+        mock_client.begin_send.side_effect = http_error(400)
+        rejected = service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Sixth', 'Body')
+        self.assertEqual(rejected.error_class, 'HttpResponseError')
+        self.assertFalse(rejected.retryable)
+
+    
+    @patch('email_app.services.EmailClient')
+    def test_send_bulk_bounded_concurrency(self, mock_email_client):
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'peak': 0, 'consumed': 0}
+        
+        def begin_send(message, **kwargs):
+            with lock:
+                state['in_flight'] += 1
+                state['peak'] = max(state['peak'], state['in_flight'])
+            poller = MagicMock()
+            
+            def result():
+                time.sleep(0.01)
+                with lock:
+                    state['in_flight'] -= 1
+                if message['recipients']['to'][0]['address'] == 'fail@example.com':
+                    raise RuntimeError('rejected')
+                return {'id': message['recipients']['to'][0]['address'], 'status': 'Succeeded'}
+            
+            poller.result.side_effect = result
+            return poller
+        
+        mock_client = MagicMock()
+        mock_client.begin_send.side_effect = begin_send
+        mock_email_client.from_connection_string.return_value = mock_client
+        
+        def messages():
+            for i in range(40):
+                state['consumed'] += 1
+                address = 'fail@example.com' if i == 7 else f'user{i}@example.com'
+                yield {
+                    'sender': 'noreply@example.com',
+                    'recipients': [address],
+                    'subject': 'Bulk',
+                    'body': 'Hello'
+                }
+        
+        service = AzureEmailService()
+        results = service.send_bulk(messages(), concurrency=5)
+        
+        # The input is pulled lazily, one window at a time
+        first = next(results)
+        self.assertLessEqual(state['consumed'], 6)
+        
+        outcomes = [first] + list(results)
+        self.assertEqual(len(outcomes), 40)
+        self.assertLessEqual(state['peak'], 5)
+        failures = [message for message, result in outcomes if not result.success]
+        self.assertEqual([m['recipients'] for m in failures], [['fail@example.com']])
+
+
+class AttachmentTests(TestCase):
+    def tearDown(self):
+        close_smtp_pools()
+    
+    def make_file(self, size):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.unlink, f.name)
+        with f:
+            block = os.urandom(64 * 1024)
+            for _ in range(size // len(block)):
+                f.write(block)
+            f.write(block[:size % len(block)])
+        return f.name
+    
+    def mock_data_server(self, mock_smtp, sink):
+        mock_server = MagicMock()
+        mock_server.mail.return_value = (250, b'OK')
+        mock_server.rcpt.return_value = (250, b'OK')
+        mock_server.docmd.return_value = (354, b'Go ahead')
+        mock_server.getreply.return_value = (250, b'Queued')
+        # A plain function, so the mock does not keep every chunk in call_args_list
+        mock_server.send = sink
+        mock_smtp.return_value = mock_server
+        return mock_server
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_smtp_streams_attachments_into_a_valid_message(self, mock_smtp, mock_email_client):
+        chunks = []
+        mock_server = self.mock_data_server(mock_smtp, chunks.append)
+        path = self.make_file(200 * 1024 + 7)
+        with open(path, 'rb') as f:
+            on_disk = f.read()
+        in_memory = Attachment.from_stream(io.BytesIO(b'col\n1\n'), 'report.csv')
+        
+        success, message = AzureEmailService().send_email(
+            sender='noreply@example.com',
+            recipients=['one@example.com', 'two@example.com'],
+            subject='Report',
+            body='.hidden line\nSee attached.',
+            attachments=[Attachment.from_path(path, name='data.bin'), in_memory]
+        )
+        
+        self.assertTrue(success, message)
+        mock_server.send_message.assert_not_called()
+        self.assertEqual([c.args[0] for c in mock_server.rcpt.call_args_list], ['one@example.com', 'two@example.com'])
+        data = b''.join(chunks)
+        self.assertTrue(data.endswith(b'\r\n.\r\n'))
+        # Undo the dot-stuffing the server would undo
+        parsed = message_from_bytes(data[:-3].replace(b'\r\n..', b'\r\n.'))
+        parts = [part for part in parsed.walk() if part.get_filename()]
+        self.assertEqual([part.get_filename() for part in parts], ['data.bin', 'report.csv'])
+        self.assertEqual(parts[0].get_payload(decode=True), on_disk)
+        self.assertEqual(parts[1].get_payload(decode=True), b'col\n1\n')
+        self.assertEqual(parts[1].get_content_type(), 'text/csv')
+        self.assertIn('.hidden line', parsed.get_payload(0).get_payload(0).get_payload())
+    
+    @override_settings(EMAIL_MAX_ATTACHMENTS_SIZE=30 * 1024 * 1024)
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_smtp_memory_stays_bounded_for_large_attachments(self, mock_smtp, mock_email_client):
+        sent = {'bytes': 0}
+        self.mock_data_server(mock_smtp, lambda chunk: sent.__setitem__('bytes', sent['bytes'] + len(chunk)))
+        attachment = Attachment.from_path(self.make_file(25 * 1024 * 1024))
+        service = AzureEmailService()
+        
+        tracemalloc.start()
+        try:
+            success, message = service.send_email(
+                'noreply@example.com', 'one@example.com', 'Big', 'Body', attachments=[attachment]
+            )
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        
+        self.assertTrue(success, message)
+        self.assertGreater(sent['bytes'], 25 * 1024 * 1024 * 4 // 3)
+        self.assertLess(peak, 2 * 1024 * 1024)
+    
+    @patch('email_app.services.EmailClient')
+    def test_bulk_direct_api_encodes_shared_attachment_once(self, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        mock_client.begin_send.return_value.result.return_value = {'id': 'test-message-id', 'status': 'Succeeded'}
+        content = os.urandom(100 * 1024)
+        attachment = Attachment.from_stream(io.BytesIO(content), 'terms.pdf')
+        
+        with patch.object(attachment, 'blocks', wraps=attachment.blocks) as blocks:
+            outcomes = list(AzureEmailService().send_bulk(
+                (
+                    {'sender': 'noreply@example.com', 'recipients': [f'user{i}@example.com'],
+                     'subject': 'Terms', 'body': 'Attached', 'attachments': [attachment]}
+                    for i in range(10)
+                ),
+                concurrency=4
+            ))
+        
+        self.assertTrue(all(result.success for _, result in outcomes))
+        self.assertEqual(blocks.call_count, 1)
+        payloads = [c.args[0]['attachments'] for c in mock_client.begin_send.call_args_list]
+        self.assertEqual(len(payloads), 10)
+        self.assertEqual(payloads[0], [{
+            'name': 'terms.pdf',
+            'contentType': 'application/pdf',
+            'contentInBase64': base64.b64encode(content).decode('ascii'),
+        }])
+    
+    @override_settings(EMAIL_MAX_ATTACHMENTS_SIZE=1024)
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_size_limit_is_enforced_before_the_provider_is_called(self, mock_smtp, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        attachments = [Attachment.from_stream(io.BytesIO(b'x' * 600), f'part{i}.txt') for i in range(2)]
+        service = AzureEmailService()
+        
+        success, message = service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Big', 'Body',
+                                                         attachments=attachments)
+        self.assertFalse(success)
+        self.assertIn('over the 1024 byte limit', message)
+        
+        success, message = service.send_email('noreply@example.com', 'one@example.com', 'Big', 'Body',
+                                              attachments=attachments)
+        self.assertFalse(success)
+        mock_client.begin_send.assert_not_called()
+        mock_smtp.assert_not_called()
+
+
+def http_error(status_code, headers=None):
+    response = MagicMock()
+    response.status_code = status_code
+    response.reason = 'Too Many Requests' if status_code == 429 else 'Error'
+    response.headers = headers or {}
+    return HttpResponseError(response=response)
+
+
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        reset_throttle()
+        self.addCleanup(reset_throttle)
+        self.addCleanup(close_smtp_pools)
+        sleeper = patch('email_app.throttling.time.sleep')
+        self.sleep = sleeper.start()
+        self.addCleanup(sleeper.stop)
+    
+    @patch('email_app.services.EmailClient')
+    def test_direct_api_retries_429_and_backs_off(self, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        poller = MagicMock()
+        poller.result.return_value = {'id': 'test-message-id', 'status': 'Succeeded'}
+        mock_client.begin_send.side_effect = [http_error(429, {'Retry-After': '2'}), poller]
+        service = AzureEmailService()
+        limit_before = service.throttle.limiter.limit
+        
+        success, message = service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        
+        self.assertTrue(success, message)
+        self.assertEqual(mock_client.begin_send.call_count, 2)
+        first, second = mock_client.begin_send.call_args_list
+        # Same operation id on the retry so the service can deduplicate it
+        self.assertEqual(first.kwargs['operation_id'], second.kwargs['operation_id'])
+        self.assertEqual(first.kwargs['retry_total'], 0)
+        self.assertGreaterEqual(self.sleep.call_args.args[0], 2)
+        self.assertLess(service.throttle.limiter.limit, limit_before)
+    
+    @patch('email_app.services.EmailClient')
+    def test_non_retryable_errors_fail_immediately(self, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        mock_client.begin_send.side_effect = http_error(400)
+        
+        success, message = AzureEmailService().send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        
+        self.assertFalse(success)
+        self.assertTrue(message.startswith('Failed to send email via direct API'))
+        self.assertEqual(mock_client.begin_send.call_count, 1)
+        self.sleep.assert_not_called()
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_smtp_throttling_reply_is_retried(self, mock_smtp, mock_email_client):
+        mock_server = mock_smtp.return_value
+        mock_server.send_message.side_effect = [
+            smtplib.SMTPDataError(451, b'4.7.500 Server busy, try again later'),
+            {},
+        ]
+        mock_server.rset.return_value = (250, b'OK')
+        
+        success, message = AzureEmailService().send_email('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        
+        self.assertTrue(success, message)
+        self.assertEqual(mock_server.send_message.call_count, 2)
+        # Retried over the same pooled session
+        self.assertEqual(mock_smtp.call_count, 1)
+    
+    def test_token_bucket_spends_burst_then_paces(self):
+        bucket = TokenBucket('test-bucket', rate=10, burst=2, cache=LocMemCache('throttle-test', {}))
+        now = [1000.0]
+        with patch('email_app.throttling.time.time', side_effect=lambda: now[0]):
+            self.assertEqual([bucket.reserve() for _ in range(2)], [0.0, 0.0])
+            self.assertAlmostEqual(bucket.reserve(), 0.1)
+            self.assertAlmostEqual(bucket.reserve(), 0.2)
+            
+            # A long idle period banks no more than the burst
+            now[0] += 3600
+            self.assertEqual([bucket.reserve() for _ in range(2)], [0.0, 0.0])
+            self.assertAlmostEqual(bucket.reserve(), 0.1)
+            
+            # Retry-After pauses every caller sharing the bucket
+            bucket.pause(5)
+            self.assertAlmostEqual(bucket.reserve(), 5.0)
+    
+    def test_token_bucket_gives_back_reservations_on_timeout(self):
+        bucket = TokenBucket('timeout-bucket', rate=1, burst=1, cache=LocMemCache('throttle-timeout-test', {}))
+        now = [1000.0]
+        with patch('email_app.throttling.time.time', side_effect=lambda: now[0]):
+            bucket.acquire()
+            for _ in range(5):
+                with self.assertRaises(RateLimitTimeout):
+                    bucket.acquire(timeout=0.5)
+            # The refused callers took nothing: the next token is one interval away, not six
+            self.assertAlmostEqual(bucket.reserve(), 1.0)
+    
+    def test_token_bucket_skips_idle_time_once(self):
+        cache = LocMemCache('throttle-skip-test', {})
+        first = TokenBucket('shared-bucket', rate=10, burst=2, cache=cache)
+        second = TokenBucket('shared-bucket', rate=10, burst=2, cache=cache)
+        now = [1000.0]
+        with patch('email_app.throttling.time.time', side_effect=lambda: now[0]):
+            first.reserve()
+            now[0] += 3600
+            # Two processes waking from the same idle spell
+            self.assertEqual([first.reserve(), second.reserve()], [0.0, 0.0])
+            self.assertAlmostEqual(first.reserve(), 0.1)
+            self.assertAlmostEqual(second.reserve(), 0.2)
+    
+    @override_settings(EMAIL_RATE_LIMIT_PER_SECOND=10, EMAIL_RATE_LIMIT_CACHE='default')
+    def test_rate_limit_cache_must_be_shared(self):
+        self.assertEqual([warning.id for warning in check_rate_limit_cache()], ['email_app.W001'])
+        with self.assertLogs('email_app.throttling', 'WARNING'):
+            build_throttle()
+    
+    @patch('email_app.async_services.AsyncEmailClient')
+    def test_async_sends_use_the_throttle(self, mock_email_client):
+        mock_email_client.from_connection_string.side_effect = lambda conn_str: make_async_email_client()
+        bucket = MagicMock()
+        bucket.aacquire = AsyncMock(return_value=0)
+        with override_settings(EMAIL_RATE_LIMIT_PER_SECOND=None):
+            service = AsyncAzureEmailService()
+        service.throttle.bucket = bucket
+        
+        success, message = asyncio.run(service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body'))
+        
+        self.assertTrue(success, message)
+        bucket.aacquire.assert_awaited_once()
+        self.assertEqual(service.throttle.limiter.in_flight, 0)
+    
+    def test_aimd_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4, minimum=1, maximum=6, cooldown=60)
+        limiter.on_throttle()
+        limiter.on_throttle()
+        # One decrease per cooldown, however many 429s arrive together
+        self.assertEqual(limiter.limit, 2)
+        for _ in range(10):
+            limiter.on_success()
+        self.assertGreater(limiter.limit, 4)
+        self.assertLessEqual(limiter.limit, 6)
+        
+        limiter = AdaptiveConcurrencyLimiter(initial=1)
+        with limiter.slot():
+            with self.assertRaises(RateLimitTimeout):
+                with limiter.slot(timeout=0.01):
+                    pass
+    
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.1, min_per_second=0, window=10)
+        for _ in range(20):
+            budget.record_request()
+        self.assertEqual([budget.try_retry() for _ in range(3)], [True, True, False])
+
+
+class FakeTransport(Transport):
+    """Local transport that injects latency and failures"""
+    kind = 'fake'
+    
+    def __init__(self, name, latency=0, error=None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.latency = latency
+        self.error = error
+        self.delivered = []
+        self._lock = threading.Lock()
+    
+    def deliver(self, sender, recipients, subject, body, html_body=None, attachments=None, timings=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.error is not None:
+            raise self.error
+        with self._lock:
+            self.delivered.append(subject)
+            message_id = f'{self.name}-{len(self.delivered)}'
+        return SendResult.sent(f"Email sent successfully via {self.name}", self.name, message_id, timings)
+
+
+class TransportRouterTests(TestCase):
+    def breaker(self, **kwargs):
+        options = {'window': 60, 'min_calls': 3, 'failure_rate': 0.5, 'slow_call_seconds': 10, 'open_seconds': 30}
+        options.update(kwargs)
+        return lambda: CircuitBreaker(**options)
+    
+    def send(self, router, count, concurrency=1):
+        def send_one(i):
+            return router.send('noreply@example.com', ['user@example.com'], f'Message {i}', 'Body')
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            return list(executor.map(send_one, range(count)))
+    
+    def test_weighted_least_outstanding_spreads_concurrent_load(self):
+        heavy = FakeTransport('heavy', latency=0.01, weight=2)
+        light = FakeTransport('light', latency=0.01)
+        other = FakeTransport('other', latency=0.01)
+        router = TransportRouter([heavy, light, other], breaker_factory=self.breaker())
+        
+        results = self.send(router, 80, concurrency=8)
+        
+        self.assertTrue(all(success for success, _ in results))
+        self.assertEqual(len(heavy.delivered) + len(light.delivered) + len(other.delivered), 80)
+        self.assertGreater(len(light.delivered), 0)
+        self.assertGreater(len(other.delivered), 0)
+        self.assertGreater(len(heavy.delivered), max(len(light.delivered), len(other.delivered)))
+        stats = router.stats()
+        self.assertEqual(stats['heavy']['outstanding'], 0)
+        self.assertEqual(stats['heavy']['latency']['count'], len(heavy.delivered))
+        self.assertGreaterEqual(stats['heavy']['p50'], 0.01)
+    
+    def test_failing_transport_fails_over_and_opens_its_breaker(self):
+        broken = FakeTransport('broken', error=ConnectionRefusedError('Connection refused'))
+        healthy = FakeTransport('healthy')
+        router = TransportRouter([broken, healthy], breaker_factory=self.breaker())
+        
+        results = self.send(router, 20)
+        
+        self.assertTrue(all(success for success, _ in results))
+        self.assertEqual(len(healthy.delivered), 20)
+        stats = router.stats()
+        self.assertEqual(stats['broken']['state'], CircuitBreaker.OPEN)
+        # Once open, the broken transport is no longer tried
+        self.assertEqual(stats['broken']['failed'], 3)
+        self.assertEqual(stats['healthy']['state'], CircuitBreaker.CLOSED)
+    
+    def test_latency_spike_opens_breaker(self):
+        slow = FakeTransport('slow', latency=0.02)
+        fast = FakeTransport('fast')
+        router = TransportRouter([slow, fast], breaker_factory=self.breaker(slow_call_seconds=0.01))
+        
+        self.send(router, 20)
+        
+        stats = router.stats()
+        self.assertEqual(stats['slow']['state'], CircuitBreaker.OPEN)
+        self.assertEqual(stats['slow']['failed'], 0)
+        self.assertEqual(len(slow.delivered), 3)
+        self.assertEqual(len(fast.delivered), 17)
+    
+    def test_message_errors_do_not_fail_over(self):
+        refused = smtplib.SMTPRecipientsRefused({'user@example.com': (550, b'No such user')})
+        first = FakeTransport('first', error=refused)
+        second = FakeTransport('second', error=refused)
+        router = TransportRouter([first, second], breaker_factory=self.breaker())
+        
+        results = self.send(router, 5)
+        
+        self.assertFalse(any(success for success, _ in results))
+        stats = router.stats()
+        self.assertEqual(stats['first']['failed'] + stats['second']['failed'], 5)
+        self.assertEqual(stats['first']['state'], CircuitBreaker.CLOSED)
+        self.assertEqual(stats['second']['state'], CircuitBreaker.CLOSED)
+    
+    def test_all_transports_down(self):
+        router = TransportRouter(
+            [FakeTransport('only', error=ConnectionResetError('reset'))],
+            breaker_factory=self.breaker(),
+        )
+        results = self.send(router, 4)
+        
+        self.assertIn('last error from only: reset', results[0].detail)
+        self.assertEqual(results[0].error_class, 'ConnectionResetError')
+        self.assertTrue(results[0].retryable)
+        self.assertIn('every circuit breaker is open', results[3].detail)
+        self.assertEqual(results[3].error_class, 'CircuitOpen')
+    
+    def test_breaker_half_open_probe(self):
+        breaker = CircuitBreaker(window=60, min_calls=2, failure_rate=0.5, slow_call_seconds=1, open_seconds=30)
+        breaker.record(100, False, 0.1)
+        breaker.record(101, False, 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.available(120))
+        
+        # One probe after the open period; a failed probe opens it again
+        self.assertTrue(breaker.available(131))
+        probe = breaker.begin(131)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.available(131))
+        breaker.record(132, False, 0.1, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+        probe = breaker.begin(162)
+        breaker.record(162, True, 0.1, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.available(162))
+    
+    def test_breaker_ignores_calls_that_started_before_the_probe(self):
+        breaker = CircuitBreaker(window=60, min_calls=2, failure_rate=0.5, slow_call_seconds=1, open_seconds=30)
+        self.assertIsNone(breaker.begin(99))
+        breaker.record(100, False, 0.1)
+        breaker.record(101, False, 0.1)
+        probe = breaker.begin(131)
+        
+        # The call begun at 99 finishes while the probe is out
+        breaker.record(132, True, 0.1)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.available(132))
+        
+        breaker.record(133, False, 0.1, probe)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+    
+    def test_latency_histogram_percentiles(self):
+        histogram = LatencyHistogram()
+        self.assertIsNone(histogram.percentile(0.5))
+        for seconds in [0.004] * 90 + [0.2] * 9 + [45]:
+            histogram.observe(seconds)
+        
+        self.assertEqual(histogram.percentile(0.5), 0.005)
+        self.assertEqual(histogram.percentile(0.95), 0.25)
+        self.assertEqual(histogram.percentile(1.0), 60.0)
+        self.assertEqual(histogram.snapshot()['count'], 100)
+    
+    @override_settings(EMAIL_RATE_LIMIT_PER_SECOND=10)
+    def test_transports_share_the_rate_limit_unless_given_their_own(self):
+        first = FakeTransport('relay-1')
+        second = FakeTransport('relay-2')
+        separate = FakeTransport('acs-westeurope', rate=50, burst=5)
+        
+        # Adding a transport must not add quota
+        self.assertEqual(first.throttle.bucket.name, 'azure-email')
+        self.assertEqual(second.throttle.bucket.name, 'azure-email')
+        self.assertEqual(first.throttle.bucket.rate, 10)
+        self.assertEqual(separate.throttle.bucket.name, 'transport:acs-westeurope')
+        self.assertEqual((separate.throttle.bucket.rate, separate.throttle.bucket.burst), (50, 5))
+        self.assertEqual(first.throttle.max_attempts, 2)
+    
+    @override_settings(EMAIL_TRANSPORTS=[
+        {'type': 'email_app.tests.FakeTransport', 'name': 'relay-1'},
+        {'type': 'email_app.tests.FakeTransport', 'name': 'relay-2'},
+    ])
+    def test_outbox_sends_through_configured_router(self):
+        reset_transport_router()
+        self.addCleanup(reset_transport_router)
+        user = User.objects.create_user(username='router', password='testpassword')
+        for i in range(4):
+            EmailMessage.objects.create(
+                sender='noreply@example.com',
+                recipients='one@example.com',
+                subject=f'Routed {i}',
+                body='Body',
+                status='QUEUED',
+                use_direct_api=bool(i % 2),
+                created_by=user
+            )
+        service = MagicMock()
+        
+        self.assertEqual(OutboxWorker(worker_id='worker-1', service=service).run_once(), 4)
+        
+        self.assertEqual(EmailMessage.objects.filter(status='SENT').count(), 4)
+        service.send_email.assert_not_called()
+        service.send_email_direct_api.assert_not_called()
+        stats = OutboxWorker().router.stats()
+        self.assertEqual(stats['relay-1']['sent'] + stats['relay-2']['sent'], 4)
+
+
+class ServiceRegistryTests(TestCase):
+    def setUp(self):
+        registry.reset_email_service()
+        self.addCleanup(registry.reset_email_service)
+    
+    @patch('email_app.services.EmailClient')
+    def test_service_is_reused_and_rebuilt_on_settings_change(self, mock_email_client):
+        first = registry.get_email_service()
+        self.assertIs(registry.get_email_service(), first)
+        
+        with override_settings(EMAIL_HOST='other-smtp.example.com'):
+            rebuilt = registry.get_email_service()
+        self.assertIsNot(rebuilt, first)
+        self.assertEqual(rebuilt.smtp_server, 'other-smtp.example.com')
+        self.assertEqual(mock_email_client.from_connection_string.call_count, 2)
+    
+    @patch('email_app.services.EmailClient')
+    def test_forked_child_builds_its_own_service(self, mock_email_client):
+        parent_service = registry.get_email_service()
+        
+        # Simulate what os.register_at_fork runs in the child
+        registry._forget_after_fork()
+        
+        self.assertIsNot(registry.get_email_service(), parent_service)
+    
+    @patch('email_app.services.EmailClient')
+    def test_connection_stats_show_keep_alive_reuse(self, mock_email_client):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+            
+            def log_message(self, *args):
+                pass
+        
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        
+        registry.get_email_service()
+        session = registry._state['session']
+        for _ in range(3):
+            session.get(f'http://127.0.0.1:{server.server_port}/')
+        
+        stats = registry.connection_stats()
+        self.assertEqual(stats['http_requests'], 3)
+        self.assertEqual(stats['http_connections'], 1)
+        self.assertEqual(stats['http_connections_reused'], 2)
+
+
+class SMTPConnectionPoolTests(TestCase):
+    def make_message(self):
+        message = MIMEText('body')
+        message['From'] = 'noreply@example.com'
+        message['To'] = 'recipient@example.com'
+        message['Subject'] = 'Pool test'
+        return message
+    
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_recycles_connection_after_max_messages(self, mock_smtp):
+        mock_smtp.side_effect = lambda *args, **kwargs: MagicMock()
+        pool = SMTPConnectionPool('smtp.example.com', 587, 'user', 'pass', max_messages=2)
+        
+        for _ in range(5):
+            pool.send_message(self.make_message())
+        
+        # 5 messages at 2 per session needs 3 sessions
+        self.assertEqual(mock_smtp.call_count, 3)
+        self.assertEqual(pool.connections_opened, 3)
+        self.assertEqual(pool.connections_reused, 2)
+    
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_reconnects_when_server_disconnected(self, mock_smtp):
+        stale_server = MagicMock()
+        stale_server.send_message.side_effect = smtplib.SMTPServerDisconnected()
+        fresh_server = MagicMock()
+        mock_smtp.side_effect = [stale_server, fresh_server]
+        pool = SMTPConnectionPool('smtp.example.com', 587, 'user', 'pass')
+        
+        pool.send_message(self.make_message())
+        
+        fresh_server.send_message.assert_called_once()
+        self.assertEqual(pool.connections_opened, 2)
+    
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_noop_health_check_and_idle_timeout(self, mock_smtp):
+        first_server = MagicMock()
+        first_server.noop.return_value = (421, b'closing')
+        second_server = MagicMock()
+        mock_smtp.side_effect = [first_server, second_server, MagicMock()]
+        pool = SMTPConnectionPool(
+            'smtp.example.com', 587, 'user', 'pass',
+            idle_timeout=60, healthcheck_interval=0
+        )
+        
+        pool.send_message(self.make_message())
+        pool.send_message(self.make_message())
+        
+        # The failed NOOP probe retires the first session
+        first_server.noop.assert_called_once()
+        second_server.send_message.assert_called_once()
+        
+        # Sessions idle past the timeout are dropped without probing
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        pool.send_message(self.make_message())
+        second_server.noop.assert_not_called()
+        self.assertEqual(pool.connections_opened, 3)
+    
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_failure_while_streaming_data_discards_session(self, mock_smtp):
+        broken_server = MagicMock()
+        broken_server.mail.return_value = (250, b'OK')
+        broken_server.rcpt.return_value = (250, b'OK')
+        broken_server.docmd.return_value = (354, b'Go ahead')
+        fresh_server = MagicMock()
+        mock_smtp.side_effect = [broken_server, fresh_server]
+        pool = SMTPConnectionPool('smtp.example.com', 587, 'user', 'pass')
+        
+        def render():
+            yield b'Subject: first\r\n\r\n'
+            raise UnicodeError('Bad attachment name')
+        
+        with self.assertRaises(UnicodeError):
+            pool.send_chunks('noreply@example.com', ['first@example.com'], render)
+        # Closed without RSET or QUIT, which would land in the half-sent body
+        broken_server.close.assert_called_once()
+        broken_server.rset.assert_not_called()
+        broken_server.quit.assert_not_called()
+        
+        pool.send_message(self.make_message())
+        fresh_server.send_message.assert_called_once()
+        broken_server.send_message.assert_not_called()
+        self.assertEqual(pool.connections_opened, 2)
+
+
+@benchmark
+class SMTPPoolBenchmark(TestCase):
+    """Compare per-message connections with the pool against a local SMTP stand-in"""
+    
+    MESSAGES = 200
+    
+    def setUp(self):
+        try:
+            from aiosmtpd.controller import Controller
+            from aiosmtpd.handlers import Sink
+        except ImportError:
+            self.skipTest('aiosmtpd is not installed')
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.controller = Controller(Sink(), hostname='127.0.0.1', port=self.port)
+        self.controller.start()
+    
+    def tearDown(self):
+        self.controller.stop()
+    
+    def make_message(self):
+        message = MIMEText('body')
+        message['From'] = 'noreply@example.com'
+        message['To'] = 'recipient@example.com'
+        message['Subject'] = 'Benchmark'
+        return message
+    
+    def test_pooled_throughput(self):
+        start = time.perf_counter()
+        for _ in range(self.MESSAGES):
+            with smtplib.SMTP('127.0.0.1', self.port) as server:
+                server.send_message(self.make_message())
+        unpooled = time.perf_counter() - start
+        
+        pool = SMTPConnectionPool('127.0.0.1', self.port, use_tls=False, max_messages=1000)
+        start = time.perf_counter()
+        for _ in range(self.MESSAGES):
+            pool.send_message(self.make_message())
+        pooled = time.perf_counter() - start
+        pool.close()
+        
+        report(f"SMTP {self.MESSAGES} messages: unpooled {self.MESSAGES / unpooled:.0f} msg/s, "
+               f"pooled {self.MESSAGES / pooled:.0f} msg/s")
+        self.assertEqual(pool.connections_opened, 1)
+
+
+def mx_rdata(preference, exchange):
+    rdata = MagicMock()
+    rdata.preference = preference
+    rdata.exchange = exchange
+    return rdata
+
+
+def txt_rdata(*strings):
+    rdata = MagicMock()
+    rdata.strings = list(strings)
+    return rdata
+
+
+class FakeAnswer(list):
+    def __init__(self, rdatas, ttl=300):
+        super().__init__(rdatas)
+        self.rrset = MagicMock()
+        self.rrset.ttl = ttl
+
+
+class FakeResolver:
+    """Stand-in for dns.asyncresolver.Resolver serving canned records"""
+    
+    def __init__(self, records, delay=0):
+        self.records = records
+        self.delay = delay
+        self.calls = []
+    
+    async def resolve(self, name, rdtype):
+        self.calls.append((name, rdtype))
+        await asyncio.sleep(self.delay)
+        if (name, rdtype) not in self.records:
+            raise dns.resolver.NXDOMAIN()
+        return self.records[(name, rdtype)]
+
+
+class DNSManagerTests(TestCase):
+    def test_verify_dns_records(self):
+        # Fake DNS answers for the domain
+        resolver = FakeResolver({
+            ('example.com', 'MX'): FakeAnswer([mx_rdata(10, 'mail.example.com.')]),
+            ('example.com', 'TXT'): FakeAnswer([txt_rdata(b'v=spf1 include:communication.azure.com -all')]),
+        })
+        
+        # Create DNS manager
+        manager = DNSManager()
+        manager.domain = 'example.com'
+        manager.engine = DNSVerificationEngine(resolver=resolver, cache=DNSCache())
+        
+        # Test verifying DNS records
+        success, results = manager.verify_dns_records()
+        
+        # Assert resolver was called for MX, SPF and DMARC
+        self.assertEqual(len(resolver.calls), 3)
+        
+        # Assert success
+        self.assertTrue(success)
+        self.assertTrue(any('MX records' in result for result in results))
+        self.assertTrue(any('SPF record' in result for result in results))
+        self.assertIn('No DMARC record found', results)
+
+
+class DNSVerificationEngineTests(TestCase):
+    def make_records(self, domains):
+        records = {}
+        for domain in domains:
+            records[(domain, 'MX')] = FakeAnswer([mx_rdata(20, f'mx2.{domain}.'), mx_rdata(10, f'mx1.{domain}.')])
+            records[(domain, 'TXT')] = FakeAnswer([txt_rdata(b'google-site-verification=x'), txt_rdata(b'v=spf1 ', b'-all')])
+            records[(f'_dmarc.{domain}', 'TXT')] = FakeAnswer([txt_rdata(b'v=DMARC1; p=reject')], ttl=60)
+            records[(f's1._domainkey.{domain}', 'TXT')] = FakeAnswer([txt_rdata(b'v=DKIM1; k=rsa; p=MIGf')])
+        return records
+    
+    def test_parses_all_record_types(self):
+        engine = DNSVerificationEngine(resolver=FakeResolver(self.make_records(['a.com'])), cache=DNSCache())
+        
+        report = engine.verify_domains(['a.com'], {'a.com': ['s1', 'missing']})['a.com']
+        
+        self.assertEqual(report.mx, [(10, 'mx1.a.com'), (20, 'mx2.a.com')])
+        self.assertEqual(report.spf, 'v=spf1 -all')
+        self.assertEqual(report.dmarc, 'v=DMARC1; p=reject')
+        self.assertEqual(report.dkim, {'s1': 'v=DKIM1; k=rsa; p=MIGf', 'missing': None})
+        self.assertTrue(all(result.latency_ms >= 0 for result in report.lookups.values()))
+    
+    def test_domains_are_resolved_concurrently(self):
+        domains = [f'tenant{i}.example.com' for i in range(200)]
+        resolver = FakeResolver(self.make_records(domains), delay=0.05)
+        engine = DNSVerificationEngine(resolver=resolver, cache=DNSCache(), concurrency=1000)
+        
+        start = time.perf_counter()
+        reports = engine.verify_domains(domains, ['s1'])
+        elapsed = time.perf_counter() - start
+        
+        # 800 lookups of 50 ms each would take 40 s one after the other
+        self.assertEqual(len(resolver.calls), 800)
+        self.assertLess(elapsed, 5)
+        self.assertTrue(all(report.spf for report in reports.values()))
+    
+    def test_cache_honours_ttl(self):
+        records = self.make_records(['a.com'])
+        records[('a.com', 'MX')].rrset.ttl = 0
+        resolver = FakeResolver(records)
+        engine = DNSVerificationEngine(resolver=resolver, cache=DNSCache(negative_ttl=60))
+        
+        engine.verify_domains(['a.com'], ['nope'])
+        engine.verify_domains(['a.com'], ['nope'])
+        
+        # Only the zero-TTL MX answer is fetched again; NXDOMAIN is cached too
+        self.assertEqual(len(resolver.calls), 5)
+        self.assertEqual(resolver.calls.count(('a.com', 'MX')), 2)
+        
+        with patch('email_app.dns_verification.time.monotonic', return_value=time.monotonic() + 120):
+            report = engine.verify_domains(['a.com'])['a.com']
+        self.assertFalse(report.lookups['DMARC'].cached)
+        self.assertTrue(report.lookups['TXT'].cached)
+
+
+class OutboxWorkerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+        self.service = MagicMock()
+        self.service.send_email.return_value = SendResult.sent('Email sent successfully', 'smtp', '<id@example.com>')
+        self.service.send_email_direct_api.return_value = SendResult.sent('Email sent successfully', 'api', 'api-id')
+    
+    def queue_email(self, **kwargs):
+        fields = {
+            'sender': 'noreply@example.com',
+            'recipients': 'one@example.com, two@example.com',
+            'subject': 'Queued Email',
+            'body': 'This is a test email.',
+            'status': 'QUEUED',
+            'created_by': self.user,
+        }
+        fields.update(kwargs)
+        email = EmailMessage.objects.create(**fields)
+        email.save_recipients()
+        return email
+    
+    def test_run_once_sends_queued_messages(self):
+        smtp_email = self.queue_email()
+        api_email = self.queue_email(use_direct_api=True)
+        worker = OutboxWorker(worker_id='worker-1', service=self.service)
+        
+        self.assertEqual(worker.run_once(), 2)
+        worker.close()
+        
+        self.service.send_email.assert_called_once_with(
+            'noreply@example.com',
+            ['one@example.com', 'two@example.com'],
+            'Queued Email',
+            'This is a test email.',
+            None
+        )
+        self.service.send_email_direct_api.assert_called_once()
+        for email in (smtp_email, api_email):
+            email.refresh_from_db()
+            self.assertEqual(email.status, 'SENT')
+            self.assertEqual(email.attempts, 1)
+            self.assertIsNone(email.locked_by)
+            self.assertEqual(
+                sorted(email.recipient_rows.values_list('address', 'status')),
+                [('one@example.com', 'SENT'), ('two@example.com', 'SENT')]
+            )
+    
+    def test_claim_skips_leased_and_future_messages(self):
+        self.queue_email(status='SENDING', locked_by='other', locked_until=timezone.now() + timedelta(minutes=5))
+        self.queue_email(next_attempt_at=timezone.now() + timedelta(minutes=5))
+        expired = self.queue_email(status='SENDING', locked_by='crashed', locked_until=timezone.now() - timedelta(seconds=1))
+        
+        first = OutboxWorker(worker_id='worker-1', service=self.service)
+        second = OutboxWorker(worker_id='worker-2', service=self.service)
+        
+        self.assertEqual([email.pk for email in first.claim_batch()], [expired.pk])
+        self.assertEqual(second.claim_batch(), [])
+    
+    def test_send_result_is_stored_on_the_message(self):
+        self.service.send_email.return_value = SendResult.sent(
+            'Email sent successfully', 'smtp', '<abc@example.com>',
+            SendTimings(connect=0.0123, tls=0.05, auth=0.02, submit=0.1, total=0.2)
+        )
+        email = self.queue_email()
+        worker = OutboxWorker(worker_id='worker-1', service=self.service)
+        
+        worker.run_once()
+        worker.close()
+        email.refresh_from_db()
+        self.assertEqual(email.provider_message_id, '<abc@example.com>')
+        self.assertEqual(email.transport, 'smtp')
+        self.assertEqual(
+            (email.connect_ms, email.tls_ms, email.auth_ms, email.submit_ms, email.total_ms),
+            (12, 50, 20, 100, 200)
+        )
+    
+    def test_permanent_failure_is_not_retried(self):
+        self.service.send_email.return_value = SendResult.failed(
+            smtplib.SMTPRecipientsRefused({'one@example.com': (550, b'No such user')}),
+            'Failed to send email: recipients refused',
+            transport='smtp'
+        )
+        email = self.queue_email()
+        worker = OutboxWorker(worker_id='worker-1', service=self.service, max_attempts=5)
+        
+        worker.run_once()
+        worker.close()
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'FAILED')
+        self.assertEqual(email.attempts, 1)
+        self.assertIsNone(email.next_attempt_at)
+    
+    def test_failed_send_is_retried_with_backoff_then_failed(self):
+        self.service.send_email.return_value = SendResult(
+            False, 'Failed to send email: 451 try later', 'SMTPDataError', retryable=True, transport='smtp'
+        )
+        email = self.queue_email()
+        worker = OutboxWorker(worker_id='worker-1', service=self.service, max_attempts=2)
+        
+        worker.run_once()
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'QUEUED')
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(email.error_message, 'Failed to send email: 451 try later')
+        
+        # Nothing is due until the backoff has elapsed
+        self.assertEqual(worker.run_once(), 0)
+        
+        EmailMessage.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+        worker.run_once()
+        worker.close()
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'FAILED')
+        self.assertEqual(email.attempts, 2)
+        self.assertEqual(set(email.recipient_rows.values_list('status', flat=True)), {'FAILED'})
+
+
+class RecipientParsingTests(TestCase):
+    def test_parse_normalises_validates_and_dedupes(self):
+        recipients = parse_recipients(
+            'Ann@Example.COM; ann@example.com, "Doe, Jane" <jane@Bücher.de>\n'
+            'Ann@example.com, bad@@example.com, nobody@localhost, ok@sub.example.com'
+        )
+        self.assertEqual(recipients.addresses, [
+            'Ann@example.com', 'ann@example.com', 'jane@xn--bcher-kva.de', 'ok@sub.example.com'
+        ])
+        self.assertEqual(recipients.invalid, ['bad@@example.com', 'nobody@localhost'])
+        self.assertEqual(recipients.duplicates, 1)
+        self.assertEqual(dict(recipients.by_domain), {
+            'example.com': ['Ann@example.com', 'ann@example.com'],
+            'xn--bcher-kva.de': ['jane@xn--bcher-kva.de'],
+            'sub.example.com': ['ok@sub.example.com'],
+        })
+        with self.assertRaisesMessage(ValidationError, 'bad@@example.com, nobody@localhost'):
+            recipients.require_valid()
+        self.assertEqual(clean_recipients(['x@Example.com', 'x@example.COM']), 'x@example.com')
+    
+    def test_summary_does_not_split_the_whole_list(self):
+        self.assertEqual(summarize_recipients('a@x.com'), 'a@x.com')
+        self.assertEqual(summarize_recipients('a@x.com, b@x.com'), 'a@x.com, b@x.com')
+        self.assertEqual(summarize_recipients('a@x.com,b@x.com,c@x.com,d@x.com'), 'a@x.com, b@x.com (+2 more)')
+    
+    def test_undeliverable_domains_use_one_mx_lookup_per_domain(self):
+        answers = {
+            'example.com': LookupResult('example.com', 'MX', [(10, 'mx.example.com')]),
+            'nullmx.example': LookupResult('nullmx.example', 'MX', [(0, '')]),
+            'gone.example': LookupResult('gone.example', 'MX', [], nxdomain=True),
+        }
+        engine = MagicMock()
+        engine.mx_records.side_effect = lambda domains: {domain: answers[domain] for domain in domains}
+        recipients = parse_recipients('a@example.com, b@example.com, c@nullmx.example, d@gone.example')
+        
+        self.assertEqual(recipients.undeliverable_domains(engine), ['nullmx.example', 'gone.example'])
+        self.assertEqual(list(engine.mx_records.call_args.args[0]), ['example.com', 'nullmx.example', 'gone.example'])
+
+
+@benchmark
+class RecipientParsingBenchmark(TestCase):
+    """One pass over 100k addresses against a per-address EmailValidator loop"""
+    
+    ADDRESSES = 100000
+    
+    def test_parse_large_recipient_list(self):
+        domains = [f'domain{i}.example' for i in range(200)]
+        value = ', '.join(f'User{i % 90000}@{domains[i % len(domains)].upper()}' for i in range(self.ADDRESSES))
+        
+        start = time.perf_counter()
+        recipients = parse_recipients(value)
+        elapsed = time.perf_counter() - start
+        
+        validate = EmailValidator()
+        start = time.perf_counter()
+        seen = set()
+        for address in value.split(','):
+            address = address.strip()
+            validate(address)
+            seen.add(address.lower())
+        baseline = time.perf_counter() - start
+        
+        report(f"Parsed {self.ADDRESSES:,} recipients in {elapsed * 1000:.0f} ms "
+               f"(EmailValidator loop: {baseline * 1000:.0f} ms), {len(recipients.by_domain)} domains")
+        self.assertEqual(len(recipients), 90000)
+        self.assertEqual(recipients.duplicates, 10000)
+        self.assertEqual(len(recipients.by_domain), len(domains))
+
+
+class SuppressionTests(TestCase):
+    def setUp(self):
+        reset_suppression_list()
+        self.addCleanup(reset_suppression_list)
+    
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for i in range(10000):
+            bloom.add(f'user{i}@example.com')
+        self.assertTrue(all(f'user{i}@example.com' in bloom for i in range(10000)))
+        false_positives = sum(f'other{i}@example.com' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+    
+    def test_refresh_loads_new_rows_incrementally(self):
+        SuppressedAddress.suppress(['gone@example.com'], reason='BOUNCE')
+        suppression = SuppressionList(refresh_interval=3600)
+        addresses = ['ok@example.com', 'gone@EXAMPLE.com', 'later@example.com']
+        self.assertEqual(suppression.split(addresses), (['ok@example.com', 'later@example.com'], ['gone@EXAMPLE.com']))
+        
+        SuppressedAddress.objects.create(address='later@Example.com', reason='UNSUBSCRIBE')
+        self.assertEqual(suppression.split(addresses)[1], ['gone@EXAMPLE.com'])
+        with self.assertNumQueries(1):
+            suppression.refresh(force=True)
+        self.assertEqual(suppression.split(addresses), (['ok@example.com'], ['gone@EXAMPLE.com', 'later@example.com']))
+    
+    def test_refresh_sees_rows_committed_after_a_later_one(self):
+        SuppressedAddress.suppress(['first@example.com'], reason='BOUNCE')
+        suppression = SuppressionList(refresh_interval=3600)
+        suppression.refresh(force=True)
+        loaded = suppression._filter.count
+        
+        # Stamped (and given its pk) before the last refresh, committed after it
+        SuppressedAddress.suppress(['slow@example.com'], reason='BOUNCE')
+        SuppressedAddress.objects.filter(address='slow@example.com').update(created_at=timezone.now() - timedelta(seconds=30))
+        suppression.refresh(force=True)
+        suppression.refresh(force=True)
+        
+        self.assertEqual(suppression.split(['slow@example.com'])[1], ['slow@example.com'])
+        # Rows inside the overlap are not counted again on every refresh
+        self.assertEqual(suppression._filter.count, loaded + 1)
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_sends_skip_suppressed_recipients(self, mock_smtp, mock_email_client):
+        SuppressedAddress.suppress(['gone@example.com'], reason='BOUNCE')
+        mock_client = mock_email_client.from_connection_string.return_value
+        service = AzureEmailService()
+        
+        result = service.send_email('noreply@example.com', ['gone@example.com', 'ok@example.com'], 'Hi', 'Body')
+        self.assertTrue(result.success)
+        self.assertEqual(mock_smtp.return_value.send_message.call_args.args[0]['To'], 'ok@example.com')
+        self.assertEqual(result.suppressed, ['gone@example.com'])
+        
+        result = service.send_email_direct_api('noreply@example.com', 'gone@example.com', 'Hi', 'Body')
+        self.assertFalse(result.success)
+        self.assertEqual(result.error_class, 'AllRecipientsSuppressed')
+        self.assertFalse(result.retryable)
+        mock_client.begin_send.assert_not_called()
+    
+    @patch('email_app.services.EmailClient')
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_suppressed_recipients_are_recorded_as_not_sent(self, mock_smtp, mock_email_client):
+        self.addCleanup(close_smtp_pools)
+        SuppressedAddress.suppress(['gone@example.com'], reason='BOUNCE')
+        user = User.objects.create_user(username='sender', password='testpassword')
+        email = EmailMessage.objects.create(
+            sender='noreply@example.com', recipients='gone@EXAMPLE.com, ok@example.com',
+            subject='Hi', body='Body', status='QUEUED', created_by=user
+        )
+        email.save_recipients()
+        worker = OutboxWorker(worker_id='worker-1', service=AzureEmailService())
+        
+        # In this thread: the suppression list reads the test transaction's rows
+        claimed, = worker.claim_batch()
+        worker.record_result(*worker.deliver(claimed))
+        
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'SENT')
+        self.assertEqual(
+            sorted(email.recipient_rows.values_list('address', 'status', 'error_message')),
+            [('gone@example.com', 'FAILED', EmailRecipient.SUPPRESSED), ('ok@example.com', 'SENT', None)]
+        )
+    
+    def test_hard_bounces_are_suppressed(self):
+        _, events = parse_events(json.dumps([{
+            'id': 'bounce-1',
+            'eventType': 'Microsoft.Communication.EmailDeliveryReportReceived',
+            'data': {'messageId': 'op-1', 'recipient': 'gone@EXAMPLE.com', 'status': 'Bounced'},
+        }]))
+        buffer = EventBuffer(max_size=10, flush_interval=3600)
+        self.addCleanup(buffer.close)
+        buffer.add(events)
+        buffer.flush()
+        self.assertEqual(SuppressedAddress.objects.get().address, 'gone@example.com')
+
+
+@benchmark
+class SuppressionBenchmark(TestCase):
+    """Membership checks stay O(1) and the filter stays small with a million addresses"""
+    
+    ADDRESSES = 1000000
+    LOOKUPS = 100000
+    
+    def test_million_address_filter(self):
+        bloom = BloomFilter(self.ADDRESSES)
+        start = time.perf_counter()
+        for i in range(self.ADDRESSES):
+            bloom.add(f'user{i}@example.com')
+        load = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        hits = sum(f'user{i}@example.com' in bloom for i in range(0, self.ADDRESSES, self.ADDRESSES // self.LOOKUPS))
+        misses = sum(f'other{i}@example.com' in bloom for i in range(self.LOOKUPS))
+        per_lookup = (time.perf_counter() - start) / (2 * self.LOOKUPS)
+        
+        report(f"Bloom filter: {self.ADDRESSES:,} addresses in {len(bloom.bits) / 2 ** 20:.1f} MiB, "
+               f"loaded in {load:.1f}s, {per_lookup * 1e6:.2f} µs per lookup, {misses} false positives")
+        self.assertEqual(hits, self.LOOKUPS)
+        self.assertLess(misses, self.LOOKUPS * 0.005)
+        self.assertLess(len(bloom.bits), 4 * 2 ** 20)
+
+
+class FakeACSTransport(HttpTransport):
+    """HTTP transport standing in for an ACS resource; send operations report ``self.status``"""
+    
+    def __init__(self, status='Running'):
+        self.status = status
+        self.requests = []
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def open(self):
+        pass
+    
+    def close(self):
+        pass
+    
+    def send(self, request, **kwargs):
+        self.requests.append((request.method, request.url))
+        response = requests.Response()
+        response.status_code = 202 if request.method == 'POST' else 200
+        response.headers['Content-Type'] = 'application/json'
+        if request.method == 'POST':
+            response.headers['Operation-Location'] = (
+                'https://acs.example.com/emails/operations/op-1?api-version=2023-03-31'
+            )
+        status = 'Running' if request.method == 'POST' else self.status
+        response.raw = io.BytesIO(json.dumps({'id': 'op-1', 'status': status}).encode())
+        response.request = requests.Request(request.method, request.url).prepare()
+        return RestRequestsTransportResponse(request=request, internal_response=response)
+
+
+class DeliveryTrackingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+    
+    def accepted_email(self, operation_id, recipients='one@example.com, two@example.com', **kwargs):
+        fields = {
+            'sender': 'noreply@example.com',
+            'recipients': recipients,
+            'subject': 'Accepted Email',
+            'body': 'This is a test email.',
+            'status': 'ACCEPTED',
+            'use_direct_api': True,
+            'provider_message_id': operation_id,
+            'transport': 'api',
+            'continuation_token': f'token:{operation_id}',
+            'created_by': self.user,
+        }
+        fields.update(kwargs)
+        email = EmailMessage.objects.create(**fields)
+        email.save_recipients()
+        return email
+    
+    @patch('email_app.services.EmailClient')
+    def test_direct_api_send_returns_once_accepted(self, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        poller = mock_client.begin_send.return_value
+        poller.result.return_value = {'id': 'op-1', 'status': 'Running'}
+        poller.continuation_token.return_value = 'token-1'
+        
+        result = AzureEmailService().send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        
+        self.assertIsInstance(mock_client.begin_send.call_args.kwargs['polling'], StatusPolling)
+        self.assertTrue(result.success)
+        self.assertEqual(result.status, 'ACCEPTED')
+        self.assertEqual(result.message_id, 'op-1')
+        self.assertEqual(EmailMessage.result_fields(result)['continuation_token'], 'token-1')
+        
+        with override_settings(EMAIL_DIRECT_API_WAIT=True):
+            poller.result.return_value = {'id': 'op-2', 'status': 'Succeeded'}
+            result = AzureEmailService().send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        self.assertEqual(mock_client.begin_send.call_args.kwargs['polling'], True)
+        self.assertEqual(result.status, 'SENT')
+        self.assertIsNone(result.continuation_token)
+    
+    def test_reconciler_settles_operations_in_bulk(self):
+        succeeded = self.accepted_email('op-ok')
+        failed = self.accepted_email('op-bad')
+        running = self.accepted_email('op-running')
+        expired = self.accepted_email('op-old')
+        EmailMessage.objects.filter(pk=expired.pk).update(sent_at=timezone.now() - timedelta(days=2))
+        not_due = self.accepted_email('op-later', next_attempt_at=timezone.now() + timedelta(minutes=5))
+        
+        operations = {
+            'op-ok': {'id': 'op-ok', 'status': 'Succeeded'},
+            'op-bad': {'id': 'op-bad', 'status': 'Failed', 'error': {'code': 'Bad', 'message': 'Sender rejected'}},
+            'op-running': {'id': 'op-running', 'status': 'Running'},
+            'op-old': {'id': 'op-old', 'status': 'Running'},
+        }
+        service = MagicMock()
+        service.get_operation_status.side_effect = lambda token: operations[token.removeprefix('token:')]
+        reconciler = DeliveryReconciler(service=service, poll_interval=60)
+        
+        self.assertEqual(reconciler.run_once(), 4)
+        self.assertEqual(reconciler.run_once(), 0)
+        reconciler.close()
+        
+        expected = {
+            succeeded: ('SENT', None),
+            failed: ('FAILED', 'Sender rejected'),
+            running: ('ACCEPTED', None),
+            expired: ('FAILED', 'Send operation did not finish within 86400 seconds'),
+            not_due: ('ACCEPTED', None),
+        }
+        for email, (status, error) in expected.items():
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.error_message), (status, error))
+            self.assertEqual(set(email.recipient_rows.values_list('status', flat=True)), {status})
+        self.assertGreater(running.next_attempt_at, timezone.now())
+        self.assertEqual(service.get_operation_status.call_count, 4)
+    
+    def test_accepted_operations_are_polled_from_their_continuation_token(self):
+        transport = FakeACSTransport()
+        client = EmailClient.from_connection_string(
+            'endpoint=https://acs.example.com/;accesskey=c2VjcmV0', transport=transport
+        )
+        throttle = build_throttle('test-poll', max_attempts=1)
+        
+        poller = client.begin_send(
+            {'senderAddress': 'noreply@example.com', 'content': {'subject': 'Hi', 'plainText': 'Body'},
+             'recipients': {'to': [{'address': 'one@example.com'}]}},
+            polling=StatusPolling(0)
+        )
+        self.assertEqual(poller.result()['status'], 'Running')
+        token = poller.continuation_token()
+        
+        self.assertEqual(get_operation_status(client, throttle, token)['status'], 'Running')
+        transport.status = 'Succeeded'
+        self.assertEqual(get_operation_status(client, throttle, token)['status'], 'Succeeded')
+        # The submit, then one status request per poll
+        self.assertEqual([method for method, _ in transport.requests], ['POST', 'GET', 'GET'])
+        self.assertTrue(transport.requests[1][1].startswith('https://acs.example.com/emails/operations/op-1'))
+    
+    @override_settings(EMAIL_TRANSPORTS=[
+        {'type': 'api', 'name': 'acs-a', 'connection_string': 'endpoint=https://a.example.com/;accesskey=YQ=='},
+        {'type': 'api', 'name': 'acs-b', 'connection_string': 'endpoint=https://b.example.com/;accesskey=Yg=='},
+    ])
+    @patch('email_app.transports.EmailClient')
+    def test_reconciler_polls_through_the_accepting_transport(self, mock_email_client):
+        reset_transport_router()
+        self.addCleanup(reset_transport_router)
+        clients = {}
+        
+        def client_for(connection_string, **kwargs):
+            client = clients[connection_string.split('//')[1].split('.')[0]] = MagicMock()
+            client.begin_send.return_value.result.return_value = {'status': 'Succeeded'}
+            return client
+        
+        mock_email_client.from_connection_string.side_effect = client_for
+        on_b = self.accepted_email('op-b', transport='acs-b')
+        on_default = self.accepted_email('op-default')
+        service = MagicMock()
+        service.get_operation_status.return_value = {'status': 'Succeeded'}
+        reconciler = DeliveryReconciler(service=service)
+        
+        self.assertEqual(reconciler.run_once(), 2)
+        reconciler.close()
+        
+        clients['a'].begin_send.assert_not_called()
+        self.assertEqual(clients['b'].begin_send.call_count, 1)
+        self.assertIsNone(clients['b'].begin_send.call_args.args[0])
+        self.assertEqual(clients['b'].begin_send.call_args.kwargs['continuation_token'], 'token:op-b')
+        service.get_operation_status.assert_called_once_with('token:op-default')
+        for email in (on_b, on_default):
+            email.refresh_from_db()
+            self.assertEqual(email.status, 'SENT')
+    
+    def post_events(self, events, token='hook-secret'):
+        return self.client.post(
+            reverse('email_events') + (f'?token={token}' if token else ''),
+            data=json.dumps(events),
+            content_type='application/json'
+        )
+    
+    def report(self, message_id, recipient, status, detail=None, event_id=None):
+        return {
+            'id': event_id or f'{message_id}:{recipient}:{status}',
+            'eventType': 'Microsoft.Communication.EmailDeliveryReportReceived',
+            'data': {
+                'messageId': message_id,
+                'recipient': recipient,
+                'status': status,
+                'deliveryStatusDetails': {'statusMessage': detail},
+            },
+        }
+    
+    def test_webhook_requires_the_secret(self):
+        self.assertEqual(self.post_events([]).status_code, 403)
+        with override_settings(EMAIL_WEBHOOK_SECRET='hook-secret'):
+            self.assertEqual(self.post_events([], token='wrong').status_code, 403)
+            response = self.post_events([{
+                'id': 'validation-1',
+                'eventType': 'Microsoft.EventGrid.SubscriptionValidationEvent',
+                'data': {'validationCode': 'abc-123'},
+            }])
+            self.assertEqual(response.json(), {'validationResponse': 'abc-123'})
+            self.assertEqual(self.post_events([{'eventType': 'x', 'data': {}}]).status_code, 400)
+            self.assertEqual(self.post_events({'not': 'an event'}).status_code, 400)
+    
+    @override_settings(EMAIL_WEBHOOK_SECRET='hook-secret')
+    def test_webhook_rejects_fields_that_do_not_fit(self):
+        reset_event_buffer()
+        self.addCleanup(reset_event_buffer)
+        malformed = [
+            ('deliveryStatusDetails', 'x'),
+            ('status', ['Delivered']),
+            ('status', 'D' * 51),
+            ('messageId', 'm' * 256),
+            ('recipient', 'a' * 250 + '@example.com'),
+        ]
+        for field, value in malformed:
+            event = self.report('op-1', 'one@example.com', 'Delivered')
+            event['data'][field] = value
+            with self.subTest(field=field):
+                self.assertEqual(self.post_events([event]).status_code, 400)
+        self.assertEqual(len(get_event_buffer()), 0)
+    
+    def test_flush_drops_events_the_database_refuses(self):
+        self.accepted_email('op-1', recipients='one@example.com')
+        _, events = parse_events(json.dumps([self.report('op-1', 'one@example.com', 'Delivered')]))
+        # Built without parse_events, whose checks would refuse it
+        bad = EmailEvent(event_id='bad-1', event_type='Microsoft.Communication.EmailDeliveryReportReceived',
+                         provider_message_id='op-1', recipient='one@example.com', status=['Delivered'])
+        buffer = EventBuffer(max_size=10, flush_interval=3600)
+        self.addCleanup(buffer.close)
+        buffer.add([bad, *events])
+        
+        with self.assertLogs('email_app.events', 'ERROR'):
+            self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(list(EmailEvent.objects.values_list('event_id', flat=True)), [events[0].event_id])
+    
+    @override_settings(EMAIL_WEBHOOK_SECRET='hook-secret', EMAIL_EVENT_BUFFER_SIZE=1)
+    def test_webhook_applies_delivery_reports(self):
+        reset_event_buffer()
+        self.addCleanup(reset_event_buffer)
+        partly = self.accepted_email('op-1')
+        bounced = self.accepted_email('op-2', recipients='gone@example.com')
+        delivered = self.accepted_email('op-3', recipients='three@example.com', status='SENT')
+        
+        response = self.post_events([
+            self.report('op-1', 'one@EXAMPLE.com', 'Delivered'),
+            self.report('op-2', 'gone@example.com', 'Bounced', 'Mailbox does not exist'),
+            self.report('op-3', 'three@example.com', 'Delivered'),
+            self.report('unknown-op', 'x@example.com', 'Delivered'),
+        ])
+        
+        self.assertEqual(response.json(), {'received': 4})
+        partly.refresh_from_db()
+        self.assertEqual(partly.status, 'SENT')
+        self.assertEqual(
+            sorted(partly.recipient_rows.values_list('address', 'status')),
+            [('one@example.com', 'DELIVERED'), ('two@example.com', 'SENT')]
+        )
+        bounced.refresh_from_db()
+        self.assertEqual((bounced.status, bounced.error_message), ('FAILED', 'Mailbox does not exist'))
+        delivered.refresh_from_db()
+        self.assertEqual(delivered.status, 'DELIVERED')
+        self.assertEqual(EmailEvent.objects.count(), 4)
+        self.assertEqual(EmailEvent.objects.filter(message=partly).get().recipient, 'one@example.com')
+        
+        # A CloudEvents-style report for the last recipient completes the message
+        self.post_events({
+            'id': 'cloud-event-1',
+            'type': 'Microsoft.Communication.EmailDeliveryReportReceived',
+            'data': self.report('op-1', 'two@example.com', 'Delivered')['data'],
+        })
+        partly.refresh_from_db()
+        self.assertEqual(partly.status, 'DELIVERED')
+    
+    def test_buffer_writes_on_size_and_skips_redelivered_events(self):
+        email = self.accepted_email('op-1', recipients='one@example.com')
+        engagement = {
+            'id': 'click-1',
+            'eventType': 'Microsoft.Communication.EmailEngagementTrackingReportReceived',
+            'data': {
+                'messageId': 'op-1',
+                'recipient': 'one@example.com',
+                'engagementType': 'Click',
+                'engagementContext': 'https://example.com/offer',
+                'userActionTimeStamp': '2024-05-01T10:00:00.1234567+00:00',
+            },
+        }
+        _, first = parse_events(json.dumps([self.report('op-1', 'one@example.com', 'Delivered'), engagement]))
+        _, again = parse_events(json.dumps([engagement]))
+        buffer = EventBuffer(max_size=3, flush_interval=3600)
+        self.addCleanup(buffer.close)
+        
+        buffer.add(first)
+        buffer.add(again)
+        self.assertEqual(len(buffer), 2)
+        self.assertFalse(EmailEvent.objects.exists())
+        
+        self.assertEqual(buffer.flush(), 2)
+        _, redelivered = parse_events(json.dumps([engagement]))
+        buffer.add(redelivered)
+        self.assertEqual(buffer.flush(), 0)
+        
+        click = EmailEvent.objects.get(event_id='click-1')
+        self.assertEqual((click.message, click.status, click.detail), (email, 'Click', 'https://example.com/offer'))
+        self.assertEqual(click.occurred_at.year, 2024)
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'DELIVERED')
+    
+    def test_naive_and_aware_timestamps_sort_together(self):
+        email = self.accepted_email('op-1', recipients='one@example.com')
+        delivered = self.report('op-1', 'one@example.com', 'Delivered')
+        delivered['data']['deliveryAttemptTimeStamp'] = '2024-05-01T10:00:05'
+        expanded = self.report('op-1', 'one@example.com', 'Expanded')
+        expanded['data']['deliveryAttemptTimeStamp'] = '2024-05-01T12:00:00+02:00'
+        _, events = parse_events(json.dumps([delivered, expanded]))
+        
+        self.assertTrue(all(timezone.is_aware(event.occurred_at) for event in events))
+        self.assertEqual(write_events(events), 2)
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'DELIVERED')
+
+
+@benchmark
+@override_settings(EMAIL_WEBHOOK_SECRET='hook-secret', EMAIL_EVENT_BUFFER_SIZE=2000, EMAIL_EVENT_FLUSH_INTERVAL=3600)
+class EventIngestionBenchmark(TestCase):
+    """Load test: batched webhook posts through the buffer into the database"""
+    
+    MESSAGES = 2000
+    BATCHES = 40
+    BATCH_SIZE = 250
+    
+    def setUp(self):
+        reset_event_buffer()
+        self.addCleanup(reset_event_buffer)
+        user = User.objects.create_user(username='testuser', password='testpassword')
+        EmailMessage.objects.bulk_create(
+            EmailMessage(sender='noreply@example.com', recipients=f'user{i}@example.com', subject='Hi',
+                         body='Body', status='SENT', provider_message_id=f'op-{i}', created_by=user)
+            for i in range(self.MESSAGES)
+        )
+        EmailRecipient.objects.bulk_create(
+            EmailRecipient(message=message, address=message.recipients, status='SENT')
+            for message in EmailMessage.objects.all()
+        )
+        self.bodies = [
+            json.dumps([
+                {
+                    'id': f'event-{batch}-{i}',
+                    'eventType': 'Microsoft.Communication.EmailDeliveryReportReceived',
+                    'eventTime': '2024-05-01T10:00:00Z',
+                    'data': {
+                        'messageId': f'op-{n % self.MESSAGES}',
+                        'recipient': f'user{n % self.MESSAGES}@example.com',
+                        'status': 'Delivered',
+                    },
+                }
+                for i in range(self.BATCH_SIZE)
+                for n in [batch * self.BATCH_SIZE + i]
+            ])
+            for batch in range(self.BATCHES)
+        ]
+    
+    def test_sustains_thousands_of_events_per_second(self):
+        url = reverse('email_events') + '?token=hook-secret'
+        start = time.perf_counter()
+        for body in self.bodies:
+            response = self.client.post(url, data=body, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+        get_event_buffer().flush()
+        elapsed = time.perf_counter() - start
+        
+        events = self.BATCHES * self.BATCH_SIZE
+        report(f"Ingested {events:,} events in {elapsed:.2f}s ({events / elapsed:,.0f} events/s)")
+        self.assertEqual(EmailEvent.objects.count(), events)
+        self.assertFalse(EmailMessage.objects.exclude(status='DELIVERED').exists())
+
+
+def make_async_email_client(delay=0):
+    """Async EmailClient stand-in whose sends take ``delay`` seconds"""
+    client = MagicMock()
+    client.close = AsyncMock()
+    
+    async def begin_send(message, **kwargs):
+        poller = MagicMock()
+        
+        async def result():
+            await asyncio.sleep(delay)
+            return {'id': 'test-message-id', 'status': 'Succeeded'}
+        
+        poller.result.side_effect = result
+        return poller
+    
+    client.begin_send = AsyncMock(side_effect=begin_send)
+    return client
+
+
+class AsyncAzureEmailServiceTests(TestCase):
+    @patch('email_app.async_services.AsyncEmailClient')
+    def test_send_email_direct_api_shares_client_per_loop(self, mock_email_client):
+        mock_email_client.from_connection_string.side_effect = lambda conn_str: make_async_email_client()
+        service = AsyncAzureEmailService()
+        
+        async def send_twice():
+            results = await asyncio.gather(*[
+                service.send_email_direct_api(
+                    'noreply@example.com',
+                    'recipient@example.com',
+                    'Test Email',
+                    'This is a test email.'
+                )
+                for _ in range(2)
+            ])
+            return results, service.get_email_client()
+        
+        results, first_client = asyncio.run(send_twice())
+        _, second_client = asyncio.run(send_twice())
+        
+        self.assertTrue(all(success for success, message in results))
+        self.assertEqual(first_client.begin_send.await_count, 2)
+        # A new event loop gets its own client
+        self.assertIsNot(first_client, second_client)
+        self.assertEqual(mock_email_client.from_connection_string.call_count, 2)
+    
+    @patch('email_app.async_services.aiosmtplib.SMTP')
+    def test_send_email_smtp_reuses_session(self, mock_smtp):
+        mock_server = MagicMock()
+        mock_server.connect = AsyncMock()
+        mock_server.login = AsyncMock()
+        mock_server.send_message = AsyncMock()
+        mock_smtp.return_value = mock_server
+        service = AsyncAzureEmailService()
+        
+        async def send_three():
+            return [
+                await service.send_email(
+                    'noreply@example.com',
+                    ['recipient@example.com'],
+                    'Test Email',
+                    'This is a test email.'
+                )
+                for _ in range(3)
+            ]
+        
+        results = asyncio.run(send_three())
+        
+        self.assertTrue(all(success for success, message in results))
+        self.assertEqual(mock_smtp.call_count, 1)
+        mock_server.login.assert_awaited_once()
+        self.assertEqual(mock_server.send_message.await_count, 3)
+
+    
+    @patch('email_app.async_services.AsyncEmailClient')
+    @patch('email_app.async_services.aiosmtplib.SMTP')
+    def test_wsgi_requests_close_their_loops_connections(self, mock_smtp, mock_email_client):
+        open_sessions = set()
+        
+        def connect():
+            server = MagicMock()
+            server.connect = AsyncMock(side_effect=lambda: open_sessions.add(server))
+            server.login = AsyncMock()
+            server.send_message = AsyncMock()
+            server.quit = AsyncMock(side_effect=lambda: open_sessions.discard(server))
+            return server
+        
+        mock_smtp.side_effect = lambda **kwargs: connect()
+        api_clients = []
+        mock_email_client.from_connection_string.side_effect = (
+            lambda conn_str: api_clients.append(make_async_email_client()) or api_clients[-1]
+        )
+        User.objects.create_user(username='sender', password='testpassword')
+        self.client.login(username='sender', password='testpassword')
+        data = {
+            'sender': 'noreply@example.com',
+            'recipients': 'recipient@example.com',
+            'subject': 'Test Email',
+            'body': 'This is a test email.',
+        }
+        
+        # The test client, like WSGI, runs the async view on a new loop per request
+        for _ in range(3):
+            self.client.post(reverse('send_email_async'), data)
+            self.client.post(reverse('send_email_async'), {**data, 'use_direct_api': 'on'})
+        
+        self.assertEqual(mock_smtp.call_count, 3)
+        self.assertEqual(open_sessions, set())
+        self.assertEqual(len(api_clients), 3)
+        for client in api_clients:
+            client.close.assert_awaited_once()
+    
+    @patch('email_app.views.record_outcomes', side_effect=RuntimeError('stats down'))
+    @patch('email_app.async_services.aiosmtplib.SMTP')
+    def test_async_view_saves_the_email_and_its_rows_together(self, mock_smtp, mock_record_outcomes):
+        server = mock_smtp.return_value
+        server.connect = AsyncMock()
+        server.login = AsyncMock()
+        server.send_message = AsyncMock()
+        server.quit = AsyncMock()
+        User.objects.create_user(username='sender', password='testpassword')
+        self.client.login(username='sender', password='testpassword')
+        
+        with self.assertRaises(RuntimeError):
+            self.client.post(reverse('send_email_async'), {
+                'sender': 'noreply@example.com',
+                'recipients': 'recipient@example.com',
+                'subject': 'Test Email',
+                'body': 'This is a test email.',
+            })
+        
+        server.send_message.assert_awaited_once()
+        self.assertFalse(EmailMessage.objects.exists())
+        self.assertFalse(EmailRecipient.objects.exists())
+
+
+@benchmark
+class SyncVersusAsyncSendBenchmark(TestCase):
+    """
+    Provider latency is simulated locally. The sync path models WSGI with a
+    fixed number of worker threads; the async path pushes every request
+    through the ASGI view on a single event loop.
+    """
+    
+    REQUESTS = 200
+    PROVIDER_LATENCY = 0.05
+    WSGI_WORKERS = 4
+    
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+    
+    def post_data(self, i):
+        return {
+            'sender': 'noreply@example.com',
+            'recipients': f'user{i}@example.com',
+            'subject': 'Load test',
+            'body': 'This is a test email.',
+            'use_direct_api': 'on'
+        }
+    
+    @patch('email_app.services.EmailClient')
+    def run_sync(self, mock_email_client):
+        def begin_send(message, **kwargs):
+            poller = MagicMock()
+            
+            def result():
+                time.sleep(self.PROVIDER_LATENCY)
+                return {'id': 'test-message-id', 'status': 'Succeeded'}
+            
+            poller.result.side_effect = result
+            return poller
+        
+        mock_email_client.from_connection_string.return_value.begin_send.side_effect = begin_send
+        service = AzureEmailService()
+        
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.WSGI_WORKERS) as executor:
+            results = list(executor.map(
+                lambda i: service.send_email_direct_api(**{
+                    'sender': 'noreply@example.com',
+                    'recipients': f'user{i}@example.com',
+                    'subject': 'Load test',
+                    'body': 'This is a test email.'
+                }),
+                range(self.REQUESTS)
+            ))
+        self.assertTrue(all(success for success, message in results))
+        return time.perf_counter() - start
+    
+    @patch('email_app.async_services.AsyncEmailClient')
+    async def test_async_view_throughput(self, mock_email_client):
+        mock_email_client.from_connection_string.return_value = make_async_email_client(self.PROVIDER_LATENCY)
+        sync_elapsed = await asyncio.to_thread(self.run_sync)
+        
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.user)
+        url = reverse('send_email_async')
+        
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[
+            client.post(url, self.post_data(i)) for i in range(self.REQUESTS)
+        ])
+        async_elapsed = time.perf_counter() - start
+        
+        self.assertTrue(all(response.status_code == 302 for response in responses))
+        self.assertEqual(await EmailMessage.objects.filter(status='SENT').acount(), self.REQUESTS)
+        report(f"{self.REQUESTS} sends at {self.PROVIDER_LATENCY * 1000:.0f} ms provider latency: "
+               f"WSGI ({self.WSGI_WORKERS} workers) {self.REQUESTS / sync_elapsed:.0f} req/s, "
+               f"ASGI {self.REQUESTS / async_elapsed:.0f} req/s")
+
+
+class SendCampaignCommandTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+    
+    @patch('email_app.management.commands.send_campaign.get_email_service')
+    def test_campaign_from_csv(self, mock_get_email_service):
+        mock_service = MagicMock()
+        mock_service.send_bulk.side_effect = lambda messages, concurrency=None: (
+            (message, SendResult.sent('Email sent successfully', 'api', f'msg-{i}')) for i, message in enumerate(messages)
+        )
+        mock_get_email_service.return_value = mock_service
+        
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('email,name\nann@example.com,Ann\nbob@example.com,Bob & Co\nann@EXAMPLE.com,Ann\nnot-an-address,X\n')
+        self.addCleanup(os.unlink, f.name)
+        
+        call_command(
+            'send_campaign',
+            csv=f.name,
+            sender='noreply@example.com',
+            subject='Hi {{ name }}',
+            body='Hello {{ name }}',
+            html_body='<p>Hello {{ name }}</p>',
+            created_by='testuser',
+            stdout=MagicMock()
+        )
+        
+        emails = EmailMessage.objects.order_by('recipients')
+        self.assertEqual([e.recipients for e in emails], ['ann@example.com', 'bob@example.com'])
+        self.assertEqual(emails[1].subject, 'Hi Bob & Co')
+        self.assertEqual(emails[1].body, 'Hello Bob & Co')
+        self.assertEqual(emails[1].html_body, '<p>Hello Bob &amp; Co</p>')
+        self.assertEqual(
+            sorted(EmailRecipient.objects.values_list('message__recipients', 'address', 'status')),
+            [('ann@example.com', 'ann@example.com', 'SENT'), ('bob@example.com', 'bob@example.com', 'SENT')]
+        )
+        self.assertTrue(all(e.status == 'SENT' for e in emails))
+
+
+class EmailTemplateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+        self.addCleanup(clear_compiled_templates)
+        self.template = EmailTemplate.objects.create(
+            name='welcome',
+            subject='Welcome {{ name }}',
+            text_body='Hello {{ name }}',
+            html_body='<p>Thanks for joining</p>',
+            created_by=self.user
+        )
+    
+    def test_compiled_template_is_cached_by_version(self):
+        compiled = get_compiled_template(self.template)
+        self.assertIs(get_compiled_template(EmailTemplate.objects.get(pk=self.template.pk)), compiled)
+        
+        self.template.subject = 'Hi {{ name }}'
+        self.template.save(update_fields=['subject'])
+        self.assertEqual(EmailTemplate.objects.get(pk=self.template.pk).version, 2)
+        
+        recompiled = get_compiled_template(self.template)
+        self.assertIsNot(recompiled, compiled)
+        self.assertEqual(recompiled.render({'name': 'Ann'})['subject'], 'Hi Ann')
+    
+    def test_render_batch_escapes_html_only_and_shares_static_parts(self):
+        compiled = CompiledEmailTemplate('Hi {{ name }}', 'Hello {{ name }}', '<p>Hello {{ name }}</p>')
+        rendered = [r for _, r in compiled.render_batch([{'name': 'Bob & Co'}, {'name': 'Ann'}])]
+        
+        self.assertEqual(rendered[0], {
+            'subject': 'Hi Bob & Co',
+            'body': 'Hello Bob & Co',
+            'html_body': '<p>Hello Bob &amp; Co</p>',
+        })
+        # Values pushed for one recipient do not leak into the next
+        self.assertEqual(rendered[1]['subject'], 'Hi Ann')
+        
+        compiled = get_compiled_template(self.template)
+        first, second = (
+            compiled.build_mime_message('noreply@example.com', [f'{name}@example.com'], compiled.render({'name': name}))
+            for name in ('ann', 'bob')
+        )
+        self.assertIs(first.get_payload(1), second.get_payload(1))
+        self.assertEqual(second['Subject'], 'Welcome bob')
+        self.assertEqual(message_from_bytes(second.as_bytes()).get_payload(0).get_payload(decode=True), b'Hello bob')
+    
+    @patch('email_app.management.commands.send_campaign.get_email_service')
+    def test_campaign_from_stored_template(self, mock_get_email_service):
+        mock_service = MagicMock()
+        mock_service.send_bulk.side_effect = lambda messages, concurrency=None: (
+            (message, SendResult.sent('Email sent successfully', 'api', f'msg-{i}')) for i, message in enumerate(messages)
+        )
+        mock_get_email_service.return_value = mock_service
+        User.objects.create_user(username='ann', email='ann@example.com', first_name='Ann')
+        
+        call_command(
+            'send_campaign',
+            all_users=True,
+            template='welcome',
+            sender='noreply@example.com',
+            created_by='testuser',
+            stdout=MagicMock()
+        )
+        
+        email = EmailMessage.objects.get(recipients='ann@example.com')
+        self.assertEqual(email.subject, 'Welcome')
+        self.assertEqual(email.html_body, '<p>Thanks for joining</p>')
+
+
+@benchmark
+class TemplateRenderBenchmark(TestCase):
+    """
+    Render personalised MIME messages from one compiled template, against
+    building a fresh Context and fresh MIME parts per message
+    """
+    
+    MESSAGES = 100000
+    SUBJECT = 'Your {{ month }} statement, {{ first_name }}'
+    TEXT = 'Hi {{ first_name }},\n\nYour balance is {{ balance }}.\n\nThanks,\nThe team'
+    HTML = '<html><body><h1>Monthly statement</h1><p>Open the app to see the details.</p></body></html>'
+    
+    def contexts(self):
+        return (
+            {'email': f'user{i}@example.com', 'first_name': f'User {i}', 'month': 'May', 'balance': i}
+            for i in range(self.MESSAGES)
+        )
+    
+    def render_compiled(self):
+        compiled = CompiledEmailTemplate(self.SUBJECT, self.TEXT, self.HTML)
+        for row, rendered in compiled.render_batch(self.contexts()):
+            compiled.build_mime_message('noreply@example.com', [row['email']], rendered)
+    
+    def render_naive(self):
+        subject, text, html = Template(self.SUBJECT), Template(self.TEXT), Template(self.HTML)
+        for row in self.contexts():
+            build_mime_message(
+                'noreply@example.com',
+                [row['email']],
+                subject.render(Context(row, autoescape=False)).strip(),
+                text.render(Context(row, autoescape=False)),
+                html.render(Context(row))
+            )
+    
+    def test_render_throughput_and_memory(self):
+        start = time.perf_counter()
+        self.render_naive()
+        naive = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        self.render_compiled()
+        compiled = time.perf_counter() - start
         
-        # Assert success
-        self.assertTrue(success)
+        # Separate pass: tracemalloc slows everything down several times
+        tracemalloc.start()
+        try:
+            self.render_compiled()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        
+        report(f"Rendered {self.MESSAGES:,} personalised messages: compiled {self.MESSAGES / compiled:,.0f} msg/s, "
+               f"per-message Context/MIME {self.MESSAGES / naive:,.0f} msg/s, peak {peak / 1024:.0f} KiB traced")
+        self.assertLess(peak, 16 * 1024 * 1024)
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+        self.addCleanup(metrics.registry.reset)
+        self.addCleanup(close_smtp_pools)
+        self.user = User.objects.create_user(username='ops', password='testpassword', is_staff=True)
     
     @patch('email_app.services.EmailClient')
-    def test_send_email_direct_api(self, mock_email_client):
-        # Mock EmailClient
-        mock_client = MagicMock()
-        mock_email_client.from_connection_string.return_value = mock_client
+    @patch('email_app.smtp_pool.smtplib.SMTP')
+    def test_sends_are_counted_with_phase_histograms(self, mock_smtp, mock_email_client):
+        mock_client = mock_email_client.from_connection_string.return_value
+        mock_client.begin_send.return_value.result.return_value = {'id': 'api-id'}
+        service = AzureEmailService()
         
-        # Mock poller
-        mock_poller = MagicMock()
-        mock_result = MagicMock()
-        mock_result.message_id = 'test-message-id'
-        mock_poller.result.return_value = mock_result
-        mock_client.begin_send.return_value = mock_poller
+        service.send_email('noreply@example.com', 'one@example.com', 'Hi', 'Body')
+        service.send_email('noreply@example.com', 'one@example.com', 'Hi again', 'Body')
+        service.send_email_direct_api('noreply@example.com', 'one@example.com', 'Hi', 'Body')
         
-        # Create service
-        service = AzureEmailService()
-        service.email_client = mock_client
+        text = metrics.registry.exposition()
+        self.assertIn('email_sends_total{transport="smtp",outcome="sent",error_class=""} 2', text)
+        # The direct API send was only accepted, so there was no poll to time
+        self.assertIn('email_sends_total{transport="api",outcome="accepted",error_class=""} 1', text)
+        # One handshake for two messages, but both submits are timed
+        self.assertIn('email_send_phase_seconds_count{transport="smtp",phase="connect"} 1', text)
+        self.assertIn('email_send_phase_seconds_count{transport="smtp",phase="submit"} 2', text)
+        self.assertNotIn('phase="poll"', text)
+        self.assertIn('email_send_phase_seconds_bucket{transport="smtp",phase="submit",le="+Inf"} 2', text)
+        self.assertIn('# TYPE email_send_phase_seconds histogram', text)
+    
+    def test_dns_lookups_are_timed(self):
+        resolver = FakeResolver({('example.com', 'MX'): FakeAnswer([])})
+        engine = DNSVerificationEngine(resolver=resolver, cache=DNSCache())
         
-        # Test sending an email
-        success, message = service.send_email_direct_api(
-            sender='noreply@example.com',
-            recipients='recipient@example.com',
-            subject='Test Email',
-            body='This is a test email.',
-            html_body='<p>This is a test email.</p>'
+        engine.verify_domains(['example.com'])
+        engine.verify_domains(['example.com'])
+        
+        samples = metrics.DNS_LOOKUP_SECONDS.snapshot()
+        self.assertEqual(samples[('MX', 'answer')][2], 1)
+        self.assertEqual(samples[('MX', 'cached')][2], 1)
+        self.assertEqual(samples[('TXT', 'negative')][2], 2)
+        self.assertEqual(metrics.DNS_VERIFICATION_SECONDS.snapshot()[()][2], 2)
+    
+    def test_metrics_endpoint_reports_view_latency(self):
+        self.client.login(username='ops', password='testpassword')
+        self.client.get(reverse('index'))
+        
+        response = self.client.get('/metrics')
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        self.assertIn(
+            'email_http_request_seconds_count{view="index",method="GET",status="200"} 1',
+            response.content.decode()
         )
         
-        # Assert API was called correctly
-        mock_client.begin_send.assert_called_once()
-        mock_poller.result.assert_called_once()
+        with override_settings(EMAIL_METRICS_TOKEN='s3cret'):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200)
+    
+    def test_metrics_endpoint_without_token_is_staff_only(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
         
-        # Assert success
-        self.assertTrue(success)
-
-
-class DNSManagerTests(TestCase):
-    @patch('email_app.services.dns.resolver.resolve')
-    def test_verify_dns_records(self, mock_resolve):
-        # Mock DNS resolver
-        mock_mx_records = [MagicMock()]
-        mock_mx_records[0].preference = 10
-        mock_mx_records[0].exchange = 'mail.example.com'
+        User.objects.create_user(username='viewer', password='testpassword')
+        self.client.login(username='viewer', password='testpassword')
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+    
+    def test_worker_files_are_merged(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(lambda: [os.remove(os.path.join(directory, f)) for f in os.listdir(directory)])
+        workers = []
+        for pid, sends in ((1001, 3), (1002, 4)):
+            worker = metrics.MetricsRegistry(directory=directory)
+            counter = worker.counter('email_sends_total', 'Sends', ('transport',))
+            histogram = worker.histogram('email_send_seconds', 'Send time', buckets=(0.1, 1.0))
+            for _ in range(sends):
+                counter.inc(transport='smtp')
+                histogram.observe(0.5)
+            with patch('email_app.metrics.os.getpid', return_value=pid):
+                worker.flush()
+            workers.append(worker)
         
-        mock_txt_records = [MagicMock()]
-        mock_txt_string = b'v=spf1 include:communication.azure.com -all'
-        mock_txt_records[0].strings = [mock_txt_string]
+        # The scraping worker adds its live values to everyone else's files
+        workers[0].metrics['email_sends_total'].inc(transport='api')
+        with patch('email_app.metrics.os.getpid', return_value=1001), \
+                patch('email_app.metrics._pid_alive', return_value=True):
+            text = workers[0].exposition()
         
-        # Configure mock to return different values for different calls
-        mock_resolve.side_effect = lambda domain, record_type: (
-            mock_mx_records if record_type == 'MX' else mock_txt_records
-        )
+        self.assertIn('email_sends_total{transport="smtp"} 7', text)
+        self.assertIn('email_sends_total{transport="api"} 1', text)
+        self.assertIn('email_send_seconds_bucket{le="0.1"} 0', text)
+        self.assertIn('email_send_seconds_bucket{le="1.0"} 7', text)
+        self.assertIn('email_send_seconds_sum 3.5', text)
+    
+    def test_files_of_exited_workers_are_removed(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(lambda: [os.remove(os.path.join(directory, f)) for f in os.listdir(directory)])
+        worker = metrics.MetricsRegistry(directory=directory)
+        counter = worker.counter('email_sends_total', 'Sends', ('transport',))
+        counter.inc(transport='smtp')
+        for pid in (1001, 1002, 1003):
+            with patch('email_app.metrics.os.getpid', return_value=pid):
+                worker.flush()
         
-        # Create DNS manager
-        manager = DNSManager()
-        manager.domain = 'example.com'
+        # 1002 exited cleanly; 1003 was killed and left its file behind
+        worker.mark_process_dead(1002)
+        with patch('email_app.metrics.os.getpid', return_value=1001), \
+                patch('email_app.metrics._pid_alive', side_effect=lambda pid: pid != 1003):
+            text = worker.exposition()
         
-        # Test verifying DNS records
-        success, results = manager.verify_dns_records()
+        self.assertIn('email_sends_total{transport="smtp"} 1', text)
+        self.assertEqual(os.listdir(directory), ['1001.json'])
+    
+    @override_settings(EMAIL_PROFILER_ENABLED=True, EMAIL_PROFILER_INTERVAL=0.001)
+    def test_profile_on_request(self):
+        User.objects.create_user(username='viewer', password='testpassword')
+        self.client.login(username='viewer', password='testpassword')
+        response = self.client.get(reverse('index') + '?profile')
+        self.assertTemplateUsed(response, 'email_app/index.html')
         
-        # Assert resolver was called correctly
-        self.assertEqual(mock_resolve.call_count, 2)
+        self.client.login(username='ops', password='testpassword')
+        with patch('email_app.views.history_queryset', side_effect=lambda user: time.sleep(0.05) or EmailMessage.objects.none()):
+            response = self.client.get(reverse('index') + '?profile')
         
-        # Assert success
-        self.assertTrue(success)
-        self.assertTrue(any('MX records' in result for result in results))
-        self.assertTrue(any('SPF record' in result for result in results))
+        self.assertEqual(response['Content-Type'], 'text/plain; charset=utf-8')
+        body = response.content.decode()
+        self.assertRegex(body, r'^# \d+ samples over')
+        self.assertIn('index (', body)
 
 
 class ViewTests(TestCase):
@@ -138,37 +2303,45 @@ class ViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'email_app/index.html')
     
-    @patch('email_app.views.AzureEmailService')
-    def test_send_email_view(self, mock_email_service):
-        # Mock email service
-        mock_service = MagicMock()
-        mock_service.send_email.return_value = (True, 'Email sent successfully')
-        mock_email_service.return_value = mock_service
-        
+    def test_send_email_view(self):
         # Test sending an email
         response = self.client.post(reverse('send_email'), {
             'sender': 'noreply@example.com',
             'recipients': 'recipient@example.com',
             'subject': 'Test Email',
             'body': 'This is a test email.',
-            'html_body': '<p>This is a test email.</p>'
+            'html_body': '<p>This is a test email.</p>',
+            'use_direct_api': 'on'
         })
         
         # Assert redirect
         self.assertEqual(response.status_code, 302)
         
-        # Assert email was created
+        # Assert email was queued rather than sent inside the request
         self.assertEqual(EmailMessage.objects.count(), 1)
         email = EmailMessage.objects.first()
         self.assertEqual(email.subject, 'Test Email')
         self.assertEqual(email.sender, 'noreply@example.com')
-        self.assertEqual(email.status, 'SENT')
+        self.assertEqual(email.status, 'QUEUED')
+        self.assertTrue(email.use_direct_api)
+        self.assertEqual(list(email.recipient_rows.values_list('address', 'status')), [('recipient@example.com', 'QUEUED')])
+    
+    def test_send_email_view_cleans_recipients(self):
+        fields = {'sender': 'noreply@example.com', 'subject': 'Test Email', 'body': 'This is a test email.'}
+        response = self.client.post(reverse('send_email'), dict(fields, recipients='ok@example.com, not-an-address'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('not-an-address', str(response.context['form'].errors['recipients']))
+        self.assertFalse(EmailMessage.objects.exists())
+        
+        self.client.post(reverse('send_email'), dict(fields, recipients='a@Example.COM; b@bücher.de,\na@example.com'))
+        self.assertEqual(EmailMessage.objects.get().recipients, 'a@example.com,b@xn--bcher-kva.de')
     
     @patch('email_app.views.DNSManager')
     def test_dns_management_view(self, mock_dns_manager):
         # Mock DNS manager
         mock_manager = MagicMock()
         mock_manager.create_mx_record.return_value = (True, 'MX record created successfully')
+        mock_manager.domain = 'example.com'
         mock_dns_manager.return_value = mock_manager
         
         # Test creating an MX record
@@ -185,6 +2358,853 @@ class ViewTests(TestCase):
         mock_manager.create_mx_record.assert_called_once_with('mail.example.com', 10)
 
 
+class EmailHistoryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+        self.other = User.objects.create_user(username='other', password='testpassword')
+        self.client = Client()
+        self.client.login(username='testuser', password='testpassword')
+        
+        self.emails = EmailMessage.objects.bulk_create([
+            EmailMessage(sender='noreply@example.com' if i % 2 else 'news@example.com',
+                         recipients=f'user{i}@example.com', subject=f'Email {i}', body='Body',
+                         status='SENT' if i % 3 else 'FAILED', created_by=self.user)
+            for i in range(25)
+        ])
+        for email in self.emails:
+            email.save_recipients()
+        # Shared timestamps make the id tie-breaker matter
+        base = timezone.now()
+        for i, email in enumerate(self.emails):
+            EmailMessage.objects.filter(pk=email.pk).update(sent_at=base - timedelta(minutes=i // 4))
+        EmailMessage.objects.create(sender='noreply@example.com', recipients='user0@example.com',
+                                    subject='Not mine', body='Body', created_by=self.other)
+    
+    def walk(self, **params):
+        seen, cursor = [], None
+        while True:
+            query = dict(params, limit=7)
+            if cursor:
+                query['cursor'] = cursor
+            data = self.client.get(reverse('email_history_api'), query).json()
+            seen.extend(row['id'] for row in data['results'])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return seen
+    
+    def test_api_pages_through_every_message_once_in_order(self):
+        seen = self.walk()
+        
+        expected = list(
+            EmailMessage.objects.filter(created_by=self.user)
+            .order_by('-sent_at', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(seen, expected)
+    
+    def test_api_filters(self):
+        self.assertEqual(len(self.walk(status='FAILED')), 9)
+        self.assertEqual(len(self.walk(sender='news@example.com')), 13)
+        self.assertEqual(self.walk(recipient='user3@EXAMPLE.com'), [self.emails[3].pk])
+    
+    def test_list_pages_do_not_load_bodies(self):
+        emails, next_cursor = history_page(history_queryset(self.user), limit=10)
+        
+        self.assertEqual(len(emails), 10)
+        self.assertIsNotNone(next_cursor)
+        self.assertTrue({'body', 'html_body'} <= emails[0].get_deferred_fields())
+    
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('email_history_api'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        
+        # The HTML view falls back to the first page
+        response = self.client.get(reverse('email_history'), {'cursor': 'not-a-cursor', 'status': 'SENT'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Email 1<')
+        self.assertNotContains(response, 'Not mine')
+
+
+@benchmark
+class HistoryPaginationBenchmark(TestCase):
+    """Keyset paging stays flat with depth where OFFSET paging degrades"""
+    
+    PAGE_SIZE = 10
+    PAGES = 10000
+    REPEAT = 20
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpassword')
+        EmailMessage.objects.bulk_create(
+            (
+                EmailMessage(sender='noreply@example.com', recipients=f'user{i}@example.com',
+                             subject=f'Email {i}', body='x' * 2000, status='SENT', created_by=self.user)
+                for i in range(self.PAGE_SIZE * self.PAGES)
+            ),
+            batch_size=5000
+        )
+    
+    def timed(self, fetch):
+        timings = []
+        for _ in range(self.REPEAT):
+            start = time.perf_counter()
+            rows = fetch()
+            timings.append(time.perf_counter() - start)
+        self.assertEqual(len(rows), self.PAGE_SIZE)
+        return sorted(timings)[len(timings) // 2]
+    
+    def test_deep_page_time_stays_flat(self):
+        queryset = history_queryset(self.user)
+        offset = self.PAGE_SIZE * (self.PAGES - 1)
+        cursor = encode_cursor(queryset[offset - 1])
+        
+        first = self.timed(lambda: history_page(queryset, limit=self.PAGE_SIZE)[0])
+        keyset = self.timed(lambda: history_page(queryset, cursor, limit=self.PAGE_SIZE)[0])
+        offset_time = self.timed(lambda: list(queryset[offset:offset + self.PAGE_SIZE]))
+        
+        report(f"History page {self.PAGES:,}: keyset {keyset * 1000:.2f} ms, OFFSET {offset_time * 1000:.2f} ms "
+               f"(page 1: {first * 1000:.2f} ms)")
+
+@override_settings(EMAIL_DOMAIN='verify.example.com')
+class DNSMonitorTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpassword'
+        )
+        self.client = Client()
+        self.client.login(username='testuser', password='testpassword')
+        
+        domain = 'verify.example.com'
+        self.resolver = FakeResolver({
+            (domain, 'MX'): FakeAnswer([mx_rdata(10, 'mail.verify.example.com.')], ttl=120),
+            (domain, 'TXT'): FakeAnswer([txt_rdata(b'v=spf1 include:spf.protection.outlook.com -all')]),
+            (f's1._domainkey.{domain}', 'TXT'): FakeAnswer([txt_rdata(b'v=DKIM1; k=rsa; p=MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQ')]),
+        })
+        patcher = patch.object(DNSVerificationEngine, 'resolver', new_callable=PropertyMock, return_value=self.resolver)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def make_monitor(self):
+        return DNSMonitor(min_interval=60, max_interval=3600)
+    
+    def test_monitor_marks_each_record_from_its_own_answer(self):
+        published = [
+            DNSRecord.objects.create(domain='verify.example.com', record_type='MX',
+                                     value='Priority: 10, Server: mail.verify.example.com'),
+            DNSRecord.objects.create(domain='verify.example.com', record_type='SPF',
+                                     value='v=spf1 include:spf.protection.outlook.com -all'),
+            DNSRecord.objects.create(domain='verify.example.com', record_type='DKIM',
+                                     value='Selector: s1, Value: v=DKIM1; k=rsa; p=MIGfMA0GCSqGS...'),
+        ]
+        missing = [
+            DNSRecord.objects.create(domain='verify.example.com', record_type='MX',
+                                     value='Priority: 20, Server: mail.verify.example.com'),
+            DNSRecord.objects.create(domain='verify.example.com', record_type='DKIM',
+                                     value='Selector: s2, Value: v=DKIM1; k=rsa; p=MIGfMA0GCSqGS...'),
+        ]
+        
+        self.assertEqual(self.make_monitor().run_once(), 1)
+        
+        for record in published:
+            record.refresh_from_db()
+            self.assertTrue(record.verified, record.value)
+            self.assertIsNotNone(record.last_verified)
+        for record in missing:
+            record.refresh_from_db()
+            self.assertFalse(record.verified, record.value)
+            self.assertIsNotNone(record.last_verified)
+        
+        state = DNSDomainState.objects.get(domain='verify.example.com')
+        self.assertEqual(state.min_ttl, 120)
+        self.assertIn('Found SPF record: v=spf1 include:spf.protection.outlook.com -all', state.summary)
+    
+    def test_unchanged_answers_are_not_written_and_drift_is_reported(self):
+        DNSRecord.objects.create(domain='verify.example.com', record_type='MX',
+                                 value='Priority: 10, Server: mail.verify.example.com')
+        monitor = self.make_monitor()
+        monitor.run_once()
+        self.assertEqual(DNSAnswerHistory.objects.count(), 3)
+        
+        # Not due yet: the shortest TTL (120s) has not elapsed
+        self.assertEqual(monitor.run_once(), 0)
+        
+        # Due again with identical answers: read-only
+        monitor._next_check.clear()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(monitor.run_once(), 1)
+        self.assertFalse([q for q in queries.captured_queries if not q['sql'].startswith('SELECT')])
+        
+        # The SPF record disappears and the MX priority changes
+        self.resolver.records[('verify.example.com', 'TXT')] = FakeAnswer([txt_rdata(b'google-site-verification=abc')])
+        self.resolver.records[('verify.example.com', 'MX')] = FakeAnswer([mx_rdata(20, 'mail.verify.example.com.')])
+        monitor.engine.cache.clear()
+        monitor._next_check.clear()
+        received = []
+        handler = lambda sender, domain, events, **kwargs: received.extend(events)
+        dns_drift_detected.connect(handler)
+        self.addCleanup(dns_drift_detected.disconnect, handler)
+        
+        with self.assertLogs('email_app.dns_monitor', 'WARNING'):
+            monitor.run_once()
+        
+        self.assertEqual(
+            sorted(event['type'] for event in received),
+            ['mx_priority_changed', 'spf_removed']
+        )
+        self.assertEqual(DNSAnswerHistory.objects.filter(domain='verify.example.com').count(), 5)
+        self.assertFalse(DNSRecord.objects.get().verified)
+    
+    def test_monitor_query_count_does_not_grow_with_records(self):
+        DNSRecord.objects.bulk_create([
+            DNSRecord(domain='verify.example.com', record_type='MX',
+                      value=f'Priority: {i}, Server: mx{i}.verify.example.com')
+            for i in range(300)
+        ])
+        
+        with CaptureQueriesContext(connection) as queries:
+            self.make_monitor().run_once()
+        
+        updates = [q['sql'] for q in queries.captured_queries
+                   if q['sql'].startswith('UPDATE "email_app_dnsrecord"')]
+        # A handful of batched UPDATEs (the batch size is capped by the
+        # backend's parameter limit) instead of one per record
+        self.assertLessEqual(len(updates), 3)
+        self.assertLessEqual(len(queries.captured_queries), 16)
+        self.assertEqual(DNSRecord.objects.filter(verified=False, last_verified__isnull=False).count(), 300)
+    
+    def test_view_requests_refresh_without_live_lookups(self):
+        DNSRecord.objects.create(domain='verify.example.com', record_type='MX',
+                                 value='Priority: 10, Server: mail.verify.example.com')
+        monitor = self.make_monitor()
+        monitor.run_once()
+        self.resolver.calls.clear()
+        
+        response = self.client.post(reverse('dns_management'), {'verify_dns': True})
+        self.assertRedirects(response, reverse('dns_management'))
+        response = self.client.get(reverse('dns_management'))
+        
+        self.assertEqual(self.resolver.calls, [])
+        self.assertContains(response, 'Found 1 MX records for verify.example.com')
+        self.assertTrue(DNSDomainState.objects.get(domain='verify.example.com').refresh_requested)
+        
+        # The requested domain is checked on the next pass even though it is not due
+        self.assertEqual(monitor.run_once(), 1)
+        self.assertFalse(DNSDomainState.objects.get(domain='verify.example.com').refresh_requested)
+
+
+class RoundCubeSyncTests(TestCase):
+    # The columns of RoundCube's users and identities tables the sync writes
+    SCHEMA = (
+        "CREATE TABLE users (user_id INTEGER PRIMARY KEY AUTOINCREMENT, username VARCHAR(128) NOT NULL, "
+        "mail_host VARCHAR(128) NOT NULL, created DATETIME NOT NULL, language VARCHAR(16), "
+        "UNIQUE (username, mail_host))",
+        "CREATE TABLE identities (identity_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "user_id INTEGER NOT NULL REFERENCES users (user_id), changed DATETIME NOT NULL, "
+        "del SMALLINT NOT NULL DEFAULT 0, standard SMALLINT NOT NULL DEFAULT 0, "
+        "name VARCHAR(128) NOT NULL, email VARCHAR(128) NOT NULL)",
+    )
+    
+    def setUp(self):
+        # A separate in-memory SQLite database stands in for RoundCube's
+        self.roundcube = ConnectionHandler({
+            'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        })['default']
+        self.addCleanup(self.roundcube.close)
+        with self.roundcube.cursor() as cursor:
+            for statement in self.SCHEMA:
+                cursor.execute(statement)
+    
+    def rows(self, sql):
+        with self.roundcube.cursor() as cursor:
+            cursor.execute(sql)
+            return cursor.fetchall()
+    
+    def accounts(self):
+        return self.rows(
+            'SELECT u.username, u.mail_host, i.name FROM users u '
+            'JOIN identities i ON i.user_id = u.user_id AND i.standard = 1 ORDER BY u.username'
+        )
+    
+    def sync(self, **kwargs):
+        # No look-back past the mark, so a run right after another sees only what changed in between
+        return RoundCubeUserSync(connection=self.roundcube, mail_host='mail.example.com', overlap=timedelta(0), **kwargs)
+    
+    def test_first_run_provisions_active_users_in_batches(self):
+        for i in range(30):
+            User.objects.create_user(f'user{i}', f'User{i}@Example.com', first_name='User', last_name=str(i))
+        User.objects.create_user('inactive', 'inactive@example.com', is_active=False)
+        User.objects.create_user('no-email', '')
+        with self.roundcube.cursor() as cursor:
+            # Created by RoundCube itself on an earlier login
+            cursor.execute(
+                "INSERT INTO users (username, mail_host, created) VALUES ('user0@example.com', 'mail.example.com', '2024-01-01')"
+            )
+            cursor.execute(
+                "INSERT INTO identities (user_id, changed, standard, name, email) VALUES (1, '2024-01-01', 1, '', 'user0@example.com')"
+            )
+        
+        with CaptureQueriesContext(self.roundcube) as statements:
+            stats = self.sync(chunk_size=20).run()
+        
+        self.assertEqual((stats.checked, stats.created, stats.updated, stats.deleted), (32, 30, 0, 0))
+        self.assertEqual(self.rows('SELECT COUNT(*) FROM users')[0][0], 30)
+        self.assertEqual(self.accounts()[0], ('user0@example.com', 'mail.example.com', 'User 0'))
+        self.assertEqual(len(self.accounts()), 30)
+        # Per chunk of users: a lookup, the users, their ids, the identities and the adopted identities
+        statements = [query['sql'] for query in statements if query['sql'] not in ('BEGIN', 'COMMIT')]
+        self.assertEqual(len(statements), 9)
+        self.assertEqual(RoundCubeAccount.objects.filter(rc_user_id__isnull=False).count(), 30)
+        self.assertFalse(RoundCubeAccount.objects.filter(rc_user_id__isnull=True).exists())
+    
+    def test_later_runs_only_touch_changed_users(self):
+        users = [User.objects.create_user(f'user{i}', f'user{i}@example.com') for i in range(10)]
+        self.sync().run()
+        
+        renamed, retitled, deactivated, deleted = users[:4]
+        renamed.email = 'renamed@example.com'
+        renamed.save()
+        retitled.first_name = 'New'
+        retitled.save()
+        deactivated.is_active = False
+        deactivated.save()
+        deleted.delete()
+        User.objects.create_user('new', 'new@example.com')
+        # Logins only touch last_login and are not changes
+        users[5].last_login = timezone.now()
+        users[5].save(update_fields=['last_login'])
+        
+        stats = self.sync().run()
+        self.assertEqual((stats.checked, stats.created, stats.updated, stats.deleted), (5, 1, 2, 2))
+        usernames = [row[0] for row in self.accounts()]
+        self.assertIn('renamed@example.com', usernames)
+        self.assertIn('new@example.com', usernames)
+        self.assertNotIn('user0@example.com', usernames)
+        self.assertNotIn('user2@example.com', usernames)
+        self.assertNotIn('user3@example.com', usernames)
+        self.assertIn(('user1@example.com', 'mail.example.com', 'New'), self.accounts())
+        self.assertEqual(self.rows('SELECT COUNT(*) FROM identities')[0][0], 9)
+        self.assertFalse(RoundCubeAccount.objects.filter(user_id__in=[deactivated.pk, deleted.pk]).exists())
+        
+        with self.assertNumQueries(3):
+            stats = self.sync().run()
+        self.assertEqual(stats.created + stats.updated + stats.deleted, 0)
+    
+    def test_users_sharing_an_email_get_one_account(self):
+        first = User.objects.create_user('first', 'shared@example.com')
+        second = User.objects.create_user('second', 'Shared@example.com')
+        User.objects.create_user('other', 'other@example.com')
+        
+        with self.assertLogs('email_app.roundcube_sync', 'WARNING'):
+            stats = self.sync().run()
+        self.assertEqual((stats.created, stats.conflicts), (2, 1))
+        self.assertEqual(self.rows("SELECT COUNT(*) FROM users WHERE username = 'shared@example.com'")[0][0], 1)
+        self.assertIsNotNone(RoundCubeAccount.objects.get(user_id=first.pk).rc_user_id)
+        self.assertIsNone(RoundCubeAccount.objects.get(user_id=second.pk).rc_user_id)
+        
+        # Deleting the skipped user leaves the owner's mailbox alone
+        second.delete()
+        self.sync().run()
+        self.assertEqual(self.rows("SELECT COUNT(*) FROM users WHERE username = 'shared@example.com'")[0][0], 1)
+        
+        # Once the owner lets the username go, a waiting user takes it over
+        third = User.objects.create_user('third', 'shared@example.com')
+        with self.assertLogs('email_app.roundcube_sync', 'WARNING'):
+            self.sync().run()
+        first.email = 'first@example.com'
+        first.save()
+        # Both in one chunk: the rename has to land before the new account is created
+        self.sync().run(full=True)
+        accounts = RoundCubeAccount.objects.in_bulk([first.pk, third.pk], field_name='user_id')
+        self.assertIsNotNone(accounts[third.pk].rc_user_id)
+        self.assertNotEqual(accounts[third.pk].rc_user_id, accounts[first.pk].rc_user_id)
+        self.assertEqual(
+            sorted(row[0] for row in self.accounts()),
+            ['first@example.com', 'other@example.com', 'shared@example.com']
+        )
+    
+    def test_full_run_repairs_changes_made_without_signals(self):
+        users = [User.objects.create_user(f'user{i}', f'user{i}@example.com') for i in range(3)]
+        self.sync().run()
+        User.objects.filter(pk=users[0].pk).update(email='moved@example.com')
+        
+        self.assertEqual(self.sync().run().updated, 0)
+        self.assertEqual(self.sync().run(full=True).updated, 1)
+        self.assertIn('moved@example.com', [row[0] for row in self.accounts()])
+    
+    def test_integrator_reports_result(self):
+        User.objects.create_user('user', 'user@example.com')
+        with patch('email_app.roundcube_integration.RoundCubeUserSync', lambda: self.sync()):
+            success, message = RoundCubeIntegrator().sync_users_from_django()
+        self.assertTrue(success)
+        self.assertIn('1 created', message)
+
+class RoundCubeSSOTests(TestCase):
+    def setUp(self):
+        reset_sso_service()
+        self.addCleanup(reset_sso_service)
+    
+    def test_token_is_single_use(self):
+        service = SSOTokenService(keys={'k1': 'secret'})
+        token = service.issue('user@example.com', '?_task=mail')
+        claims = service.verify(token)
+        self.assertEqual((claims.email, claims.redirect_to), ('user@example.com', '?_task=mail'))
+        with self.assertRaisesMessage(InvalidToken, 'already used'):
+            service.verify(token)
+    
+    def test_rejects_forged_expired_and_malformed_tokens(self):
+        service = SSOTokenService(keys={'k1': 'secret'}, ttl=60)
+        key_id, claims, signature = service.issue('user@example.com').split('.')
+        other = SSOTokenService(keys={'k1': 'secret'}).issue('admin@example.com').split('.')[1]
+        for token in (f'{key_id}.{other}.{signature}', f'k2.{claims}.{signature}', 'garbage', None):
+            with self.assertRaises(InvalidToken):
+                service.verify(token)
+        
+        with patch('email_app.sso.time.time', return_value=time.time() - 120):
+            expired = service.issue('user@example.com')
+        with self.assertRaisesMessage(InvalidToken, 'expired'):
+            service.verify(expired)
+    
+    def test_rotated_keys_still_verify(self):
+        old = SSOTokenService(keys={'2024': 'old secret'})
+        token = old.issue('user@example.com')
+        rotated = SSOTokenService(keys={'2025': 'new secret', '2024': 'old secret'})
+        self.assertEqual(rotated.verify(token).email, 'user@example.com')
+        self.assertTrue(rotated.issue('user@example.com').startswith('2025.'))
+        with self.assertRaises(InvalidToken):
+            SSOTokenService(keys={'2025': 'new secret'}).verify(old.issue('user@example.com'))
+    
+    def test_replay_cache_evicts_expired_ids_and_stays_bounded(self):
+        cache = ReplayCache(max_entries=2)
+        self.assertTrue(cache.add('a', 1, 60))
+        self.assertFalse(cache.add('a', 1, 60))
+        self.assertTrue(cache.add('b', 1, 60))
+        # Full of unexpired ids: refuse instead of forgetting one
+        self.assertFalse(cache.add('c', 1, 60))
+        with patch('email_app.sso.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertTrue(cache.add('c', 1, 60))
+            self.assertEqual(len(cache), 1)
+    
+    def test_shared_django_cache_as_replay_cache(self):
+        shared = LocMemCache('sso-test', {})
+        token = SSOTokenService(keys={'k1': 'secret'}, replay_cache=shared).issue('user@example.com')
+        SSOTokenService(keys={'k1': 'secret'}, replay_cache=shared).verify(token)
+        with self.assertRaises(InvalidToken):
+            SSOTokenService(keys={'k1': 'secret'}, replay_cache=shared).verify(token)
+    
+    @override_settings(ROUNDCUBE_SSO_VALIDATION_SECRET='plugin-secret', ROUNDCUBE_URL='https://mail.example.com')
+    def test_validation_endpoint(self):
+        success, url = RoundCubeIntegrator().generate_sso_url('user+tag@example.com', '?_task=mail&_mbox=INBOX')
+        self.assertTrue(success)
+        self.assertTrue(url.startswith('https://mail.example.com/?_action=sso&_sso_token='))
+        token = url.rpartition('=')[2]
+        self.assertNotIn('+', token)
+        
+        client = Client()
+        endpoint = reverse('roundcube_sso_validate')
+        self.assertEqual(client.post(endpoint, {'token': token}).status_code, 403)
+        response = client.post(endpoint, {'token': token}, HTTP_X_SSO_SECRET='plugin-secret')
+        self.assertEqual(response.json(), {'valid': True, 'email': 'user+tag@example.com', 'redirect': '?_task=mail&_mbox=INBOX'})
+        response = client.post(endpoint, {'token': token}, HTTP_X_SSO_SECRET='plugin-secret')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json()['error'], 'Token already used')
+
+
+@benchmark
+class SSOTokenBenchmark(TestCase):
+    def test_issue_and_verify_throughput(self):
+        service = SSOTokenService(keys={'2025': 'new secret', '2024': 'old secret'})
+        count = 20000
+        started = time.perf_counter()
+        for i in range(count):
+            service.verify(service.issue(f'user{i}@example.com'))
+        elapsed = time.perf_counter() - started
+        report(f"SSO: {count / elapsed:,.0f} logins/s issued and verified, {len(service.replay_cache)} ids held")
+        self.assertEqual(len(service.replay_cache), count)
+
+class RoundCubeConfigTests(TestCase):
+    FIXTURES = os.path.join(os.path.dirname(__file__), 'test_data', 'roundcube')
+    
+    def config_file(self, name='config.inc.php'):
+        # Laid out like a RoundCube installation: <ROUNDCUBE_PATH>/config/config.inc.php
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        os.mkdir(os.path.join(directory.name, 'config'))
+        path = os.path.join(directory.name, 'config', 'config.inc.php')
+        with open(os.path.join(self.FIXTURES, name)) as source, open(path, 'w') as target:
+            target.write(source.read())
+        return path
+    
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+    
+    def test_parses_assignments_into_values(self):
+        config = RoundCubeConfigFile(self.config_file()).read()
+        self.assertEqual(config['smtp_server'], 'tls://smtp.example.com')
+        self.assertEqual(config['smtp_port'], 587)
+        self.assertEqual(config['support_url'], 'https://example.com/support?a=1;b=2')
+        self.assertEqual(config['plugins'], ['archive', 'zipdownload'])
+        self.assertEqual(config['smtp_conn_options'], {'ssl': {'verify_peer': True, 'cafile': '/etc/ssl/certs/ca.pem'}})
+        self.assertIs(config['enable_spellcheck'], False)
+        self.assertEqual(config['log_dir'], PHPExpression("RCUBE_INSTALL_PATH . 'logs/'"))
+        
+        config = RoundCubeConfigFile(self.config_file('config.closing-tag.inc.php')).read()
+        self.assertEqual(config['product_name'], 'Webmail "Example"')
+        self.assertEqual(config['default_host'], 'imap.example.com')
+    
+    def test_rewrites_only_changed_keys(self):
+        path = self.config_file()
+        original = self.read(path)
+        update = RoundCubeConfigFile(path).update({
+            'smtp_server': 'tls://smtp.example.com',
+            'smtp_port': 465,
+            'smtp_user': '%u',
+        })
+        self.assertEqual(update.changed, ['smtp_port', 'smtp_user'])
+        self.assertTrue(update.written)
+        self.assertEqual(
+            self.read(path),
+            original.replace("$config['smtp_port'] = 587;", "$config['smtp_port'] = 465;") + "$config['smtp_user'] = '%u';\n"
+        )
+        self.assertEqual(RoundCubeConfig(self.read(path))['smtp_port'], 465)
+    
+    def test_unchanged_content_is_not_written(self):
+        path = self.config_file()
+        before = os.stat(path)
+        update = RoundCubeConfigFile(path).update({'smtp_port': 587, 'plugins': ['archive', 'zipdownload']})
+        self.assertFalse(update.written)
+        self.assertEqual(update.changed, [])
+        self.assertEqual(os.stat(path).st_ino, before.st_ino)
+        # 1 is not true, so the key is rewritten
+        self.assertEqual(RoundCubeConfigFile(path).update({'enable_spellcheck': 0}).changed, ['enable_spellcheck'])
+    
+    def test_new_keys_go_before_closing_tag(self):
+        path = self.config_file('config.closing-tag.inc.php')
+        RoundCubeConfigFile(path).update({'default_host': 'ssl://imap.example.com', 'des_key': "it's a key"})
+        text = self.read(path)
+        self.assertTrue(text.endswith("$config['des_key'] = 'it\\'s a key';\n?>\n"))
+        self.assertIn("$config['default_host'] = 'localhost';", text)
+        config = RoundCubeConfig(text)
+        self.assertEqual((config['default_host'], config['des_key']), ('ssl://imap.example.com', "it's a key"))
+    
+    def test_concurrent_updates_keep_every_key(self):
+        path = self.config_file()
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: RoundCubeConfigFile(path).update({f'key_{i}': i}), range(32)))
+        config = RoundCubeConfigFile(path).read()
+        self.assertEqual([config[f'key_{i}'] for i in range(32)], list(range(32)))
+        self.assertEqual(config['smtp_port'], 587)
+    
+    def test_integrator_configures_smtp(self):
+        path = self.config_file()
+        with override_settings(ROUNDCUBE_PATH=os.path.dirname(os.path.dirname(path))):
+            integrator = RoundCubeIntegrator()
+        success, message = integrator.configure_smtp_settings('smtp.azurecomm.net', 587)
+        self.assertTrue(success)
+        self.assertEqual(message, 'Updated RoundCube SMTP settings: smtp_server, smtp_user, smtp_pass, smtp_auth_type')
+        self.assertEqual(RoundCubeConfigFile(path).read()['smtp_server'], 'tls://smtp.azurecomm.net')
+        success, message = integrator.configure_smtp_settings('smtp.azurecomm.net', 587)
+        self.assertEqual(message, 'RoundCube SMTP settings are already up to date')
+
+class DashboardTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='dashboard', password='password')
+        caches['default'].clear()
+        self.service = MagicMock()
+        self.service.send_email.return_value = SendResult.sent('Email sent successfully', 'smtp', '<id@example.com>')
+        self.service.send_email_direct_api.return_value = SendResult.failed(ValueError('Bad sender'), 'Bad sender')
+    
+    def message(self, **kwargs):
+        fields = {
+            'sender': 'noreply@example.com',
+            'recipients': 'one@gmail.com,two@example.com',
+            'subject': 'Dashboard',
+            'body': 'Body',
+            'status': 'QUEUED',
+            'created_by': self.user,
+        }
+        fields.update(kwargs)
+        email = EmailMessage.objects.create(**fields)
+        email.save_recipients()
+        return email
+    
+    def rollups(self):
+        return (
+            sorted(EmailDailyStat.objects.filter(count__gt=0).values_list('user_id', 'day', 'status', 'count')),
+            sorted(EmailDomainDailyStat.objects.filter(count__gt=0).values_list('user_id', 'day', 'domain', 'count')),
+        )
+    
+    def test_finished_sends_update_rollups(self):
+        self.message()
+        self.message(recipients='three@example.com')
+        self.message(use_direct_api=True)
+        worker = OutboxWorker(worker_id='worker-1', service=self.service)
+        with self.captureOnCommitCallbacks(execute=True):
+            worker.run_once()
+        worker.close()
+        
+        stats = compute_dashboard(self.user.pk, 30)
+        self.assertEqual((stats['sent'], stats['delivered'], stats['failed']), (2, 0, 1))
+        self.assertEqual(stats['per_day'][-1], {'day': timezone.localdate(), 'sent': 2, 'delivered': 0, 'failed': 1})
+        self.assertEqual(len(stats['per_day']), 30)
+        self.assertEqual(stats['top_domains'], [('example.com', 3), ('gmail.com', 2)])
+    
+    def test_delivery_reports_move_messages_between_statuses(self):
+        email = self.message(status='SENT', provider_message_id='op-1')
+        record_outcomes([(self.user.pk, email.sent_at, email.recipient_list(), None, 'SENT')])
+        
+        apply_delivery_reports([('op-1', 'one@gmail.com', 'Delivered', None), ('op-1', 'two@example.com', 'Delivered', None)])
+        stats = compute_dashboard(self.user.pk, 30)
+        self.assertEqual((stats['sent'], stats['delivered'], stats['failed']), (1, 1, 0))
+        # Domains are counted once per message, not per status change
+        self.assertEqual(stats['top_domains'], [('example.com', 1), ('gmail.com', 1)])
+    
+    def test_report_and_reconciler_count_a_message_once(self):
+        email = self.message(status='ACCEPTED', provider_message_id='op-2', use_direct_api=True,
+                             transport='api', continuation_token='token-2')
+        EmailRecipient.objects.filter(message=email).update(status='ACCEPTED')
+        service = MagicMock()
+        service.get_operation_status.return_value = {'status': 'Succeeded'}
+        reconciler = DeliveryReconciler(service=service)
+        reconciler.run_once()
+        reconciler.close()
+        
+        # The report arrives after polling settled the message: SENT -> DELIVERED, not ACCEPTED -> DELIVERED
+        apply_delivery_reports([('op-2', 'one@gmail.com', 'Delivered', None), ('op-2', 'two@example.com', 'Delivered', None)])
+        email.refresh_from_db()
+        self.assertEqual(email.status, 'DELIVERED')
+        stats = compute_dashboard(self.user.pk, 30)
+        self.assertEqual((stats['sent'], stats['delivered'], stats['failed']), (1, 1, 0))
+        self.assertEqual(stats['top_domains'], [('example.com', 1), ('gmail.com', 1)])
+    
+    def test_reads_are_cached_until_a_write(self):
+        self.assertEqual(dashboard_stats(self.user)['failed'], 0)
+        with self.assertNumQueries(0):
+            dashboard_stats(self.user)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            record_outcomes([(self.user.pk, timezone.now(), ['x@example.com'], None, 'FAILED')])
+        self.assertEqual(dashboard_stats(self.user)['failed'], 1)
+    
+    def test_rebuild_matches_incremental_rollups(self):
+        for i in range(3):
+            self.message(recipients=f'user{i}@example.com,other{i}@Example.org')
+        self.message(use_direct_api=True)
+        worker = OutboxWorker(worker_id='worker-1', service=self.service)
+        worker.run_once()
+        worker.close()
+        incremental = self.rollups()
+        
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('rebuild_dashboard_stats', stdout=out)
+        self.assertIn('Wrote 5 rollup rows', out.getvalue())
+        self.assertEqual(self.rollups(), incremental)
+        
+        # Only recent days are replaced when asked
+        old = self.message(status='SENT')
+        EmailMessage.objects.filter(pk=old.pk).update(sent_at=timezone.now() - timedelta(days=100))
+        call_command('rebuild_dashboard_stats', days=7, stdout=out)
+        self.assertEqual(self.rollups(), incremental)
+        call_command('rebuild_dashboard_stats', stdout=out)
+        self.assertEqual(compute_dashboard(self.user.pk, 30)['sent'], 3)
+        self.assertEqual(compute_dashboard(self.user.pk, 120)['sent'], 4)
+    
+    def test_index_shows_figures(self):
+        record_outcomes([(self.user.pk, timezone.now(), ['a@example.com', 'b@example.com'], None, 'SENT')])
+        self.client.login(username='dashboard', password='password')
+        response = self.client.get(reverse('index'))
+        self.assertEqual(response.context['stats']['sent'], 1)
+        self.assertContains(response, 'Top Recipient Domains')
+        self.assertContains(response, 'example.com')
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+        self.client.login(username='admin', password='password')
+    
+    def message(self, subject='Hello', recipients='one@example.com', body='Body', **kwargs):
+        return EmailMessage.objects.create(sender='noreply@example.com', recipients=recipients, subject=subject,
+                                           body=body, created_by=kwargs.pop('created_by', self.admin), **kwargs)
+    
+    def search(self, term):
+        return set(full_text_filter(EmailMessage.objects.all(), term).values_list('subject', flat=True))
+    
+    def test_search_uses_full_text_index(self):
+        self.message('Quarterly invoice', recipients='alice@example.com,bob@example.org')
+        self.message('Invoice reminder', body='Please pay the outstanding balance')
+        self.message('Newsletter', recipients='carol@example.net')
+        
+        self.assertEqual(self.search('invoice'), {'Quarterly invoice', 'Invoice reminder'})
+        self.assertEqual(self.search('INVO'), {'Quarterly invoice', 'Invoice reminder'})
+        self.assertEqual(self.search('invoice outstanding'), {'Invoice reminder'})
+        self.assertEqual(self.search('alice@example.com'), {'Quarterly invoice'})
+        self.assertEqual(self.search('"pay the"'), {'Invoice reminder'})
+        self.assertEqual(self.search('missing'), set())
+        
+        response = self.client.get(reverse('admin:email_app_emailmessage_changelist'), {'q': 'carol@example.net'})
+        self.assertEqual([obj.subject for obj in response.context['cl'].result_list], ['Newsletter'])
+    
+    def test_index_follows_updates_and_deletes(self):
+        email = self.message('Original subject')
+        self.assertEqual(self.search('original'), {'Original subject'})
+        
+        email.subject = 'Renamed subject'
+        email.save()
+        EmailMessage.objects.filter(pk=email.pk).update(status='SENT')
+        self.assertEqual(self.search('original'), set())
+        self.assertEqual(self.search('renamed'), {'Renamed subject'})
+        
+        email.delete()
+        self.assertEqual(self.search('renamed'), set())
+    
+    @patch.dict('email_app.search._fts_tables', clear=True)
+    def test_missing_triggers_fail_instead_of_serving_stale_results(self):
+        self.assertTrue(has_search_index(connection))
+        self.assertEqual(check_search_index(databases=['default']), [])
+        
+        # What a later migration rebuilding the table on SQLite would leave behind
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER email_app_emailmessage_fts_update')
+        self.assertEqual([error.id for error in check_search_index(databases=['default'])], ['email_app.E001'])
+        with patch.dict('email_app.search._fts_tables', clear=True):
+            with self.assertRaises(ImproperlyConfigured):
+                has_search_index(connection)
+    
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:email_app_emailmessage_changelist')
+        many = ','.join(f'user{i}@example.com' for i in range(500))
+        self.message('Mass mailing', recipients=many)
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        
+        for i in range(10):
+            user = User.objects.create_user(username=f'sender{i}', password='password')
+            self.message(f'Message {i}', recipients='a@example.com, b@example.com, c@example.com', created_by=user)
+        with CaptureQueriesContext(connection) as more:
+            response = self.client.get(url)
+        self.assertEqual(len(more), len(few))
+        self.assertContains(response, 'user0@example.com, user1@example.com (+498 more)')
+        self.assertContains(response, 'a@example.com, b@example.com (+1 more)')
+        self.assertNotIn('user499@example.com', response.content.decode())
+    
+    def test_date_hierarchy_probes_periods_instead_of_a_distinct(self):
+        url = reverse('admin:email_app_emailmessage_changelist')
+        now = timezone.now()
+        old = self.message('Old', status='SENT')
+        EmailMessage.objects.filter(pk=old.pk).update(sent_at=now.replace(year=now.year - 2, month=3, day=15))
+        self.message('New', status='FAILED')
+        
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertContains(response, f'sent_at__year={now.year - 2}')
+        self.assertContains(response, f'sent_at__year={now.year}')
+        self.assertNotContains(response, f'sent_at__year={now.year - 1}')
+        self.assertFalse([q['sql'] for q in queries if 'DISTINCT' in q['sql']])
+        
+        response = self.client.get(url, {'sent_at__year': now.year - 2})
+        self.assertContains(response, 'sent_at__month=3')
+        self.assertNotContains(response, 'sent_at__month=4')
+        response = self.client.get(url, {'sent_at__year': now.year - 2, 'sent_at__month': 3})
+        self.assertContains(response, 'sent_at__day=15')
+        self.assertEqual(
+            list(EmailMessage.objects.datetimes('sent_at', 'month', order='DESC')),
+            SentAtProbeQuerySet(EmailMessage).datetimes('sent_at', 'month', order='DESC'),
+        )
+    
+    def test_estimated_count_above_threshold(self):
+        emails = [self.message(f'Message {i}') for i in range(8)]
+        EmailMessage.objects.filter(pk__in=[emails[0].pk, emails[1].pk]).delete()
+        
+        with override_settings(EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD=5):
+            # Unfiltered: estimated from the highest id on SQLite
+            self.assertEqual(EstimatedCountPaginator(EmailMessage.objects.all(), 10).count, emails[-1].pk)
+            # Filtered queries have no estimate here and are counted
+            self.assertEqual(EstimatedCountPaginator(EmailMessage.objects.filter(status='QUEUED'), 10).count, 6)
+        with override_settings(EMAIL_ADMIN_ESTIMATED_COUNT_THRESHOLD=10000):
+            self.assertEqual(EstimatedCountPaginator(EmailMessage.objects.all(), 10).count, 6)
+
+
+@benchmark
+class AdminChangelistBenchmark(TestCase):
+    """The EmailMessage changelist and its search over a million messages"""
+    
+    ROWS = 1_000_000
+    REPEAT = 5
+    
+    # One INSERT ... SELECT per backend, generating the rows in the database
+    ROW_VALUES = """
+        'noreply@example.com',
+        'user' || n || '@example.com,team' || (n %% 97) || '@example.org',
+        'Invoice ' || n || ' for order ' || (n %% 1000),
+        'Dear customer ' || (n %% 5000) || ', your statement is attached.',
+        {sent_at}, 'SENT', %s, false, 0
+    """
+    INSERT = """
+        INSERT INTO email_app_emailmessage
+            (sender, recipients, subject, body, sent_at, status, created_by_id, use_direct_api, attempts)
+    """
+    GENERATE = {
+        'sqlite': (
+            'WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s) '
+            + INSERT + ' SELECT ' + ROW_VALUES.format(sent_at="datetime('now', '-' || (n %% 365) || ' days')")
+            + ' FROM seq'
+        ),
+        'postgresql': (
+            INSERT + ' SELECT ' + ROW_VALUES.format(sent_at="now() - (n %% 365) * interval '1 day'")
+            + ' FROM generate_series(1, %s) AS n'
+        ),
+    }
+    
+    @classmethod
+    def setUpTestData(cls):
+        vendor = connection.vendor
+        if vendor not in cls.GENERATE:
+            raise unittest.SkipTest(f'No row generator for {vendor}')
+        cls.admin = User.objects.create_superuser(username='admin', email='admin@example.com', password='password')
+        params = [cls.ROWS, cls.admin.pk] if vendor == 'sqlite' else [cls.admin.pk, cls.ROWS]
+        start = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute(cls.GENERATE[vendor], params)
+            # Planner statistics, which the estimated counts read
+            cursor.execute('ANALYZE email_app_emailmessage')
+        report(f"Inserted {cls.ROWS:,} messages on {vendor} in {time.perf_counter() - start:.1f} s")
+    
+    def setUp(self):
+        self.client.login(username='admin', password='password')
+    
+    def timed(self, fetch):
+        timings = []
+        for _ in range(self.REPEAT):
+            start = time.perf_counter()
+            fetch()
+            timings.append(time.perf_counter() - start)
+        return sorted(timings)[len(timings) // 2]
+    
+    def test_changelist_and_search(self):
+        url = reverse('admin:email_app_emailmessage_changelist')
+        model_admin = admin_site._registry[EmailMessage]
+        term = 'user123456@example.com'
+        
+        page = self.timed(lambda: self.assertEqual(self.client.get(url).status_code, 200))
+        searched = self.timed(lambda: self.assertEqual(self.client.get(url, {'q': term}).status_code, 200))
+        fulltext = self.timed(lambda: self.assertEqual(full_text_filter(EmailMessage.objects.all(), term).count(), 1))
+        like = self.timed(lambda: self.assertEqual(
+            admin.ModelAdmin.get_search_results(model_admin, None, EmailMessage.objects.all(), term)[0].count(), 1
+        ))
+        estimated = self.timed(lambda: EstimatedCountPaginator(EmailMessage.objects.all(), 100).count)
+        exact = self.timed(lambda: EmailMessage.objects.count())
+        
+        report(f"Changelist over {self.ROWS:,} messages: page {page * 1000:.1f} ms, search {searched * 1000:.1f} ms; "
+               f"full-text {fulltext * 1000:.2f} ms vs LIKE {like * 1000:.1f} ms; "
+               f"estimated count {estimated * 1000:.2f} ms vs COUNT(*) {exact * 1000:.1f} ms")
+
 class ModelTests(TestCase):
     def setUp(self):
         # Create test user
@@ -228,4 +3248,78 @@ class ModelTests(TestCase):
         self.assertEqual(dns_record.record_type, 'MX')
         self.assertEqual(dns_record.value, 'Priority: 10, Server: mail.example.com')
         self.assertFalse(dns_record.verified)
-        self.assertIsNone(dns_record.last_verified)
\ No newline at end of file
+        self.assertIsNone(dns_record.last_verified)
+    
+    def test_email_recipients_are_split_and_deduplicated(self):
+        email = EmailMessage.objects.create(
+            sender='noreply@example.com',
+            recipients='One@Example.COM, two@example.com,,one@example.com , One@Example.COM',
+            subject='Test Email',
+            body='This is a test email.',
+            created_by=self.user
+        )
+        email.save_recipients()
+        # Saving twice does not duplicate rows
+        email.save_recipients()
+        
+        self.assertEqual(
+            sorted(EmailRecipient.objects.filter(message=email).values_list('address', flat=True)),
+            ['One@example.com', 'one@example.com', 'two@example.com']
+        )
+        self.assertEqual(
+            list(EmailMessage.objects.filter(recipient_rows__address='two@example.com')),
+            [email]
+        )
+    
+    def test_split_recipients_migration(self):
+        migration = importlib.import_module('email_app.migrations.0005_split_recipients')
+        emails = EmailMessage.objects.bulk_create([
+            EmailMessage(sender='noreply@example.com', recipients=f'a{i}@example.com, shared@Example.com',
+                         subject='Old', body='Old', status='SENT', created_by=self.user)
+            for i in range(3)
+        ])
+        
+        migration.split_recipients(django_apps, None)
+        
+        self.assertEqual(EmailRecipient.objects.count(), 6)
+        self.assertEqual(EmailRecipient.objects.filter(address='shared@example.com', status='SENT').count(), 3)
+        self.assertEqual(
+            set(EmailRecipient.objects.filter(message=emails[0]).values_list('address', flat=True)),
+            {'a0@example.com', 'shared@example.com'}
+        )
+    
+    def test_split_recipients_migration_matches_the_model(self):
+        migration = importlib.import_module('email_app.migrations.0005_split_recipients')
+        email = EmailMessage.objects.create(
+            sender='noreply@example.com', recipients='User@Bücher.DE, not-an-address',
+            subject='Old', body='Old', status='SENT', created_by=self.user
+        )
+        
+        migration.split_recipients(django_apps, None)
+        
+        for address in ('User@Bücher.DE', ' not-an-address'):
+            self.assertEqual(migration.normalize(address), EmailRecipient.normalize(address))
+        self.assertEqual(
+            list(EmailMessage.objects.filter(recipient_rows__address='User@xn--bcher-kva.de')),
+            [email]
+        )
+    
+    def test_split_recipients_migration_skips_addresses_too_long_to_store(self):
+        migration = importlib.import_module('email_app.migrations.0005_split_recipients')
+        too_long = 'x' * 300
+        email = EmailMessage.objects.create(
+            sender='noreply@example.com', recipients=f'one@example.com, {too_long}',
+            subject='Old', body='Old', status='SENT', created_by=self.user
+        )
+        
+        migration.split_recipients(django_apps, None)
+        
+        self.assertEqual(list(email.recipient_rows.values_list('address', flat=True)), ['one@example.com'])
+    
+    def test_history_queries_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('Query plan text is backend specific')
+        user_plan = EmailMessage.objects.filter(created_by=self.user).order_by('-sent_at').explain()
+        self.assertIn('email_user_sent_idx', user_plan)
+        recipient_plan = EmailRecipient.objects.filter(address='x@example.com').explain()
+        self.assertIn('email_recipient_address_idx', recipient_plan)
\ No newline at end of file
@@ -0,0 +1,423 @@
+# email_app/throttling.py
+import asyncio
+import logging
+import os
+import random
+import smtplib
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from email.utils import parsedate_to_datetime
+
+from asgiref.sync import sync_to_async
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+logger = logging.getLogger(__name__)
+
+# Direct API statuses worth another attempt; 429 and 503 also mean "slow down"
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUS_CODES = {429, 503}
+
+# SMTP replies Azure uses for throttling and other temporary failures
+RETRYABLE_SMTP_CODES = {421, 450, 451, 452, 454}
+THROTTLE_SMTP_CODES = {421, 450, 451, 452}
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a send cannot get a token or a concurrency slot in time"""
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_error(exc):
+    """
+    ``(retryable, throttled, retry_after)`` for an exception raised by a send.
+
+    ``retry_after`` comes from the provider's Retry-After (or
+    retry-after-ms) header when there is one.
+    """
+    if isinstance(exc, HttpResponseError) and exc.status_code is not None:
+        retry_after = None
+        headers = getattr(exc.response, 'headers', None) or {}
+        for header, scale in (('retry-after-ms', 1000), ('x-ms-retry-after-ms', 1000), ('Retry-After', 1)):
+            value = parse_retry_after(headers.get(header))
+            if value is not None:
+                retry_after = value / scale
+                break
+        return (
+            exc.status_code in RETRYABLE_STATUS_CODES,
+            exc.status_code in THROTTLE_STATUS_CODES,
+            retry_after,
+        )
+    if isinstance(exc, (ServiceRequestError, ServiceResponseError)):
+        return True, False, None
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code in RETRYABLE_SMTP_CODES, exc.smtp_code in THROTTLE_SMTP_CODES, None
+    return False, False, None
+
+
+def backoff_delay(attempt, retry_after=None, base=None, cap=None):
+    """Full-jitter exponential backoff, never shorter than the provider's Retry-After"""
+    base = base if base is not None else getattr(settings, 'EMAIL_SEND_RETRY_BACKOFF', 0.5)
+    cap = cap if cap is not None else getattr(settings, 'EMAIL_SEND_RETRY_BACKOFF_MAX', 30)
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    return max(delay, retry_after or 0)
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every process that uses the same Django cache.
+
+    Tokens are handed out as reservations on a single counter, so taking one
+    is one atomic ``incr``: reservation ``n`` may be used ``(n - burst) / rate``
+    seconds after the bucket was created. ``cache`` has to be shared by the
+    workers (Redis, memcached); with a local-memory cache every process
+    gets the full rate, which ``check_rate_limit_cache`` reports. A
+    provider's Retry-After pauses the whole bucket.
+    """
+
+    def __init__(self, name, rate, burst=None, cache=None):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = burst or max(int(rate), 1)
+        self.cache = cache or caches[getattr(settings, 'EMAIL_RATE_LIMIT_CACHE', 'default')]
+        self._origin_key = f'email-rate:{name}:origin'
+        self._count_key = f'email-rate:{name}:count'
+        self._paused_key = f'email-rate:{name}:paused-until'
+        self._skip_key = f'email-rate:{name}:skipping'
+
+    def _origin(self):
+        origin = self.cache.get(self._origin_key)
+        if origin is None:
+            self.cache.add(self._origin_key, time.time(), None)
+            self.cache.add(self._count_key, 0, None)
+            origin = self.cache.get(self._origin_key)
+        return origin
+
+    def reserve(self, tokens=1):
+        """Take ``tokens`` and return how many seconds to wait before using them"""
+        origin = self._origin()
+        try:
+            count = self.cache.incr(self._count_key, tokens)
+        except ValueError:
+            # The counter was evicted; start it again from here
+            self.cache.add(self._count_key, 0, None)
+            count = self.cache.incr(self._count_key, tokens)
+
+        now = time.time()
+        ready_at = origin + (count - self.burst) / self.rate
+        earliest = now - (self.burst - 1) / self.rate
+        if ready_at < earliest:
+            # Idle time must not bank more than ``burst`` tokens: skip the
+            # counter ahead as if this were the first token of a full bucket
+            self._skip_ahead(origin, earliest)
+            ready_at = earliest
+
+        paused_until = self.cache.get(self._paused_key) or 0
+        return max(ready_at - now, paused_until - now, 0.0)
+
+    def _skip_ahead(self, origin, earliest):
+        # One process at a time, sized from the counter as it is now, so
+        # processes waking from the same idle spell do not each skip it
+        if not self.cache.add(self._skip_key, 1, 1):
+            return
+        try:
+            count = self.cache.get(self._count_key) or 0
+            behind = int((earliest - origin - (count - self.burst) / self.rate) * self.rate + 1e-9)
+            if behind > 0:
+                self.cache.incr(self._count_key, behind)
+        except ValueError:
+            pass
+        finally:
+            self.cache.delete(self._skip_key)
+
+    def release(self, tokens=1):
+        """Give back a reservation that will not be used"""
+        try:
+            self.cache.decr(self._count_key, tokens)
+        except ValueError:
+            pass
+
+    def _check_timeout(self, delay, tokens, timeout):
+        if timeout is not None and delay > timeout:
+            self.release(tokens)
+            raise RateLimitTimeout(f"Rate limit {self.name} needs {delay:.1f}s, over the {timeout}s timeout")
+
+    def acquire(self, tokens=1, timeout=None):
+        """Wait for ``tokens``; RateLimitTimeout, with the tokens given back, if that takes over ``timeout``"""
+        delay = self.reserve(tokens)
+        self._check_timeout(delay, tokens, timeout)
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    async def aacquire(self, tokens=1, timeout=None):
+        """``acquire`` for coroutines: the cache round trip runs in a thread and the wait does not block the loop"""
+        delay = await sync_to_async(self.reserve, thread_sensitive=False)(tokens)
+        self._check_timeout(delay, tokens, timeout)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+    def pause(self, seconds):
+        """Stop handing out tokens for ``seconds``, e.g. after a Retry-After"""
+        until = time.time() + seconds
+        if until > (self.cache.get(self._paused_key) or 0):
+            self.cache.set(self._paused_key, until, int(seconds) + 1)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Cap on in-flight sends that adapts with AIMD: every successful send grows
+    the limit by ``increase / limit`` (about ``increase`` per round of sends),
+    and a throttling response multiplies it by ``decrease``, at most once per
+    ``cooldown`` seconds so one burst of 429s counts as a single signal.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, increase=1.0, decrease=0.5, cooldown=1.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """Hold one concurrency slot; the body reports back via ``on_success``/``on_throttle``"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise RateLimitTimeout(f"No send slot free within {timeout}s (limit {int(self.limit)})")
+                self._condition.wait(remaining)
+            self.in_flight += 1
+        try:
+            yield self
+        finally:
+            self._release()
+
+    # Coroutines cannot wait on the condition without blocking their loop, so they poll
+    ASYNC_POLL_INTERVAL = 0.01
+
+    @asynccontextmanager
+    async def aslot(self, timeout=None):
+        """``slot`` for coroutines, counted against the same limit as threaded sends"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    break
+            if deadline is not None and time.monotonic() >= deadline:
+                raise RateLimitTimeout(f"No send slot free within {timeout}s (limit {int(self.limit)})")
+            await asyncio.sleep(self.ASYNC_POLL_INTERVAL)
+        try:
+            yield self
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+
+
+class RetryBudget:
+    """
+    Allow retries only while they stay under ``ratio`` of recent requests (plus
+    ``min_per_second``), so a provider outage cannot turn into a retry storm.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, window=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.window = window
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        for events in (self._requests, self._retries):
+            while events and events[0] < now - self.window:
+                events.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_retry(self):
+        """Spend budget on one retry; False when the budget is exhausted"""
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = self.min_per_second * self.window + self.ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+
+class Throttle:
+    """Rate limit, adaptive concurrency and budgeted retries around provider calls"""
+
+    def __init__(self, bucket=None, limiter=None, budget=None, max_attempts=None, timeout=None):
+        self.bucket = bucket
+        self.limiter = limiter or AdaptiveConcurrencyLimiter()
+        self.budget = budget or RetryBudget()
+        self.max_attempts = max_attempts or getattr(settings, 'EMAIL_SEND_RETRY_MAX_ATTEMPTS', 4)
+        self.timeout = timeout
+
+    def call(self, send):
+        """
+        Return ``send()``, retrying retryable provider errors with jittered
+        backoff while attempts and the retry budget last. The last error is
+        re-raised once retrying stops.
+        """
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire(timeout=self.timeout)
+            with self.limiter.slot(self.timeout):
+                try:
+                    result = send()
+                except Exception as e:
+                    attempt += 1
+                    retry_after = self._failed(e, attempt)
+                else:
+                    self.limiter.on_success()
+                    return result
+            time.sleep(backoff_delay(attempt - 1, retry_after))
+
+    async def acall(self, send):
+        """``call`` for a coroutine function ``send``, under the same bucket, limit and budget"""
+        self.budget.record_request()
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                await self.bucket.aacquire(timeout=self.timeout)
+            async with self.limiter.aslot(self.timeout):
+                try:
+                    result = await send()
+                except Exception as e:
+                    attempt += 1
+                    retry_after = self._failed(e, attempt)
+                else:
+                    self.limiter.on_success()
+                    return result
+            await asyncio.sleep(backoff_delay(attempt - 1, retry_after))
+
+    def _failed(self, exc, attempt):
+        """Feed a failed attempt back; returns the Retry-After to honour, or re-raises when retrying stops"""
+        retryable, throttled, retry_after = classify_error(exc)
+        if throttled:
+            self.limiter.on_throttle()
+            if retry_after and self.bucket is not None:
+                self.bucket.pause(retry_after)
+        if not retryable or attempt >= self.max_attempts or not self.budget.try_retry():
+            raise exc
+        return retry_after
+
+
+@checks.register()
+def check_rate_limit_cache(app_configs=None, **kwargs):
+    """Warn when the shared token bucket lives in a cache each process has its own copy of"""
+    if not getattr(settings, 'EMAIL_RATE_LIMIT_PER_SECOND', None):
+        return []
+    alias = getattr(settings, 'EMAIL_RATE_LIMIT_CACHE', 'default')
+    if not isinstance(caches[alias], (LocMemCache, DummyCache)):
+        return []
+    return [checks.Warning(
+        f"EMAIL_RATE_LIMIT_CACHE '{alias}' is local to each process, so every worker "
+        f"sends at the full EMAIL_RATE_LIMIT_PER_SECOND.",
+        hint='Point EMAIL_RATE_LIMIT_CACHE at a cache shared by the workers, such as Redis or memcached.',
+        id='email_app.W001',
+    )]
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def build_throttle(name='azure-email', rate=None, burst=None, max_attempts=None):
+    """
+    A Throttle configured from settings. ``rate`` and ``burst`` default to
+    EMAIL_RATE_LIMIT_PER_SECOND/BURST; ``name`` keys the shared token bucket.
+    """
+    rate = rate or getattr(settings, 'EMAIL_RATE_LIMIT_PER_SECOND', None)
+    burst = burst or getattr(settings, 'EMAIL_RATE_LIMIT_BURST', None)
+    if rate:
+        for warning in check_rate_limit_cache():
+            logger.warning("%s %s", warning.msg, warning.hint)
+    return Throttle(
+        bucket=TokenBucket(name, rate, burst) if rate else None,
+        limiter=AdaptiveConcurrencyLimiter(
+            initial=getattr(settings, 'EMAIL_SEND_CONCURRENCY_INITIAL', 8),
+            minimum=getattr(settings, 'EMAIL_SEND_CONCURRENCY_MIN', 1),
+            maximum=getattr(settings, 'EMAIL_SEND_CONCURRENCY_MAX', 64),
+        ),
+        budget=RetryBudget(ratio=getattr(settings, 'EMAIL_SEND_RETRY_BUDGET_RATIO', 0.1)),
+        max_attempts=max_attempts,
+    )
+
+
+def get_throttle():
+    """Return the process-wide Throttle configured from settings"""
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = build_throttle()
+        return _throttle
+
+
+def reset_throttle():
+    global _throttle
+    with _throttle_lock:
+        _throttle = None
+
+
+def _forget_throttle_after_fork():
+    global _throttle, _throttle_lock
+    _throttle_lock = threading.Lock()
+    _throttle = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_throttle_after_fork)
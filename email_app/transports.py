@@ -0,0 +1,423 @@
+# email_app/transports.py
+import bisect
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from azure.communication.email import EmailClient
+from azure.core.credentials import AzureKeyCredential
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .services import deliver_api, deliver_smtp, get_operation_status
+from .smtp_pool import get_smtp_pool
+from .metrics import record_send
+from .results import SendResult, SendTimings, is_permanent_error
+from .throttling import build_throttle
+
+
+class Transport:
+    """
+    One way out for email: an SMTP relay, an ACS resource's direct API, ...
+
+    ``deliver`` sends a single message and returns a ``results.SendResult``.
+    It raises on failure so the router can tell a broken transport from a
+    message that can never be sent.
+    ``weight`` is the transport's share of traffic relative to the others.
+    Transports draw from the shared EMAIL_RATE_LIMIT_PER_SECOND bucket unless
+    given their own ``rate`` (and ``burst``), e.g. for a separate ACS resource.
+    """
+    kind = None
+
+    def __init__(self, name, weight=1, throttle=None, max_attempts=None, rate=None, burst=None):
+        self.name = name
+        self.weight = weight
+        # Each transport gets its own AIMD limit; the router fails over after
+        # these retries rather than retrying longer
+        self.throttle = throttle or build_throttle(
+            f'transport:{name}' if rate else 'azure-email',
+            rate=rate,
+            burst=burst,
+            max_attempts=max_attempts or getattr(settings, 'EMAIL_TRANSPORT_MAX_ATTEMPTS', 2),
+        )
+
+    def deliver(self, sender, recipients, subject, body, html_body=None, attachments=None, timings=None):
+        """Send one message and return its SendResult; raise on failure. Phase times go on ``timings``"""
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.name}>'
+
+
+class SMTPTransport(Transport):
+    kind = 'smtp'
+
+    def __init__(self, name, host, port=587, username=None, password=None, use_tls=True, **kwargs):
+        super().__init__(name, **kwargs)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+
+    def deliver(self, sender, recipients, subject, body, html_body=None, attachments=None, timings=None):
+        pool = get_smtp_pool(self.host, self.port, self.username, self.password, use_tls=self.use_tls)
+        suppressed = []
+        message_id = deliver_smtp(
+            pool, self.throttle, sender, recipients, subject, body, html_body, attachments, timings=timings,
+            suppressed=suppressed
+        )
+        result = SendResult.sent(
+            f"Email sent successfully via {self.name}. Message ID: {message_id}", self.name, message_id, timings
+        )
+        result.suppressed = suppressed
+        return result
+
+
+class APITransport(Transport):
+    kind = 'api'
+
+    def __init__(self, name, connection_string=None, endpoint=None, api_key=None, client_kwargs=None, **kwargs):
+        super().__init__(name, **kwargs)
+        if connection_string:
+            self.email_client = EmailClient.from_connection_string(connection_string, **(client_kwargs or {}))
+        elif endpoint and api_key:
+            self.email_client = EmailClient(endpoint, AzureKeyCredential(api_key), **(client_kwargs or {}))
+        else:
+            raise ValueError(f"Transport {name} needs a connection_string or an endpoint and api_key")
+
+    def deliver(self, sender, recipients, subject, body, html_body=None, attachments=None, timings=None):
+        suppressed = []
+        operation, continuation_token = deliver_api(
+            self.email_client, self.throttle, sender, recipients, subject, body, html_body, attachments,
+            timings=timings, wait=getattr(settings, 'EMAIL_DIRECT_API_WAIT', False), suppressed=suppressed
+        )
+        result = SendResult.from_operation(operation, self.name, timings, continuation_token)
+        result.suppressed = suppressed
+        return result
+
+    def get_operation_status(self, continuation_token):
+        """Current body of a send operation this transport accepted, like ``AzureEmailService``'s"""
+        return get_operation_status(self.email_client, self.throttle, continuation_token)
+
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; cheap to update and to read percentiles from"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile (0-1), or None when empty"""
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank and bucket_count:
+                    return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.total
+        return {
+            'count': count,
+            'mean': total / count if count else None,
+            'buckets': dict(zip([*self.buckets, float('inf')], counts)),
+        }
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker over a rolling window of calls.
+
+    The breaker opens once at least ``min_calls`` calls in the last
+    ``window`` seconds include ``failure_rate`` failures or ``slow_rate``
+    calls slower than ``slow_call_seconds``. After ``open_seconds`` one probe
+    call is let through; its outcome closes the breaker or opens it again.
+    ``begin`` hands the probe a token, and results passed to ``record``
+    without it (calls that started before the breaker opened) are ignored
+    until the probe is back.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, window=None, min_calls=None, failure_rate=None, slow_call_seconds=None,
+                 slow_rate=None, open_seconds=None):
+        self.window = window or getattr(settings, 'EMAIL_TRANSPORT_BREAKER_WINDOW', 30)
+        self.min_calls = min_calls or getattr(settings, 'EMAIL_TRANSPORT_BREAKER_MIN_CALLS', 10)
+        self.failure_rate = failure_rate or getattr(settings, 'EMAIL_TRANSPORT_BREAKER_FAILURE_RATE', 0.5)
+        self.slow_call_seconds = slow_call_seconds or getattr(settings, 'EMAIL_TRANSPORT_SLOW_CALL_SECONDS', 10)
+        self.slow_rate = slow_rate or getattr(settings, 'EMAIL_TRANSPORT_BREAKER_SLOW_RATE', 0.8)
+        self.open_seconds = open_seconds or getattr(settings, 'EMAIL_TRANSPORT_BREAKER_OPEN_SECONDS', 30)
+        self.state = self.CLOSED
+        self.opened_at = None
+        self._calls = deque()
+        self._probe = None
+
+    def available(self, now):
+        """Whether a call may be sent now; callers hold the router's lock"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.open_seconds
+        return self._probe is None
+
+    def begin(self, now):
+        """
+        Note that a call is starting; an expired open breaker lets it through
+        as the probe. Returns the probe token for ``record``, or None.
+        """
+        if self.state == self.OPEN and now - self.opened_at >= self.open_seconds:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            self._probe = object()
+            return self._probe
+        return None
+
+    def record(self, now, ok, latency, token=None):
+        slow = latency >= self.slow_call_seconds
+        if self.state == self.HALF_OPEN:
+            if token is None or token is not self._probe:
+                return
+            self._probe = None
+            if ok and not slow:
+                self.state = self.CLOSED
+                self._calls.clear()
+            else:
+                self._open(now)
+            return
+        if self.state == self.OPEN:
+            return
+
+        self._calls.append((now, ok, slow))
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+        calls = len(self._calls)
+        if calls < self.min_calls:
+            return
+        failures = sum(1 for _, call_ok, _ in self._calls if not call_ok)
+        slow_calls = sum(1 for _, _, call_slow in self._calls if call_slow)
+        if failures >= self.failure_rate * calls or slow_calls >= self.slow_rate * calls:
+            self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self._calls.clear()
+
+
+class _Route:
+    """Router bookkeeping for one transport"""
+
+    def __init__(self, transport, breaker):
+        self.transport = transport
+        self.breaker = breaker
+        self.outstanding = 0
+        self.sent = 0
+        self.failed = 0
+        self.latency = LatencyHistogram()
+
+
+class TransportRouter:
+    """
+    Spread sends over several transports by weighted least outstanding
+    requests, failing over when a transport errors.
+
+    Each send goes to the available transport with the lowest
+    ``(outstanding + 1) / weight``; ties are broken at random. A transport
+    whose circuit breaker is open is skipped, and a failed send is retried on
+    the next best transport it has not tried yet. Latency of every attempt is
+    kept per transport in a LatencyHistogram.
+    """
+
+    def __init__(self, transports, breaker_factory=CircuitBreaker):
+        if not transports:
+            raise ValueError("TransportRouter needs at least one transport")
+        self.routes = [_Route(transport, breaker_factory()) for transport in transports]
+        self._lock = threading.Lock()
+
+    def _acquire(self, exclude):
+        """
+        Pick a route and count the send against it: ``(route, probe token)``,
+        or None when none is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [
+                route for route in self.routes
+                if route not in exclude and route.breaker.available(now)
+            ]
+            if not candidates:
+                return None
+            best = min((route.outstanding + 1) / route.transport.weight for route in candidates)
+            route = random.choice([
+                route for route in candidates
+                if (route.outstanding + 1) / route.transport.weight == best
+            ])
+            token = route.breaker.begin(now)
+            route.outstanding += 1
+            return route, token
+
+    def _release(self, route, token, latency, error=None):
+        route.latency.observe(latency)
+        # A message the provider refused still shows the transport works
+        healthy = error is None or is_permanent_error(error)
+        with self._lock:
+            route.outstanding -= 1
+            if error is None:
+                route.sent += 1
+            else:
+                route.failed += 1
+            route.breaker.record(time.monotonic(), healthy, latency, token)
+
+    def send(self, sender, recipients, subject, body, html_body=None, attachments=None):
+        """Send one message; returns a ``results.SendResult`` like AzureEmailService"""
+        result = self._send(sender, recipients, subject, body, html_body, attachments)
+        record_send(result)
+        return result
+
+    def _send(self, sender, recipients, subject, body, html_body, attachments):
+        tried = []
+        last_error = None
+        started = time.monotonic()
+        while True:
+            acquired = self._acquire(tried)
+            if acquired is None:
+                break
+            route, token = acquired
+            tried.append(route)
+            name = route.transport.name
+            timings = SendTimings()
+            attempt_started = time.monotonic()
+            try:
+                result = route.transport.deliver(
+                    sender, recipients, subject, body, html_body, attachments, timings=timings
+                )
+            except Exception as e:
+                self._release(route, token, time.monotonic() - attempt_started, e)
+                timings.total = time.monotonic() - started
+                if is_permanent_error(e):
+                    return SendResult.failed(
+                        e, f"Failed to send email via {name}: {str(e)}", transport=name, timings=timings
+                    )
+                last_error = (e, name, timings)
+            else:
+                self._release(route, token, time.monotonic() - attempt_started)
+                result.timings.total = time.monotonic() - started
+                return result
+
+        if last_error is None:
+            return SendResult(
+                False,
+                "Failed to send email: no transport available, every circuit breaker is open",
+                error_class='CircuitOpen',
+                retryable=True,
+            )
+        error, name, timings = last_error
+        return SendResult.failed(
+            error,
+            f"Failed to send email on every transport; last error from {name}: {str(error)}",
+            transport=name,
+            timings=timings
+        )
+
+    def transport(self, name):
+        """The transport called ``name``, or None"""
+        for route in self.routes:
+            if route.transport.name == name:
+                return route.transport
+        return None
+
+    def stats(self):
+        """Per-transport state, counters and latency percentiles, e.g. for a status page"""
+        with self._lock:
+            rows = [
+                (route, route.breaker.state, route.outstanding, route.sent, route.failed)
+                for route in self.routes
+            ]
+        return {
+            route.transport.name: {
+                'kind': route.transport.kind,
+                'weight': route.transport.weight,
+                'state': state,
+                'outstanding': outstanding,
+                'sent': sent,
+                'failed': failed,
+                'p50': route.latency.percentile(0.5),
+                'p90': route.latency.percentile(0.9),
+                'p99': route.latency.percentile(0.99),
+                'latency': route.latency.snapshot(),
+            }
+            for route, state, outstanding, sent, failed in rows
+        }
+
+
+TRANSPORT_TYPES = {
+    'smtp': SMTPTransport,
+    'api': APITransport,
+}
+
+
+def build_transport(config):
+    """A Transport from one EMAIL_TRANSPORTS entry; ``type`` is a key of TRANSPORT_TYPES or a dotted path"""
+    options = dict(config)
+    transport_type = options.pop('type')
+    cls = TRANSPORT_TYPES.get(transport_type) or import_string(transport_type)
+    return cls(**options)
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_transport_router():
+    """
+    Return the process-wide TransportRouter built from EMAIL_TRANSPORTS, or
+    None when that setting is empty and sends use AzureEmailService directly.
+    """
+    global _router
+    configs = getattr(settings, 'EMAIL_TRANSPORTS', None)
+    if not configs:
+        return None
+    with _router_lock:
+        if _router is None:
+            _router = TransportRouter([build_transport(config) for config in configs])
+        return _router
+
+
+def reset_transport_router():
+    global _router
+    with _router_lock:
+        _router = None
+
+
+def _forget_router_after_fork():
+    global _router, _router_lock
+    _router_lock = threading.Lock()
+    _router = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_router_after_fork)
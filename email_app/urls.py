@@ -3,8 +3,15 @@ from . import views
 
 urlpatterns = [
     path('', views.index, name='index'),
+    path('history/', views.email_history, name='email_history'),
+    path('api/history/', views.email_history_api, name='email_history_api'),
     path('send-email/', views.send_email, name='send_email'),
+    path('send-email/async/', views.send_email_async, name='send_email_async'),
     path('dns-management/', views.dns_management, name='dns_management'),
+    path('service-stats/', views.service_stats, name='service_stats'),
+    path('metrics', views.metrics, name='metrics'),
+    path('webhooks/email-events/', views.email_events, name='email_events'),
+    path('roundcube/sso/validate/', views.roundcube_sso_validate, name='roundcube_sso_validate'),
 ]
 
 